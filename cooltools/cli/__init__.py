@@ -60,6 +60,8 @@ from . import (
     compute_saddle,
     call_dots,
     call_compartments,
+    compute_pileup,
+    compute_directionality,
     genome,
     random_sample,
 )
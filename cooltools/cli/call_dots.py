@@ -1,4 +1,6 @@
+import os
 import os.path as op
+import tempfile
 import pandas as pd
 import numpy as np
 import cooler
@@ -146,6 +148,15 @@ from .. import dotfinder
     default="parquet",
     show_default=True,
 )
+@click.option(
+    "--spill-pixels",
+    help="Stream pixels extracted at the FDR thresholds into a temporary"
+    " HDF5 file, and post-process them one chromosome at a time. Bounds"
+    " memory usage by the number of extracted pixels on the largest"
+    " chromosome, useful for permissive FDR on deep Hi-C maps.",
+    is_flag=True,
+    default=False,
+)
 @click.option(
     "--temp-dir",
     help="Create temporary files in specified directory.",
@@ -178,6 +189,7 @@ def call_dots(
     output_hists,
     output_calls,
     score_dump_mode,
+    spill_pixels,
     temp_dir,
     no_delete_temp,
 ):
@@ -285,7 +297,9 @@ def call_dots(
     # may lead to scoring the same pixel twice, - i.e. duplicates.
 
     # generate standard kernels - consider providing custom ones
-    kernels = {k: dotfinder.get_kernel(w, p, k) for k in ktypes}
+    # kernels are decomposed into shared sub-regions once, and
+    # evaluated together for every tile:
+    kernels = dotfinder.KernelBank.from_params(w, p, ktypes)
 
     # list of tile coordinate ranges
     tiles = list(
@@ -335,6 +349,10 @@ def call_dots(
     )
 
     # 3. Filter using FDR thresholds calculated in the histogramming step
+    spill_path = None
+    if spill_pixels:
+        fd, spill_path = tempfile.mkstemp(suffix=".h5", dir=temp_dir)
+        os.close(fd)
     filtered_pixels = dotfinder.scoring_and_extraction_step(
         clr,
         expected,
@@ -350,27 +368,47 @@ def call_dots(
         output_calls,
         nproc,
         verbose,
+        spill_path=spill_path,
     )
 
     # 4. Post-processing
-    if verbose:
-        print(
-            "Begin post-processing of {} filtered pixels".format(len(filtered_pixels))
+    if spill_pixels:
+        # 4a. annotation and clustering one chromosome at a time:
+        centroids = dotfinder.postprocessing_step(
+            spill_path,
+            clr,
+            expected_chroms,
+            qvalues,
+            kernels,
+            dots_clustering_radius,
+            verbose,
         )
-        print("preparing to extract needed q-values ...")
+        if not no_delete_temp:
+            os.remove(spill_path)
+    else:
+        if verbose:
+            print(
+                "Begin post-processing of {} filtered pixels".format(
+                    len(filtered_pixels)
+                )
+            )
+            print("preparing to extract needed q-values ...")
 
-    filtered_pixels_qvals = dotfinder.annotate_pixels_with_qvalues(
-        filtered_pixels, qvalues, kernels
-    )
-    # 4a. clustering
-    ########################################################################
-    # Clustering has to be done using annotated DataFrame of filtered pixels
-    # why ? - because - clustering has to be done chromosome by chromosome !
-    ########################################################################
-    filtered_pixels_annotated = cooler.annotate(filtered_pixels_qvals, clr.bins()[:])
-    centroids = dotfinder.clustering_step(
-        filtered_pixels_annotated, expected_chroms, dots_clustering_radius, verbose
-    )
+        filtered_pixels_qvals = dotfinder.annotate_pixels_with_qvalues(
+            filtered_pixels, qvalues, kernels
+        )
+        # 4a. clustering
+        ####################################################################
+        # Clustering has to be done using annotated DataFrame of filtered
+        # pixels why ? - because - clustering has to be done chromosome by
+        # chromosome !
+        ####################################################################
+        filtered_pixels_annotated = cooler.annotate(
+            filtered_pixels_qvals, clr.bins()[:]
+        )
+        centroids = dotfinder.clustering_step(
+            filtered_pixels_annotated, expected_chroms, dots_clustering_radius, verbose
+        )
 
     # 4b. filter by enrichment and qval
     postprocessed_calls = dotfinder.thresholding_step(centroids)
@@ -0,0 +1,119 @@
+import multiprocess as mp
+import click
+import cooler
+
+from . import cli
+from .. import directionality
+
+
+@cli.command()
+@click.argument("in_path", metavar="IN_PATH", type=str, nargs=1)
+@click.argument("window", nargs=-1, metavar="WINDOW", type=int, required=True)
+@click.option(
+    "--output",
+    "-o",
+    help="Specify output file name to store the directionality in a tsv format.",
+    type=str,
+    required=False,
+)
+@click.option(
+    "--balance",
+    help="Name of the column of the bin table with balancing weights.",
+    type=str,
+    default="weight",
+    show_default=True,
+)
+@click.option(
+    "--ignore-diags",
+    help="The number of diagonals to ignore. By default, equals"
+    " the number of diagonals ignored during IC balancing.",
+    type=int,
+    default=None,
+    show_default=True,
+)
+@click.option(
+    "--min-dist-bad-bin",
+    help="The minimal allowed distance to a bad bin. "
+    "Directionality is not reported for bins closer to a bad bin.",
+    type=int,
+    default=2,
+    show_default=True,
+)
+@click.option(
+    "--window-pixels",
+    help="If set then the window sizes are provided in units of pixels.",
+    is_flag=True,
+)
+@click.option(
+    "--chunksize",
+    help="The number of pixels to read at a time.",
+    type=int,
+    default=20000000,
+    show_default=True,
+)
+@click.option(
+    "--nproc",
+    "-p",
+    help="Number of processes to split the work between, one chromosome"
+    " per process at a time. [default: 1, i.e. no process pool]",
+    default=1,
+    type=int,
+)
+@click.option("--verbose", help="Report real-time progress.", is_flag=True)
+def compute_directionality(
+    in_path,
+    window,
+    output,
+    balance,
+    ignore_diags,
+    min_dist_bad_bin,
+    window_pixels,
+    chunksize,
+    nproc,
+    verbose,
+):
+    """
+    Calculate the directionality ratios and indices of genomic bins.
+
+    IN_PATH : The paths to a .cool file with a balanced Hi-C map.
+
+    WINDOW : The size of the window upstream and downstream of a bin.
+             Multiple space-separated values can be provided, all of them
+             are calculated from a single read of the map.
+             By default, the window size must be provided in units of bp.
+             When the flag --window-pixels is set, the window sizes must
+             be provided in units of pixels instead.
+    """
+
+    clr = cooler.Cooler(in_path)
+    if window_pixels:
+        window = [win * clr.info["bin-size"] for win in window]
+
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        map_ = pool.imap_unordered
+    else:
+        map_ = map
+
+    # using try-clause to close mp.Pool properly
+    try:
+        dir_table = directionality.directionality(
+            clr,
+            window_bp=list(window),
+            balance=balance,
+            min_dist_bad_bin=min_dist_bad_bin,
+            ignore_diags=ignore_diags,
+            chunksize=chunksize,
+            verbose=verbose,
+            map=map_,
+        )
+    finally:
+        if nproc > 1:
+            pool.close()
+
+    # output to file if specified:
+    if output:
+        dir_table.to_csv(output, sep="\t", index=False, na_rep="nan")
+    # or print into stdout otherwise:
+    else:
+        print(dir_table.to_csv(sep="\t", index=False, na_rep="nan"))
@@ -0,0 +1,168 @@
+import multiprocess as mp
+import pandas as pd
+import numpy as np
+import cooler
+
+import click
+from . import cli
+from .util import sniff_for_header
+from .. import snipping
+
+
+@cli.command()
+@click.argument(
+    "cool_path",
+    metavar="COOL_PATH",
+    type=str,
+    nargs=1,
+)
+@click.argument(
+    "features_path",
+    metavar="FEATURES_PATH",
+    type=click.Path(exists=True, dir_okay=False),
+    nargs=1,
+)
+@click.option(
+    "--features-format",
+    help="Format of FEATURES_PATH: 'bed' for on-diagonal features"
+    " (chrom, start, end), 'bedpe' for pairs of loci"
+    " (chrom1, start1, end1, chrom2, start2, end2).",
+    type=click.Choice(["bed", "bedpe"]),
+    default="bed",
+    show_default=True,
+)
+@click.option(
+    "--expected",
+    "expected_path",
+    help="Path to a tsv-like file with cis-expected, with 'chrom' and"
+    " 'balanced.avg' columns. Observed over expected is piled up when"
+    " provided, and balanced observed otherwise.",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+)
+@click.option(
+    "--flank",
+    help="Size of the flanks around the midpoints of features, in bp.",
+    type=int,
+    default=100000,
+    show_default=True,
+)
+@click.option(
+    "--by",
+    help="Name of a column of FEATURES_PATH to aggregate features by,"
+    " e.g. a motif orientation. Repeat for multiple columns."
+    " Requires FEATURES_PATH with a header.",
+    type=str,
+    multiple=True,
+)
+@click.option(
+    "-p", "--nproc",
+    help="Number of processes to split the work between."
+    " [default: 1, i.e. no process pool]",
+    default=1,
+    type=int,
+)
+@click.option(
+    "-o", "--out-prefix",
+    help="Dump 'groups', 'mean', 'std', 'count' and 'n' arrays of the pileups"
+    " in a numpy-specific .npz container. Use numpy.load to load these arrays"
+    " into a dict-like object.",
+    required=True,
+)
+def compute_pileup(
+    cool_path,
+    features_path,
+    features_format,
+    expected_path,
+    flank,
+    by,
+    nproc,
+    out_prefix,
+):
+    """
+    Pileup (average) snippets of a Hi-C map around features, without keeping
+    snippets of all of the features in memory.
+
+    COOL_PATH : The paths to a .cool file with a balanced Hi-C map. Use the
+    '::' syntax to specify a group path in a multicooler file.
+
+    FEATURES_PATH : The path to a BED-like or BEDPE-like file with features.
+    Snippets are centered at the midpoints of the features.
+
+    Features on the same chromosome are processed together, and chromosomes
+    are split between processes, with every process opening COOL_PATH itself.
+
+    """
+    clr = cooler.Cooler(cool_path)
+
+    buf, names = sniff_for_header(features_path)
+    features = pd.read_table(buf, header=0 if names else None)
+    if features_format == "bed":
+        ends = [("chrom", "start", "end")]
+    else:
+        ends = [("chrom1", "start1", "end1"), ("chrom2", "start2", "end2")]
+    if not names:
+        columns = [name for end in ends for name in end]
+        features = features.rename(columns=dict(enumerate(columns)))
+    if not set(by).issubset(features.columns):
+        raise ValueError(
+            "Columns {} are not found in {}".format(list(by), features_path)
+        )
+
+    windows = []
+    for chrom, start, end in ends:
+        windows.append(
+            snipping.make_bin_aligned_windows(
+                clr.binsize,
+                features[chrom],
+                (features[start] + features[end]) // 2,
+                flank_bp=flank,
+            )
+        )
+    if features_format == "bed":
+        windows = windows[0]
+    else:
+        windows = pd.merge(
+            windows[0],
+            windows[1],
+            left_index=True,
+            right_index=True,
+            suffixes=("1", "2"),
+        )
+    for col in by:
+        windows[col] = features[col]
+
+    supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
+    windows = snipping.assign_regions(windows, supports)
+    windows = windows[windows["region"].notnull()]
+
+    if expected_path is None:
+        spec = snipping.SnipperSpec(snipping.CoolerSnipper, clr.uri)
+    else:
+        expected = pd.read_table(expected_path)
+        spec = snipping.SnipperSpec(snipping.ObsExpSnipper, clr.uri, expected)
+
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        map_ = pool.imap_unordered
+    else:
+        map_ = map
+    try:
+        accumulators = snipping.accumulate_snipper_pileup(
+            windows, spec, by=list(by) if by else None, map=map_
+        )
+    finally:
+        if nproc > 1:
+            pool.close()
+
+    if not by:
+        accumulators = {"all": accumulators}
+    groups = list(accumulators)
+    np.savez(
+        out_prefix + ".pileup",
+        groups=np.array([str(group) for group in groups]),
+        mean=np.array([accumulators[group].mean for group in groups]),
+        std=np.array([accumulators[group].std for group in groups]),
+        count=np.array([accumulators[group].count for group in groups]),
+        n=np.array([accumulators[group].n for group in groups]),
+    )
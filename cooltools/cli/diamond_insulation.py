@@ -1,3 +1,5 @@
+import multiprocess as mp
+import numpy as np
 import click
 import cooler
 
@@ -25,6 +27,17 @@ from .. import insulation
     type=str,
     required=False,
 )
+@click.option(
+    "--output-format",
+    help="The format of the output: a 'tsv' table, a 'parquet' table or"
+    " 'bigwig' tracks of the insulation scores and boundary strengths of"
+    " every window, named <output>.<column>.bw. Tables of chromosomes are"
+    " written as soon as they are done. 'parquet' requires pyarrow and"
+    " 'bigwig' requires pyBigWig.",
+    type=click.Choice(["tsv", "parquet", "bigwig"]),
+    default="tsv",
+    show_default=True,
+)
 @click.option(
     "--ignore-diags",
     help="The number of diagonals to ignore. By default, equals"
@@ -67,6 +80,14 @@ from .. import insulation
     default=20000000,
     show_default=True
 )
+@click.option(
+    "--nproc",
+    "-p",
+    help="Number of processes to split the work between, one chromosome"
+    " per process at a time. [default: 1, i.e. no process pool]",
+    default=1,
+    type=int,
+)
 @click.option(
     "--verbose",
     help="Report real-time progress.",
@@ -76,12 +97,14 @@ def diamond_insulation(
     in_path,
     window,
     output,
+    output_format,
     ignore_diags,
     min_frac_valid_pixels,
     min_dist_bad_bin,
     window_pixels,
     append_raw_scores,
     chunksize,
+    nproc,
     verbose,
 ):
     """
@@ -100,24 +123,138 @@ def diamond_insulation(
     if window_pixels:
         window = [win * clr.info["bin-size"] for win in window]
 
-    ins_table = insulation.calculate_insulation_score(
-        clr,
-        window_bp=window,
-        ignore_diags=ignore_diags,
-        append_raw_scores=append_raw_scores,
-        chunksize=chunksize,
-        verbose=verbose,
-    )
-
-    ins_table = insulation.find_boundaries(
-        ins_table,
-        min_frac_valid_pixels=min_frac_valid_pixels,
-        min_dist_bad_bin=min_dist_bad_bin,
-    )
-
-    # output to file if specified:
-    if output:
-        ins_table.to_csv(output, sep="\t", index=False, na_rep="nan")
-    # or print into stdout otherwise:
+    if output_format != "tsv" and not output:
+        raise click.UsageError(
+            "--output is required with --output-format {}".format(output_format)
+        )
+
+    # tables of chromosomes are written as soon as they are done:
+    if output_format == "parquet":
+        writer = _ParquetWriter(output)
+    elif output_format == "bigwig":
+        writer = _BigWigWriter(output, clr.chromsizes)
+    else:
+        writer = _TsvWriter(output)
+
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        map_ = pool.imap_unordered
     else:
-        print(ins_table.to_csv(sep="\t", index=False, na_rep="nan"))
+        map_ = map
+
+    # using try-clause to close mp.Pool properly
+    try:
+        for ins_chrom in insulation.iter_insulation_boundaries(
+            clr,
+            window_bp=window,
+            ignore_diags=ignore_diags,
+            append_raw_scores=append_raw_scores,
+            min_frac_valid_pixels=min_frac_valid_pixels,
+            min_dist_bad_bin=min_dist_bad_bin,
+            chunksize=chunksize,
+            verbose=verbose,
+            map=map_,
+        ):
+            writer.write(ins_chrom)
+    finally:
+        writer.close()
+        if nproc > 1:
+            pool.close()
+
+
+class _TsvWriter:
+    """
+    Append tables to a tsv file, or print them to stdout if path is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = True
+
+    def write(self, table):
+        if self.path:
+            table.to_csv(
+                self.path,
+                sep="\t",
+                index=False,
+                na_rep="nan",
+                mode="w" if self.header else "a",
+                header=self.header,
+            )
+        else:
+            print(
+                table.to_csv(sep="\t", index=False, na_rep="nan", header=self.header),
+                end="",
+            )
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class _ParquetWriter:
+    """
+    Append tables to a parquet file, as one row group per table.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("The pyarrow module is required to write parquet")
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.writer = None
+
+    def write(self, table):
+        table = self.pa.Table.from_pandas(
+            table.astype({"chrom": str}), preserve_index=False
+        )
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _BigWigWriter:
+    """
+    Write the insulation scores and the boundary strengths of every window
+    as bigwig tracks, named <prefix>.<column>.bw.
+    """
+
+    track_prefixes = ("log2_insulation_score", "boundary_strength")
+
+    def __init__(self, prefix, chromsizes):
+        try:
+            import pyBigWig
+        except ImportError:
+            raise ImportError("The pyBigWig module is required to write bigwig")
+        self.pyBigWig = pyBigWig
+        self.prefix = prefix
+        self.header = [(chrom, int(size)) for chrom, size in chromsizes.items()]
+        self.tracks = {}
+
+    def write(self, table):
+        for col in table.columns:
+            if not col.startswith(self.track_prefixes):
+                continue
+            if col not in self.tracks:
+                bw = self.pyBigWig.open("{}.{}.bw".format(self.prefix, col), "w")
+                bw.addHeader(self.header)
+                self.tracks[col] = bw
+            values = table[col].values
+            valid = np.isfinite(values)
+            self.tracks[col].addEntries(
+                table["chrom"].values[valid].astype(str).tolist(),
+                table["start"].values[valid].tolist(),
+                ends=table["end"].values[valid].tolist(),
+                values=values[valid].astype(float).tolist(),
+            )
+
+    def close(self):
+        for bw in self.tracks.values():
+            bw.close()
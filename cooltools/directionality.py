@@ -1,69 +1,58 @@
+import logging
 import warnings
+from functools import partial
+
 import numpy as np
 import pandas as pd
-from .lib import peaks, numutils
-
-
-def dirscore(pixels, bins, window=10, ignore_diags=2, balanced=True, signed_chi2=False):
-    lo_bin_id = bins.index.min()
-    hi_bin_id = bins.index.max() + 1
-    N = hi_bin_id - lo_bin_id
-
-    bad_bin_mask = (
-        bins["weight"].isnull().values if balanced else np.zeros(N, dtype=bool)
-    )
-
-    diag_pixels = pixels[pixels["bin2_id"] - pixels["bin1_id"] <= (window - 1) * 2]
-    if balanced:
-        diag_pixels = diag_pixels[~diag_pixels["balanced"].isnull()]
-
-    i = diag_pixels["bin1_id"].values - lo_bin_id
-    j = diag_pixels["bin2_id"].values - lo_bin_id
-    val = diag_pixels["balanced"].values if balanced else diag_pixels["count"].values
+import cooler
 
-    sum_pixels_left = np.zeros(N)
-    n_pixels_left = np.zeros(N)
-    for i_shift in range(0, window):
-        if i_shift < ignore_diags:
-            continue
-
-        mask = (i + i_shift == j) & (i + i_shift < N) & (j >= 0)
-        sum_pixels_left += np.bincount(i[mask] + i_shift, val[mask], minlength=N)
-
-        loc_bad_bin_mask = np.zeros(N, dtype=bool)
-        if i_shift == 0:
-            loc_bad_bin_mask |= bad_bin_mask
-        else:
-            loc_bad_bin_mask[i_shift:] |= bad_bin_mask[:-i_shift]
-            loc_bad_bin_mask |= bad_bin_mask
-        n_pixels_left[i_shift:] += 1 - loc_bad_bin_mask[i_shift:]
-
-    sum_pixels_right = np.zeros(N)
-    n_pixels_right = np.zeros(N)
-    for j_shift in range(0, window):
-        if j_shift < ignore_diags:
-            continue
+from .lib._query import CSRSelector
+from .lib import peaks, numutils
 
-        mask = (i == j - j_shift) & (i < N) & (j - j_shift >= 0)
 
-        sum_pixels_right += np.bincount(i[mask], val[mask], minlength=N)
+def _add_to_dirsums(sums_left, sums_right, i, j, values, windows, ignore_diags):
+    """
+    Add pixels (i, j) to the upstream (left) and downstream (right) sums of
+    all windows at once. The sums are kept per band of diagonals between the
+    sorted `windows` and become the sums over windows by their cumulative
+    sum over the bands, so the cost does not depend on the window sizes.
+    """
+    n_windows, N = sums_left.shape
+    diag = j - i
+    sel = (diag >= ignore_diags) & (diag < windows[-1])
+    i, j, diag, values = i[sel], j[sel], diag[sel], values[sel]
+    # the smallest window, in which the pixel is included:
+    band = np.searchsorted(windows, diag, side="right")
+    size = n_windows * N
+    sums_left += np.bincount(band * N + j, values, size).reshape(n_windows, N)
+    sums_right += np.bincount(band * N + i, values, size).reshape(n_windows, N)
 
-        loc_bad_bin_mask = np.zeros(N, dtype=bool)
-        loc_bad_bin_mask |= bad_bin_mask
-        if j_shift == 0:
-            loc_bad_bin_mask |= bad_bin_mask
-        else:
-            loc_bad_bin_mask[:-j_shift] |= bad_bin_mask[j_shift:]
 
-        n_pixels_right[: (-j_shift if j_shift else None)] += (
-            1 - loc_bad_bin_mask[: (-j_shift if j_shift else None)]
+def _dirsums(pixel_chunks, N, windows, ignore_diags):
+    """
+    Upstream and downstream sums of every window from (i, j, values)
+    chunks, in one pass over the chunks. Returns two arrays of the shape
+    (len(windows), N), with the rows in the order of `windows`.
+    """
+    windows = np.asarray(windows)
+    order = np.argsort(windows)
+    sorted_windows = windows[order]
+    sums_left = np.zeros((len(windows), N))
+    sums_right = np.zeros((len(windows), N))
+    for i, j, values in pixel_chunks:
+        _add_to_dirsums(
+            sums_left, sums_right, i, j, values, sorted_windows, ignore_diags
         )
+    sums_left = np.cumsum(sums_left, axis=0)
+    sums_right = np.cumsum(sums_right, axis=0)
+    ranks = np.argsort(order)
+    return sums_left[ranks], sums_right[ranks]
+
 
+def _dirscore_from_sums(a, b, signed_chi2=False):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
-        a = sum_pixels_left
-        b = sum_pixels_right
         if signed_chi2:
             e = (a + b) / 2.0
             score = np.sign(b - a) * ((a - e) ** 2 + (b - e) ** 2) / e
@@ -73,6 +62,25 @@ def dirscore(pixels, bins, window=10, ignore_diags=2, balanced=True, signed_chi2
     return score
 
 
+def dirscore(pixels, bins, window=10, ignore_diags=2, balanced=True, signed_chi2=False):
+    lo_bin_id = bins.index.min()
+    hi_bin_id = bins.index.max() + 1
+    N = hi_bin_id - lo_bin_id
+
+    diag_pixels = pixels[pixels["bin2_id"] - pixels["bin1_id"] <= (window - 1) * 2]
+    if balanced:
+        diag_pixels = diag_pixels[~diag_pixels["balanced"].isnull()]
+
+    i = diag_pixels["bin1_id"].values - lo_bin_id
+    j = diag_pixels["bin2_id"].values - lo_bin_id
+    val = diag_pixels["balanced"].values if balanced else diag_pixels["count"].values
+
+    sums_left, sums_right = _dirsums(
+        [(i, j, val.astype(float))], N, [window], ignore_diags
+    )
+    return _dirscore_from_sums(sums_left[0], sums_right[0], signed_chi2)
+
+
 def _dirscore_dense(A, window=10, signed_chi2=False):
     N = A.shape[0]
     di = np.zeros(N)
@@ -98,28 +106,46 @@ def directionality(
     min_dist_bad_bin=2,
     ignore_diags=None,
     chromosomes=None,
+    chunksize=20000000,
+    verbose=False,
+    map=map,
 ):
-    """Calculate the diamond insulation scores and call insulating boundaries.
+    """Calculate the directionality ratios and indices of genomic bins.
+
+    The pixels near the diagonal are read once per chromosome, up to the
+    largest window, and the upstream and downstream sums of all windows are
+    accumulated in one pass.
 
     Parameters
     ----------
     clr : cooler.Cooler
         A cooler with balanced Hi-C data.
-    window_bp : int
-        The size of the sliding diamond window used to calculate the insulation
-        score.
+    window_bp : int or list
+        The size(s) of the window upstream and downstream of a bin.
+    balance : str
+        The name of the column of the bin table with balancing weights.
     min_dist_bad_bin : int
-        The minimal allowed distance to a bad bin. Do not calculate insulation
-        scores for bins having a bad bin closer than this distance.
+        The minimal allowed distance to a bad bin. Do not calculate
+        directionality for bins having a bad bin closer than this distance.
     ignore_diags : int
         The number of diagonals to ignore. If None, equals the number of
         diagonals ignored during IC balancing.
+    chromosomes : list of str
+        The chromosomes to process, all of them by default.
+    chunksize : int
+        The number of pixels to read at a time.
+    verbose : bool
+        If True, report real-time progress.
+    map : callable
+        Map functor implementation, e.g. the `imap_unordered` of a process
+        pool. Chromosomes are processed independently, each by a worker
+        opening the cooler by itself.
 
     Returns
     -------
-    ins_table : pandas.DataFrame
-        A table containing the insulation scores of the genomic bins and
-        the insulating boundary strengths.
+    dir_table : pandas.DataFrame
+        A table with the directionality ratios and indices of every window,
+        for the genomic bins of the chromosomes in genome order.
     """
     if chromosomes is None:
         chromosomes = clr.chromnames
@@ -128,56 +154,103 @@ def directionality(
     ignore_diags = (
         ignore_diags
         if ignore_diags is not None
-        else clr._load_attrs(clr.root.rstrip("/") + "/bins/weight")["ignore_diags"]
+        else clr._load_attrs(clr.root.rstrip("/") + "/bins/" + balance)["ignore_diags"]
     )
-    window_bins = window_bp // bin_size
 
-    if window_bp % bin_size != 0:
+    window_bp = np.atleast_1d(window_bp)
+
+    bad_win_sizes = window_bp % bin_size != 0
+    if np.any(bad_win_sizes):
         raise Exception(
-            "The window size ({}) has to be a multiple of the bin size {}".format(
-                window_bp, bin_size
+            "The window sizes {} has to be a multiple of the bin size {}".format(
+                window_bp[bad_win_sizes], bin_size
             )
         )
 
-    dir_chrom_tables = []
-    for chrom in chromosomes:
-        chrom_bins = clr.bins().fetch(chrom)
-        chrom_pixels = clr.matrix(as_pixels=True, balance=balance).fetch(chrom)
-
-        # mask neighbors of bad bins
-        is_bad_bin = np.isnan(chrom_bins["weight"].values)
-        bad_bin_neighbor = np.zeros_like(is_bad_bin)
-        for i in range(0, min_dist_bad_bin):
-            if i == 0:
-                bad_bin_neighbor = bad_bin_neighbor | is_bad_bin
-            else:
-                bad_bin_neighbor = bad_bin_neighbor | np.r_[[True] * i, is_bad_bin[:-i]]
-                bad_bin_neighbor = bad_bin_neighbor | np.r_[is_bad_bin[i:], [True] * i]
-
-        dir_chrom = chrom_bins[["chrom", "start", "end"]].copy()
-        dir_chrom["bad_bin_masked"] = bad_bin_neighbor
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", RuntimeWarning)
-            dir_track = dirscore(
-                chrom_pixels, chrom_bins, window=window_bins, ignore_diags=ignore_diags
-            )
-            dir_track[bad_bin_neighbor] = np.nan
-            dir_track[~np.isfinite(dir_track)] = np.nan
-            dir_chrom["directionality_ratio_{}".format(window_bp)] = dir_track
-
-            dir_track = dirscore(
-                chrom_pixels,
-                chrom_bins,
-                window=window_bins,
-                ignore_diags=ignore_diags,
-                signed_chi2=True,
-            )
+    # largest chromosomes first, to balance the load of the workers:
+    chromosomes = sorted(chromosomes, key=lambda chrom: -clr.chromsizes[chrom])
+    job = partial(
+        _directionality_chrom,
+        clr.uri,
+        window_bp,
+        balance,
+        min_dist_bad_bin,
+        ignore_diags,
+        chunksize,
+        verbose,
+    )
+    dir_chrom_tables = dict(map(job, chromosomes))
+
+    # genome order of the chromosomes:
+    chromosomes = [chrom for chrom in clr.chromnames if chrom in dir_chrom_tables]
+    dir_table = pd.concat([dir_chrom_tables[chrom] for chrom in chromosomes])
+    return dir_table
+
+
+def _directionality_chrom(
+    cool_uri,
+    window_bp,
+    balance,
+    min_dist_bad_bin,
+    ignore_diags,
+    chunksize,
+    verbose,
+    chrom,
+):
+    """
+    Calculate the directionality of a single chromosome, opening the cooler
+    in the process that does the work. Returns a (chrom, table) pair.
+    """
+    if verbose:
+        logging.info("Processing {}".format(chrom))
+
+    clr = cooler.Cooler(cool_uri)
+    window_bins = window_bp // clr.info["bin-size"]
+
+    chrom_bins = clr.bins().fetch(chrom)
+    weights = chrom_bins[balance].values
+    c0, c1 = clr.extent(chrom)
+
+    # only the band of the largest window is read:
+    nbins = len(clr.bins())
+    selector = CSRSelector(
+        clr.open("r"), shape=(nbins, nbins), field="count", chunksize=chunksize
+    )
+    chrom_query = selector.band(c0, c1, max_diag=max(window_bins))
+
+    def balanced_chunks():
+        for chunk_dict in chrom_query.read_chunked():
+            i = chunk_dict["bin1_id"] - c0
+            j = chunk_dict["bin2_id"] - c0
+            balanced = chunk_dict["count"] * weights[i] * weights[j]
+            valid_pixel_mask = ~np.isnan(balanced)
+            yield i[valid_pixel_mask], j[valid_pixel_mask], balanced[valid_pixel_mask]
+
+    sums_left, sums_right = _dirsums(
+        balanced_chunks(), c1 - c0, window_bins, ignore_diags
+    )
+
+    # mask neighbors of bad bins
+    is_bad_bin = np.isnan(weights)
+    bad_bin_neighbor = np.zeros_like(is_bad_bin)
+    for i in range(0, min_dist_bad_bin):
+        if i == 0:
+            bad_bin_neighbor = bad_bin_neighbor | is_bad_bin
+        else:
+            bad_bin_neighbor = bad_bin_neighbor | np.r_[[True] * i, is_bad_bin[:-i]]
+            bad_bin_neighbor = bad_bin_neighbor | np.r_[is_bad_bin[i:], [True] * i]
+
+    dir_chrom = chrom_bins[["chrom", "start", "end"]].copy()
+    dir_chrom["bad_bin_masked"] = bad_bin_neighbor
+
+    for k, win in enumerate(window_bp):
+        for key, signed_chi2 in [
+            ("directionality_ratio_{}", False),
+            ("directionality_index_{}", True),
+        ]:
+            dir_track = _dirscore_from_sums(sums_left[k], sums_right[k], signed_chi2)
             dir_track[bad_bin_neighbor] = np.nan
             dir_track[~np.isfinite(dir_track)] = np.nan
-            dir_chrom["directionality_index_{}".format(window_bp)] = dir_track
+            dir_chrom[key.format(win)] = dir_track
 
-        dir_chrom_tables.append(dir_chrom)
-
-    dir_table = pd.concat(dir_chrom_tables)
-    return dir_table
+    return chrom, dir_chrom
@@ -2,7 +2,9 @@
 Collection of functions related to dot-calling
 
 """
+from collections.abc import Mapping
 from functools import partial, reduce
+from itertools import groupby
 import multiprocess as mp
 
 from scipy.linalg import toeplitz
@@ -80,6 +82,134 @@ def buffer_df_chunks(chunks, size=25000000):
         print("last guy shipped ...")
 
 
+def groupwise_argmax(values, *group_keys):
+    """
+    Positions of the first maximum of 'values' in every group of rows with
+    equal 'group_keys', in the sorted order of the groups.
+
+    Same as 'df.groupby(keys)[values].idxmax()', but positional, and done with
+    a single stable sort and a sorted-group reduction, instead of a Python
+    loop over groups.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        1D array of values to find maximums of.
+    group_keys : numpy.ndarray
+        1D arrays of sortable keys (e.g. integers), same length as 'values',
+        the first key being the most significant one.
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        Integer positions of a maximum value within every group.
+
+    """
+    values = np.asarray(values)
+    if not len(values):
+        return np.array([], dtype=np.int64)
+    # stable sort, so rows within a group keep their order:
+    order = np.lexsort(group_keys[::-1])
+    sorted_keys = [np.asarray(key)[order] for key in group_keys]
+    is_start = np.zeros(len(values), dtype=bool)
+    is_start[0] = True
+    for key in sorted_keys:
+        is_start[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(is_start)
+    group_ids = np.cumsum(is_start) - 1
+    sorted_values = values[order]
+    group_max = np.maximum.reduceat(sorted_values, starts)
+    # the first of the maximums within every group:
+    is_max = np.flatnonzero(sorted_values == group_max[group_ids])
+    is_first = np.r_[True, group_ids[is_max][1:] != group_ids[is_max][:-1]]
+    return order[is_max[is_first]]
+
+
+def _indexed_stripe_job(job, indexed_stripe):
+    """
+    Helper to run a per-tile 'job' on all of the tiles of a stripe and keep
+    track of the tile indices, so that results completed out of order can be
+    put back in order. A stripe is sent to a worker as a single task, so the
+    tiles of a stripe share the band of rows cached by the 'TileReader' of
+    the 'job'.
+    """
+    return [(idx, job(tile)) for idx, tile in indexed_stripe]
+
+
+def ordered_pixel_chunks(
+    tiles, indexed_chunks, bin1_id_name=bin1_id_name, bin2_id_name=bin2_id_name
+):
+    """
+    A reorder buffer that consumes chunks of scored pixels, computed for
+    'tiles' and completed in an arbitrary order (e.g. by 'imap_unordered'),
+    and yields chunks of pixels in bin1-major order, i.e. sorted by bin1_id
+    and then by bin2_id across all of the yielded chunks.
+
+    Such a stream of chunks can be written to a cooler in a single pass,
+    using 'cooler.create_cooler(..., ordered=True)', without writing
+    temporary sorted partitions and merging them.
+
+    Parameters
+    ----------
+    tiles : list
+        List of tiles (chrom, tilei, tilej) in the order of their indices,
+        sorted by the row-start of the tiles, i.e. tilei[0].
+    indexed_chunks : iterable
+        Iterable of (tile_index, pixels_df) pairs, where tile_index is
+        the position of the tile in 'tiles' and pixels_df is a DataFrame
+        with the scored pixels of that tile.
+    bin1_id_name : str
+        Name of the 1st coordinate (row index) in pixels DataFrames.
+    bin2_id_name : str
+        Name of the 2nd coordinate (column index) in pixels DataFrames.
+
+    Yields
+    ------
+    chunk : pandas.DataFrame
+        Chunks of deduplicated pixels in bin1-major order.
+
+    Notes
+    -----
+    Pixels are released once no unfinished tile can produce a pixel in
+    the same or in a preceding row, i.e. pixels with bin1_id below the
+    smallest row-start of the tiles that are not completed yet. Tiles are
+    padded and overlap, thus a pixel can be scored twice - only the first
+    occurrence is kept.
+
+    """
+    row_starts = np.array([tilei[0] for _, tilei, _ in tiles], dtype=np.int64)
+    # watermarks[t] - the smallest row that tiles t, t+1, ... can produce,
+    # the last one is for the case when all of the tiles are completed:
+    watermarks = np.append(
+        np.minimum.accumulate(row_starts[::-1])[::-1], np.iinfo(np.int64).max
+    )
+    pending = {}
+    held = []
+    next_tile = 0
+    released_to = -1
+    for idx, chunk in indexed_chunks:
+        pending[idx] = chunk
+        # move the contiguous run of completed tiles into the buffer:
+        while next_tile in pending:
+            held.append(pending.pop(next_tile))
+            next_tile += 1
+        watermark = watermarks[next_tile]
+        if watermark <= released_to or not held:
+            continue
+        released_to = watermark
+        buf = pd.concat(held, axis=0, ignore_index=True)
+        is_released = buf[bin1_id_name].values < watermark
+        held = [buf[~is_released]] if not is_released.all() else []
+        out = (
+            buf[is_released]
+            .drop_duplicates(subset=[bin1_id_name, bin2_id_name])
+            .sort_values(by=[bin1_id_name, bin2_id_name])
+            .reset_index(drop=True)
+        )
+        if len(out):
+            yield out
+
+
 ##################################
 # dotfinder-specific service functions:
 ##################################
@@ -540,6 +670,120 @@ def heatmap_tiles_generator_diag(clr, chroms, pad_size, tile_size, band_to_cover
                 yield chrom, tilei, tilej
 
 
+class TileReader(object):
+    """
+    Reader of dense raw observed heatmap tiles, that serves tiles
+    from a band of rows, which is read from the cooler only once.
+
+    Tiles are expected to be requested stripe by stripe, i.e. with the
+    same row-span and increasing column-spans, as yielded by the
+    'heatmap_tiles_generator_diag'. Pixels of the band are read directly
+    from the CSR-index of the cooler, sorted by column once, and every
+    tile is filled in by a pair of binary searches and a single scatter
+    into a preallocated dense buffer, that is reused between the tiles.
+
+    Only the upper triangle is read from the cooler, i.e. the lower
+    triangle of tiles crossing the main diagonal is zero (it is masked
+    out in 'get_adjusted_expected_tile_some_nans' anyway).
+
+    Parameters
+    ----------
+    clr : cooler
+        Cooler object to read the tiles from.
+    field : str
+        Name of the pixel column to read, "count" by default.
+    max_span : int or None
+        Keep only pixels closer than 'max_span' bins to the first row of
+        the band. Tiles reaching further are still served, by reading
+        the missing columns of the band. None to keep the entire rows.
+
+    Example
+    -------
+    >>> reader = TileReader(clr, max_span=band_to_cover + tile_size)
+    >>> observed = reader[slice(*tilei), slice(*tilej)]
+
+    """
+
+    def __init__(self, clr, field="count", max_span=None):
+        self.clr = clr
+        self.field = field
+        self.max_span = max_span
+        self._clear()
+
+    def _clear(self):
+        # band of rows [i0, i1) and columns [i0, j_stop):
+        self._rows = None
+        self._j_stop = None
+        self._bin1 = None
+        self._bin2 = None
+        self._data = None
+        self._buffer = None
+
+    def __getstate__(self):
+        # do not send the cached band to worker processes:
+        state = self.__dict__.copy()
+        for key in ["_rows", "_j_stop", "_bin1", "_bin2", "_data", "_buffer"]:
+            state[key] = None
+        return state
+
+    def _read_band(self, i0, i1, j0, j1):
+        # read upper-triangle pixels in rows [i0, i1) and columns [j0, j1),
+        # sorted by column:
+        with self.clr.open("r") as grp:
+            offsets = grp["indexes"]["bin1_offset"][i0 : i1 + 1]
+            p0, p1 = offsets[0], offsets[-1]
+            bin1 = np.repeat(np.arange(i0, i1), np.diff(offsets))
+            bin2 = grp["pixels"]["bin2_id"][p0:p1]
+            data = grp["pixels"][self.field][p0:p1]
+        mask = (bin2 >= j0) & (bin2 < j1)
+        order = np.argsort(bin2[mask], kind="mergesort")
+        return bin1[mask][order], bin2[mask][order], data[mask][order]
+
+    def _load(self, rows, j_stop):
+        i0, i1 = rows
+        if self._rows != rows:
+            # new stripe - read a new band of rows:
+            n_bins = self.clr.shape[1]
+            if self.max_span is None:
+                j_band = n_bins
+            else:
+                j_band = min(n_bins, i0 + self.max_span)
+            self._bin1, self._bin2, self._data = self._read_band(
+                i0, i1, i0, max(j_band, j_stop)
+            )
+            self._rows = rows
+            self._j_stop = max(j_band, j_stop)
+        elif j_stop > self._j_stop:
+            # tile reaches beyond the band - read the missing columns,
+            # that all go after the cached ones in the column order:
+            bin1, bin2, data = self._read_band(i0, i1, self._j_stop, j_stop)
+            self._bin1 = np.concatenate([self._bin1, bin1])
+            self._bin2 = np.concatenate([self._bin2, bin2])
+            self._data = np.concatenate([self._data, data])
+            self._j_stop = j_stop
+
+    def __getitem__(self, key):
+        islice, jslice = key
+        i0, i1 = islice.start, islice.stop
+        j0, j1 = jslice.start, jslice.stop
+        self._load((i0, i1), j1)
+        # pixels in the column-span of the tile:
+        lo, hi = np.searchsorted(self._bin2, [j0, j1])
+        shape = (i1 - i0, j1 - j0)
+        if self._buffer is None or self._buffer.size < shape[0] * shape[1]:
+            self._buffer = np.empty(shape[0] * shape[1], dtype=self._data.dtype)
+        tile = self._buffer[: shape[0] * shape[1]].reshape(shape)
+        tile.fill(0)
+        tile[self._bin1[lo:hi] - i0, self._bin2[lo:hi] - j0] = self._data[lo:hi]
+        return tile
+
+
+def _tile_reader(clr, tiles):
+    # reader keeping only the columns, reached by the tiles of a stripe:
+    max_span = max((tilej[1] - tilei[0] for _, tilei, tilej in tiles), default=None)
+    return TileReader(clr, max_span=max_span)
+
+
 ##################################
 # kernel-convolution related:
 ##################################
@@ -587,6 +831,185 @@ def _convolve_and_count_nans(O_bal, E_bal, E_raw, N_bal, kernel):
     return Ek_raw, NN
 
 
+def _sum_of_shifts(mat, start, stop, length, axis):
+    """
+    Sum of the slices [shift:shift+length] of 'mat' along 'axis'
+    for every shift in the range [start, stop).
+    """
+    mat = np.moveaxis(mat, axis, 0)
+    result = mat[start : start + length].copy()
+    for shift in range(start + 1, stop):
+        result += mat[shift : shift + length]
+    return np.moveaxis(result, 0, axis)
+
+
+class KernelBank(Mapping):
+    """
+    A collection of named convolution kernels, that are evaluated together.
+
+    Kernels are decomposed into rectangular sub-regions shared by all of
+    the kernels - each sub-region has a constant value within every kernel.
+    Convolution of a matrix with all of the kernels then reduces to sums
+    over these sub-regions, and the sum over each sub-region is computed
+    once and reused by every kernel that covers it. Thus, adding more
+    kernel types costs little extra.
+
+    KernelBank behaves as a read-only dictionary of kernels, and can be used
+    wherever a dictionary of kernels is expected.
+
+    Parameters
+    ----------
+    kernels : dict of (str, numpy.ndarray)
+        Dictionary of square kernels of odd size. Kernels of different
+        sizes are aligned by their centers.
+
+    """
+
+    def __init__(self, kernels):
+        kernels = {name: np.asarray(kernel) for name, kernel in kernels.items()}
+        if not kernels:
+            raise ValueError("'kernels' must contain at least one kernel.")
+        for name, kernel in kernels.items():
+            if (
+                kernel.ndim != 2
+                or kernel.shape[0] != kernel.shape[1]
+                or kernel.shape[0] % 2 == 0
+            ):
+                raise ValueError(
+                    "Kernel {} must be a square matrix of odd size.".format(name)
+                )
+        self._kernels = kernels
+        self.pad = max(kernel.shape[0] for kernel in kernels.values()) // 2
+        size = 2 * self.pad + 1
+
+        # stack of kernels flipped (convolution vs correlation)
+        # and padded to a common size:
+        stack = np.zeros((len(kernels), size, size))
+        for k, kernel in enumerate(kernels.values()):
+            o = self.pad - kernel.shape[0] // 2
+            stack[k, o : size - o, o : size - o] = kernel[::-1, ::-1]
+
+        # split the footprint along rows and columns wherever any of
+        # the kernels changes, so that every cell is uniform in every kernel:
+        row_changes = (stack[:, 1:, :] != stack[:, :-1, :]).any(axis=(0, 2))
+        col_changes = (stack[:, :, 1:] != stack[:, :, :-1]).any(axis=(0, 1))
+        row_edges = np.r_[0, 1 + np.flatnonzero(row_changes), size]
+        col_edges = np.r_[0, 1 + np.flatnonzero(col_changes), size]
+        # merge horizontally adjacent cells with the same values in
+        # all of the kernels, and then vertically adjacent ones:
+        rects = []
+        for r0, r1 in zip(row_edges[:-1], row_edges[1:]):
+            row_rects = []
+            for c0, c1 in zip(col_edges[:-1], col_edges[1:]):
+                values = stack[:, r0, c0]
+                if row_rects and np.array_equal(row_rects[-1][4], values):
+                    row_rects[-1][3] = c1
+                else:
+                    row_rects.append([r0, r1, c0, c1, values])
+            for rect in row_rects:
+                if not rect[4].any():
+                    continue
+                for prev in rects:
+                    if (
+                        prev[1] == rect[0]
+                        and prev[2:4] == rect[2:4]
+                        and np.array_equal(prev[4], rect[4])
+                    ):
+                        prev[1] = rect[1]
+                        break
+                else:
+                    rects.append(rect)
+        self._rects = [tuple(rect[:4]) for rect in rects]
+        # (n_kernels, n_rects) matrix of kernel values in each sub-region:
+        self._weights = np.array([rect[4] for rect in rects]).T
+
+    def __getitem__(self, name):
+        return self._kernels[name]
+
+    def __iter__(self):
+        return iter(self._kernels)
+
+    def __len__(self):
+        return len(self._kernels)
+
+    @classmethod
+    def from_params(cls, w, p, ktypes):
+        """
+        Build a KernelBank of the standard kernels, see 'get_kernel'.
+        """
+        return cls({ktype: get_kernel(w, p, ktype) for ktype in ktypes})
+
+    @property
+    def rects(self):
+        """
+        Shared rectangular sub-regions of the flipped kernels,
+        as (row_start, row_end, col_start, col_end) tuples.
+        """
+        return list(self._rects)
+
+    def convolve(self, O_bal, E_bal, N_bal):
+        """
+        Convolve balanced observed and expected with every kernel and count
+        NaNs in the footprint of every kernel, same as
+        scipy.ndimage.convolve with mode="constant" and cval=0 for O_bal and
+        E_bal, and cval=1 for the NaN-matrix N_bal.
+
+        Parameters
+        ----------
+        O_bal, E_bal : numpy.ndarray
+            Dense balanced observed and expected, with NaNs filled in.
+        N_bal : numpy.ndarray
+            Boolean matrix of NaNs shared by O_bal and E_bal.
+
+        Returns
+        -------
+        convolved : dict
+            Dictionary with kernel names as keys and tuples (KO, KE, NN) as
+            values.
+
+        """
+        m, n = O_bal.shape
+        pad = self.pad
+        # matrices padded with the values beyond the boundary:
+        padded = [
+            np.pad(np.asarray(O_bal, dtype=np.float64), pad, constant_values=0.0),
+            np.pad(np.asarray(E_bal, dtype=np.float64), pad, constant_values=0.0),
+            np.pad(np.asarray(N_bal, dtype=np.int64), pad, constant_values=1),
+        ]
+        footprints = (self._weights != 0).astype(np.int64)
+        results = [
+            np.zeros((len(self), m, n)),
+            np.zeros((len(self), m, n)),
+            np.zeros((len(self), m, n), dtype=np.int64),
+        ]
+        # sums over a sub-region are accumulated from shifted slices
+        # (not from cumulative sums), so that the sum in a given pixel
+        # does not depend on its position within a tile, and pixels
+        # shared by overlapping tiles get exactly the same scores.
+        # Row-wise sums over a range of columns are shared between
+        # sub-regions with the same columns:
+        row_sums = [{}, {}, {}]
+        for r, (r0, r1, c0, c1) in enumerate(self._rects):
+            for mat, cache, result, weights in zip(
+                padded,
+                row_sums,
+                results,
+                (self._weights, self._weights, footprints),
+            ):
+                if (c0, c1) not in cache:
+                    cache[(c0, c1)] = _sum_of_shifts(mat, c0, c1, n, axis=1)
+                box = _sum_of_shifts(cache[(c0, c1)], r0, r1, m, axis=0)
+                for k in np.flatnonzero(weights[:, r]):
+                    if weights[k, r] == 1:
+                        result[k] += box
+                    else:
+                        result[k] += weights[k, r] * box
+        return {
+            name: (results[0][k], results[1][k], results[2][k])
+            for k, name in enumerate(self._kernels)
+        }
+
+
 ########################################################################
 # this should be a MAIN function to get locally adjusted expected
 # Die Hauptfunktion
@@ -686,11 +1109,12 @@ def get_adjusted_expected_tile_some_nans(
         all local environments (all kernels),
         to be considered significant.
         Dictionay keys must contain names for
-        each kernel.
+        each kernel. Pass a KernelBank to avoid
+        decomposing the kernels for every tile.
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         Beware!: kernels are flipped and
-        only then multiplied to matrix by
-        scipy.ndimage.convolve
+        only then multiplied to matrix, same
+        as in scipy.ndimage.convolve
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
     balance_factor: float
         Multiplicative Balancing factor:
@@ -743,11 +1167,13 @@ def get_adjusted_expected_tile_some_nans(
             "for a slice of matrix with an arbitrary origin."
         )
     # kernels must be a dict with kernel-names as keys
-    # and kernel ndarrays as values.
-    if not isinstance(kernels, dict):
+    # and kernel ndarrays as values, or a KernelBank.
+    if not isinstance(kernels, Mapping):
         raise ValueError(
             "'kernels' must be a dictionary" "with name-keys and ndarrays-values."
         )
+    if not isinstance(kernels, KernelBank):
+        kernels = KernelBank(kernels)
 
     # balanced observed, from raw-observed
     # by element-wise multiply:
@@ -786,53 +1212,23 @@ def get_adjusted_expected_tile_some_nans(
     # pack it into DataFrame to accumulate results:
     peaks_df = pd.DataFrame({"bin1_id": i.flatten() + io, "bin2_id": j.flatten() + jo})
 
+    # all of the kernels are evaluated at once, sharing partial sums
+    # of O_bal, E_bal and N_bal between kernels (see KernelBank):
+    convolved = kernels.convolve(O_bal, E_bal, N_bal)
+
     with np.errstate(divide="ignore", invalid="ignore"):
-        for kernel_name, kernel in kernels.items():
+        for kernel_name in kernels:
             ###############################
             # kernel-specific calculations:
             ###############################
-            # kernel paramters such as width etc
-            # are taken into account implicitly ...
-            ########################################
-            #####################
-            # unroll _convolve_and_count_nans function back
-            # for us to test the dynamic donut criteria ...
-            #####################
-            # Ek_raw, NN = _convolve_and_count_nans(O_bal,
-            #                                     E_bal,
-            #                                     E_raw,
-            #                                     N_bal,
-            #                                     kernel)
-            # Dense versions of a bunch of matrices needed for convolution and
-            # calculation of number of NaNs in a vicinity of each pixel. And a kernel to
-            # be provided of course.
-            # a matrix filled with the kernel-weighted sums
-            # based on a balanced observed matrix:
-            KO = convolve(O_bal, kernel, mode="constant", cval=0.0, origin=0)
-            # a matrix filled with the kernel-weighted sums
-            # based on a balanced expected matrix:
-            KE = convolve(E_bal, kernel, mode="constant", cval=0.0, origin=0)
-            # get number of NaNs in a vicinity of every
-            # pixel (kernel's nonzero footprint)
-            # based on the NaN-matrix N_bal.
-            # N_bal is shared NaNs between O_bal E_bal,
-            NN = convolve(
-                N_bal.astype(np.int),
-                # we have to use kernel's
-                # nonzero footprint:
-                (kernel != 0).astype(np.int),
-                mode="constant",
-                # there are only NaNs
-                # beyond the boundary:
-                cval=1,
-                origin=0,
-            )
-            ######################################
-            # using cval=0 for actual data and
-            # cval=1 for NaNs matrix reduces
-            # "boundary issue" to the "number of
-            # NaNs"-issue
-            # ####################################
+            # KO, KE - matrices filled with the kernel-weighted sums
+            # based on balanced observed and expected matrices, and
+            # NN - number of NaNs in a vicinity of every pixel
+            # (kernel's nonzero footprint) based on the NaN-matrix N_bal.
+            # This is equivalent to scipy.ndimage.convolve with
+            # cval=0 for actual data and cval=1 for NaNs matrix, which
+            # reduces "boundary issue" to the "number of NaNs"-issue.
+            KO, KE, NN = convolved[kernel_name]
             # now finally, E_raw*(KO/KE), as the
             # locally-adjusted expected with raw counts as values:
             Ek_raw = np.multiply(E_raw, np.divide(KO, KE))
@@ -904,6 +1300,7 @@ def score_tile(
     band_to_cover,
     balance_factor,
     verbose,
+    tile_reader=None,
 ):
     """
     The main working function that given a tile of a heatmap, applies kernels to
@@ -940,6 +1337,9 @@ def score_tile(
         use None value to disable dynamic-donut criteria calculation.
     verbose : bool
         Enable verbose output.
+    tile_reader : TileReader or None
+        Reader to fetch raw observed tiles with, which reuses bands of rows
+        between the tiles of a stripe. None to query cooler for every tile.
 
     Returns
     -------
@@ -959,7 +1359,10 @@ def score_tile(
     lazy_exp = LazyToeplitz(cis_exp.loc[chrom][exp_v_name].values)
 
     # RAW observed matrix slice:
-    observed = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
+    if tile_reader is None:
+        observed = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
+    else:
+        observed = tile_reader[slice(*tilei), slice(*tilej)]
     # expected as a rectangular tile :
     expected = lazy_exp[slice(*tilei), slice(*tilej)]
     # slice of balance_weight for row-span and column-span :
@@ -1278,6 +1681,9 @@ def scoring_step(
 
     # add very_verbose to supress output from convolution of every tile
     very_verbose = False
+    # decompose kernels once, instead of doing it for every tile:
+    if not isinstance(kernels, KernelBank):
+        kernels = KernelBank(kernels)
     job = partial(
         score_tile,
         clr=clr,
@@ -1291,11 +1697,13 @@ def scoring_step(
         # for now.
         balance_factor=None,
         verbose=very_verbose,
+        tile_reader=_tile_reader(clr, tiles),
     )
 
     if nproc > 1:
         pool = mp.Pool(nproc)
         map_ = pool.imap
+        map_unordered_ = pool.imap_unordered
         map_kwargs = dict(chunksize=int(np.ceil(len(tiles) / nproc)))
         if verbose:
             print(
@@ -1305,6 +1713,7 @@ def scoring_step(
             )
     else:
         map_ = map
+        map_unordered_ = map
         if verbose:
             print("fallback to serial implementation.")
         map_kwargs = {}
@@ -1312,7 +1721,10 @@ def scoring_step(
         # consider using
         # https://github.com/mirnylab/cooler/blob/9e72ee202b0ac6f9d93fd2444d6f94c524962769/cooler/tools.py#L59
         # here:
-        chunks = map_(job, tiles, **map_kwargs)
+        if output_mode != "cooler":
+            # Pool.imap dispatches tasks right away, cooler output
+            # dispatches its own, ordering-aware ones:
+            chunks = map_(job, tiles, **map_kwargs)
         ###########################################
         #
         # this is to be rewritten using cooler output
@@ -1348,19 +1760,35 @@ def scoring_step(
             # # dtype them just in case as well:
             # dtypes = {"la_exp."+k+".value":np.float64 for k in kernels}
             # dtypes["count"] = np.int32
-            # create_cooler using buffered chunks iterator, to speed up
-            # cooler merge, as suggested by @nvictus
+            # score tiles in bin1-major order, one stripe at a time per worker,
+            # and put out-of-order completions back in order with a reorder
+            # buffer - this way pixels can be written in a single pass,
+            # without sorting temporary partitions and merging them:
+            ordered_tiles = sorted(tiles, key=lambda tile: (tile[1][0], tile[2][0]))
+            stripes = [
+                list(stripe)
+                for _, stripe in groupby(
+                    enumerate(ordered_tiles), key=lambda item: item[1][:2]
+                )
+            ]
+            indexed_chunks = (
+                indexed_chunk
+                for stripe_chunks in map_unordered_(
+                    partial(_indexed_stripe_job, job), stripes
+                )
+                for indexed_chunk in stripe_chunks
+            )
             cooler.create_cooler(
                 output_path,
                 clr.bins()[:],
                 # iterator of larger pixel chunks ...
-                buffer_df_chunks(chunks),
+                buffer_df_chunks(ordered_pixel_chunks(ordered_tiles, indexed_chunks)),
                 columns=columns,
                 # dtypes=dtypes,
                 # # to be included later, copy from original clr?
                 # metadata : dict, optional
                 # assembly : str, optional
-                ordered=False,  # not ordered for sure
+                ordered=True,
                 symmetric_upper=True,  # is it really ? should be
                 mode="w",
             )
@@ -1744,21 +2172,18 @@ def clustering_step(
     """
     # using different bin12_id_names since all
     # pixels are annotated at this point.
+    # positions of cis-pixels on every chromosome, found in a single pass:
+    chrom1 = scores_df["chrom1"].astype(str).values
+    chrom2 = scores_df["chrom2"].astype(str).values
+    cis_positions = np.flatnonzero(chrom1 == chrom2)
+    chrom_positions = (
+        pd.Series(cis_positions).groupby(chrom1[cis_positions]).indices
+    )
     pixel_clust_list = []
     for chrom in expected_chroms:
-        # probably generate one big DataFrame with clustering
-        # information only and then just merge it with the
-        # existing 'scores_df'-DataFrame.
-        # should we use groupby instead of 'scores_df['chrom12']==chrom' ?!
-        # to be tested ...
-        df = scores_df[
-            (
-                (scores_df["chrom1"].astype(str) == str(chrom))
-                & (scores_df["chrom2"].astype(str) == str(chrom))
-            )
-        ]
-        if not len(df):
+        if str(chrom) not in chrom_positions:
             continue
+        df = scores_df.iloc[cis_positions[chrom_positions[str(chrom)]]]
 
         pixel_clust = clust_2D_pixels(
             df,
@@ -1782,9 +2207,21 @@ def clustering_step(
     #prevents scores_df categorical values (all chroms, including chrM)
     df['chrom1'] = df['chrom1'].astype(str)
     df['chrom2'] = df['chrom2'].astype(str)
-    # report only centroids with highest Observed:
-    chrom_clust_group = df.groupby(["chrom1", "chrom2", "c_label"])
-    centroids = df.loc[chrom_clust_group[obs_raw_name].idxmax()]
+    # report only centroids with highest Observed,
+    # (same as groupby(["chrom1", "chrom2", "c_label"]) and idxmax):
+    clustered = np.flatnonzero(df["c_label"].notna().values)
+    chrom1_codes = pd.factorize(df["chrom1"].values[clustered], sort=True)[0]
+    chrom2_codes = pd.factorize(df["chrom2"].values[clustered], sort=True)[0]
+    centroids = df.iloc[
+        clustered[
+            groupwise_argmax(
+                df[obs_raw_name].values[clustered],
+                chrom1_codes,
+                chrom2_codes,
+                df["c_label"].values[clustered],
+            )
+        ]
+    ]
     return centroids
 
 
@@ -1797,47 +2234,31 @@ def thresholding_step(centroids, obs_raw_name=observed_count_name):
     enrichment_factor_2 = 1.75
     enrichment_factor_3 = 2.0
     FDR_orphan_threshold = 0.02
-    ######################################################################
-    # # Temporarily remove orphans filtering, until q-vals are calculated:
-    ######################################################################
+    # filters are evaluated on bare arrays, avoiding
+    # index alignment of pandas-Series at every step:
+    obs = centroids[obs_raw_name].values
+    la_exp = {
+        k: centroids["la_exp." + k + ".value"].values
+        for k in ["donut", "vertical", "horizontal", "lowleft"]
+    }
+    qval_sum = (
+        centroids["la_exp.lowleft.qval"].values
+        + centroids["la_exp.donut.qval"].values
+        + centroids["la_exp.vertical.qval"].values
+        + centroids["la_exp.horizontal.qval"].values
+    )
     enrichment_fdr_comply = (
-        (
-            centroids[obs_raw_name]
-            > enrichment_factor_2 * centroids["la_exp.lowleft.value"]
-        )
-        & (
-            centroids[obs_raw_name]
-            > enrichment_factor_2 * centroids["la_exp.donut.value"]
-        )
-        & (
-            centroids[obs_raw_name]
-            > enrichment_factor_1 * centroids["la_exp.vertical.value"]
-        )
-        & (
-            centroids[obs_raw_name]
-            > enrichment_factor_1 * centroids["la_exp.horizontal.value"]
-        )
+        (obs > enrichment_factor_2 * la_exp["lowleft"])
+        & (obs > enrichment_factor_2 * la_exp["donut"])
+        & (obs > enrichment_factor_1 * la_exp["vertical"])
+        & (obs > enrichment_factor_1 * la_exp["horizontal"])
         & (
-            (
-                centroids[obs_raw_name]
-                > enrichment_factor_3 * centroids["la_exp.lowleft.value"]
-            )
-            | (
-                centroids[obs_raw_name]
-                > enrichment_factor_3 * centroids["la_exp.donut.value"]
-            )
+            (obs > enrichment_factor_3 * la_exp["lowleft"])
+            | (obs > enrichment_factor_3 * la_exp["donut"])
         )
         & (
-            (centroids["c_size"] > 1)
-            | (
-                (
-                    centroids["la_exp.lowleft.qval"]
-                    + centroids["la_exp.donut.qval"]
-                    + centroids["la_exp.vertical.qval"]
-                    + centroids["la_exp.horizontal.qval"]
-                )
-                <= FDR_orphan_threshold
-            )
+            (centroids["c_size"].values > 1)
+            | (qval_sum <= FDR_orphan_threshold)
         )
     )
     # #
@@ -1956,6 +2377,9 @@ def scoring_and_histogramming_step(
     # add very_verbose to supress output from convolution of every tile
     very_verbose = False
 
+    # decompose kernels once, instead of doing it for every tile:
+    if not isinstance(kernels, KernelBank):
+        kernels = KernelBank(kernels)
     # to score per tile:
     to_score = partial(
         score_tile,
@@ -1970,6 +2394,7 @@ def scoring_and_histogramming_step(
         # for now.
         balance_factor=None,
         verbose=very_verbose,
+        tile_reader=_tile_reader(clr, tiles),
     )
 
     # to hist per scored chunk:
@@ -2069,6 +2494,7 @@ def scoring_and_extraction_step(
     verbose,
     bin1_id_name="bin1_id",
     bin2_id_name="bin2_id",
+    spill_path=None,
 ):
     """
     This is a derivative of the 'scoring_step' which is supposed to implement
@@ -2078,6 +2504,12 @@ def scoring_and_extraction_step(
     Basically we are piping scoring operation together with extraction into a
     single pipeline of per-chunk operations/transforms.
 
+    With permissive FDR there could be too many extracted pixels to keep in
+    memory. Provide 'spill_path' to stream them into an HDF5 file instead,
+    with a separate table for every chromosome, and post-process them one
+    chromosome at a time with 'postprocessing_step'. In that case the
+    'spill_path' is returned instead of a DataFrame of pixels.
+
     """
     if verbose:
         print("Preparing to convolve {} tiles:".format(len(tiles)))
@@ -2085,6 +2517,9 @@ def scoring_and_extraction_step(
     # add very_verbose to supress output from convolution of every tile
     very_verbose = False
 
+    # decompose kernels once, instead of doing it for every tile:
+    if not isinstance(kernels, KernelBank):
+        kernels = KernelBank(kernels)
     # to score per tile:
     to_score = partial(
         score_tile,
@@ -2097,6 +2532,7 @@ def scoring_and_extraction_step(
         band_to_cover=loci_separation_bins,
         balance_factor=balance_factor,
         verbose=very_verbose,
+        tile_reader=_tile_reader(clr, tiles),
     )
 
     # to hist per scored chunk:
@@ -2133,6 +2569,18 @@ def scoring_and_extraction_step(
         # https://github.com/mirnylab/cooler/blob/9e72ee202b0ac6f9d93fd2444d6f94c524962769/cooler/tools.py#L59
         # here:
         filtered_pix_chunks = map_(job, tiles, **map_kwargs)
+        if spill_path is not None:
+            # map_ preserves the order of tiles, so chunks
+            # can be matched with chromosomes of their tiles:
+            chrom_chunks = zip((chrom for chrom, _, _ in tiles), filtered_pix_chunks)
+            spill_pixels(
+                clr,
+                chrom_chunks,
+                spill_path,
+                _scored_pixels_schema(kernels),
+                output_path=output_path,
+            )
+            return spill_path
         significant_pixels = pd.concat(filtered_pix_chunks, ignore_index=True)
         if output_path is not None:
             significant_pixels.to_csv(
@@ -2154,6 +2602,154 @@ def scoring_and_extraction_step(
     )
 
 
+def _spill_key(clr, chrom):
+    # chromosome names are not always valid HDF5 node names:
+    return "chrom_{}".format(clr.chromnames.index(chrom))
+
+
+_spill_schema_key = "schema"
+
+
+def _scored_pixels_schema(kernels):
+    # an empty table with the columns of pixels scored by 'score_tile':
+    columns = {"bin1_id": np.int64, "bin2_id": np.int64, "count": np.int64}
+    columns.update({"la_exp." + k + ".value": np.float64 for k in kernels})
+    return pd.DataFrame({col: np.array([], dtype=dt) for col, dt in columns.items()})
+
+
+def spill_pixels(clr, chrom_chunks, spill_path, schema, output_path=None):
+    """
+    Stream chunks of extracted pixels into an HDF5 file, partitioned by
+    chromosome, so that they never have to be held in memory all at once.
+
+    Parameters
+    ----------
+    clr : cooler
+        Cooler object the pixels were extracted from.
+    chrom_chunks : iterable of (str, pandas.DataFrame)
+        Chunks of extracted pixels, each one coming from a single chromosome.
+    spill_path : str
+        HDF5 file to write pixels to. Any existing content is overwritten.
+    schema : pandas.DataFrame
+        An empty table with the columns of pixels. It is stored as well, to
+        post-process and to write out even when there are no pixels at all.
+    output_path : str or None
+        Also write pixels to this tab-separated file, chunk by chunk.
+
+    """
+    with pd.HDFStore(spill_path, mode="w") as store:
+        store.put(_spill_schema_key, schema)
+        if output_path is not None:
+            schema.to_csv(
+                output_path, sep="\t", header=True, index=False, compression=None
+            )
+        for chrom, chunk in chrom_chunks:
+            if not len(chunk):
+                continue
+            store.append(
+                _spill_key(clr, chrom),
+                chunk,
+                format="table",
+                index=False,
+                # temporary file - favor speed over size:
+                complevel=1,
+                complib="blosc",
+            )
+            if output_path is not None:
+                chunk.to_csv(
+                    output_path,
+                    sep="\t",
+                    header=False,
+                    index=False,
+                    mode="a",
+                    compression=None,
+                )
+
+
+def postprocessing_step(
+    spill_path,
+    clr,
+    chroms,
+    qvalues,
+    kernels,
+    dots_clustering_radius,
+    verbose,
+    bin1_id_name="bin1_id",
+    bin2_id_name="bin2_id",
+):
+    """
+    Annotate and cluster pixels spilled by 'scoring_and_extraction_step'
+    one chromosome at a time, so that memory usage is bounded by the
+    number of extracted pixels on the largest chromosome.
+
+    Parameters
+    ----------
+    spill_path : str
+        HDF5 file with extracted pixels, see 'spill_pixels'.
+    clr : cooler
+        Cooler object the pixels were extracted from.
+    chroms : iterable
+        An iterable of chromosomes to be post-processed.
+    qvalues : dict of DataFrames
+        q-values for every kernel, see 'annotate_pixels_with_qvalues'.
+    kernels : dict
+        A dictionary with keys being kernels names and values being ndarrays
+        representing those kernels.
+    dots_clustering_radius : int
+        Birch-clustering threshold.
+    verbose : bool
+        Enable verbose output.
+
+    Returns
+    -------
+    centroids : pandas.DataFrame
+        Centroids of clustered pixels annotated with q-values and
+        genomic coordinates, ready for the 'thresholding_step'.
+
+    """
+    centroids = []
+    with pd.HDFStore(spill_path, mode="r") as store:
+        for chrom in chroms:
+            key = _spill_key(clr, chrom)
+            if key not in store:
+                continue
+            pixels = store.select(key)
+            if verbose:
+                print(
+                    "Post-processing {} filtered pixels on {}".format(
+                        len(pixels), chrom
+                    )
+                )
+            # there should be no duplicates in extracted pixels:
+            pixels_dups = pixels.duplicated()
+            assert (
+                not pixels_dups.any()
+            ), "Duplicated pixels detected during exctraction {}".format(
+                pixels[pixels_dups]
+            )
+            pixels = pixels.sort_values(by=[bin1_id_name, bin2_id_name]).reset_index(
+                drop=True
+            )
+            pixels = annotate_pixels_with_qvalues(
+                pixels, qvalues, kernels, inplace=True
+            )
+            # annotate with the bins of this chromosome only:
+            pixels = cooler.annotate(pixels, clr.bins())
+            centroids.append(
+                clustering_step(pixels, [chrom], dots_clustering_radius, verbose)
+            )
+        if not centroids:
+            # no pixels passed the filters - no centroids, but with the
+            # columns that clustered pixels would have:
+            pixels = annotate_pixels_with_qvalues(
+                store.select(_spill_schema_key), qvalues, kernels, inplace=True
+            )
+            pixels = cooler.annotate(pixels, clr.bins())
+            clust_columns = ["cstart1", "cstart2", "c_label", "c_size"]
+            return pixels.reindex(columns=list(pixels.columns) + clust_columns)
+    return pd.concat(centroids, ignore_index=True)
+
+
 ##################################
 # OLD functions - to be retired :
 ##################################
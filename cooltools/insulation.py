@@ -1,12 +1,14 @@
 import re
 import logging
 import warnings
+from functools import partial
+
 import numpy as np
 import pandas as pd
 import cooler
 
 from .lib._query import CSRSelector
-from .lib import peaks, numutils
+from .lib import peaks, numutils, BandMatrix
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,31 +17,45 @@ def get_n_pixels(bad_bin_mask, window=10, ignore_diags=2):
     """
     Calculate the number of "good" pixels in a diamond at each bin.
 
+    The diamond of a bin spans good rows and good columns, counted by
+    prefix sums of the good-bin mask, less the pixels on the ignored
+    diagonals, i.e. O(N * ignore_diags ** 2) instead of O(N * window ** 2).
+
     """
     N = len(bad_bin_mask)
-    n_pixels = np.zeros(N)
-    loc_bad_bin_mask = np.zeros(N, dtype=bool)
-    for i_shift in range(0, window):
-        for j_shift in range(0, window):
-            if i_shift + j_shift < ignore_diags:
-                continue
-
-            loc_bad_bin_mask[:] = False
-            if i_shift == 0:
-                loc_bad_bin_mask |= bad_bin_mask
-            else:
-                loc_bad_bin_mask[i_shift:] |= bad_bin_mask[:-i_shift]
-            if j_shift == 0:
-                loc_bad_bin_mask |= bad_bin_mask
-            else:
-                loc_bad_bin_mask[:-j_shift] |= bad_bin_mask[j_shift:]
-
-            n_pixels[i_shift : (-j_shift if j_shift else None)] += (
-                1 - loc_bad_bin_mask[i_shift : (-j_shift if j_shift else None)]
+    is_good = ~np.asarray(bad_bin_mask, dtype=bool)
+    cum_good = np.r_[0, np.cumsum(is_good)]
+    k = np.arange(N)
+    n_rows = cum_good[k + 1] - cum_good[np.maximum(k - window + 1, 0)]
+    n_cols = cum_good[np.minimum(k + window, N)] - cum_good[k]
+    n_pixels = (n_rows * n_cols).astype(float)
+
+    for i_shift in range(0, min(window, ignore_diags)):
+        for j_shift in range(0, min(window, ignore_diags - i_shift)):
+            n_pixels[i_shift : N - j_shift] -= (
+                is_good[: N - j_shift - i_shift] & is_good[i_shift + j_shift :]
             )
     return n_pixels
 
 
+def _add_to_diamonds(delta, i, j, values, window, ignore_diags):
+    """
+    Add pixels (i, j) to the sums over diamonds, that are kept as a
+    difference array 'delta' of N + 1 elements, the sums are its prefix sum.
+    A pixel is in the diamonds of bins [max(i, j - window + 1),
+    min(i + window - 1, j)], i.e. it is added at the first of them and
+    subtracted after the last one, independent of the window size.
+    Pixels are counted, when 'values' is None.
+    """
+    sel = (j - i >= ignore_diags) & (j - i <= (window - 1) * 2)
+    i, j = i[sel], j[sel]
+    values = None if values is None else values[sel]
+    first = np.maximum(i, j - window + 1)
+    last = np.minimum(i + window - 1, j)
+    delta += np.bincount(first, values, minlength=len(delta))
+    delta -= np.bincount(last + 1, values, minlength=len(delta))
+
+
 def insul_diamond(pixel_query, bins, window=10, ignore_diags=2, norm_by_median=True):
     """
     Calculates the insulation score of a Hi-C interaction matrix.
@@ -48,7 +64,8 @@ def insul_diamond(pixel_query, bins, window=10, ignore_diags=2, norm_by_median=T
     ----------
     pixel_query : RangeQuery object <TODO:update description>
         A table of Hi-C interactions. Must follow the Cooler columnar format:
-        bin1_id, bin2_id, count, balanced (optional)).
+        bin1_id, bin2_id, count, balanced (optional)). Alternatively, a
+        BandMatrix of the balanced map of the region of `bins`.
     bins : pandas.DataFrame
         A table of bins, is used to determine the span of the matrix
         and the locations of bad bins.
@@ -63,49 +80,120 @@ def insul_diamond(pixel_query, bins, window=10, ignore_diags=2, norm_by_median=T
     norm_by_median : bool
         If True, normalize the insulation score by its NaN-median.
     """
+    return insul_diamonds(
+        pixel_query,
+        bins,
+        windows=[window],
+        ignore_diags=ignore_diags,
+        norm_by_median=norm_by_median,
+    )[0]
+
+
+def insul_diamonds(
+    pixel_query, bins, windows=(10,), ignore_diags=2, norm_by_median=True
+):
+    """
+    Calculates the insulation scores of a Hi-C interaction matrix for
+    several window sizes, reading the pixels only once.
+
+    Parameters
+    ----------
+    pixel_query : RangeQuery object or BandMatrix
+        A query of Hi-C interactions, see `insul_diamond`. A BandMatrix of
+        the balanced map is summed up diagonal by diagonal, with the raw
+        counts unknown, i.e. sum_counts are NaN.
+    bins : pandas.DataFrame
+        A table of bins, is used to determine the span of the matrix
+        and the locations of bad bins.
+    windows : list of int
+        The widths (in bins) of the diamond windows.
+    ignore_diags : int
+        The number of diagonals to ignore, see `insul_diamond`.
+    norm_by_median : bool
+        If True, normalize the insulation scores by their NaN-medians.
+
+    Returns
+    -------
+    A list of (score, n_pixels, sum_balanced, sum_counts) tuples, one per
+    window, in the order of `windows`.
+    """
     lo_bin_id = bins.index.min()
     hi_bin_id = bins.index.max() + 1
     N = hi_bin_id - lo_bin_id
-    sum_counts = np.zeros(N)
-    sum_balanced = np.zeros(N)
-
-    n_pixels = get_n_pixels(
-        bins.weight.isnull().values, window=window, ignore_diags=ignore_diags
-    )
+    delta_counts = np.zeros((len(windows), N + 1))
+    delta_balanced = np.zeros((len(windows), N + 1))
+    delta_valid = np.zeros((len(windows), N + 1), dtype=np.int64)
+    weights = bins["weight"].values
+    max_diag = (max(windows) - 1) * 2
+
+    if isinstance(pixel_query, BandMatrix):
+        if pixel_query.shape[0] != N:
+            raise ValueError("The band does not match the bins")
+        results = []
+        for window in windows:
+            sum_balanced, n_valid = pixel_query.diamond_sums(window, ignore_diags)
+            sum_counts = np.full(N, np.nan)
+            results.append(
+                _insul_from_sums(
+                    bins,
+                    window,
+                    ignore_diags,
+                    norm_by_median,
+                    sum_counts,
+                    sum_balanced,
+                    n_valid,
+                )
+            )
+        return results
 
     for chunk_dict in pixel_query.read_chunked():
-        chunk = pd.DataFrame(chunk_dict, columns=["bin1_id", "bin2_id", "count"])
-        diag_pixels = chunk[chunk.bin2_id - chunk.bin1_id <= (window - 1) * 2]
+        i = chunk_dict["bin1_id"] - lo_bin_id
+        j = chunk_dict["bin2_id"] - lo_bin_id
+        # keep the band of the largest window only:
+        in_band = (j - i >= ignore_diags) & (j - i <= max_diag)
+        i, j = i[in_band], j[in_band]
+        counts = chunk_dict["count"][in_band].astype(float)
+
+        balanced = counts * weights[i] * weights[j]
+        valid_pixel_mask = ~np.isnan(balanced)
+        i_valid, j_valid = i[valid_pixel_mask], j[valid_pixel_mask]
+        balanced = balanced[valid_pixel_mask]
+
+        for k, window in enumerate(windows):
+            _add_to_diamonds(delta_counts[k], i, j, counts, window, ignore_diags)
+            _add_to_diamonds(
+                delta_balanced[k], i_valid, j_valid, balanced, window, ignore_diags
+            )
+            _add_to_diamonds(
+                delta_valid[k], i_valid, j_valid, None, window, ignore_diags
+            )
 
-        diag_pixels = cooler.annotate(diag_pixels, bins[["weight"]])
-        diag_pixels["balanced"] = (
-            diag_pixels["count"] * diag_pixels["weight1"] * diag_pixels["weight2"]
+    return [
+        _insul_from_sums(
+            bins,
+            window,
+            ignore_diags,
+            norm_by_median,
+            np.cumsum(delta_counts[k])[:N],
+            np.cumsum(delta_balanced[k])[:N],
+            np.cumsum(delta_valid[k])[:N],
         )
-        valid_pixel_mask = ~diag_pixels["balanced"].isnull().values
-
-        i = diag_pixels.bin1_id.values - lo_bin_id
-        j = diag_pixels.bin2_id.values - lo_bin_id
-
-        for i_shift in range(0, window):
-            for j_shift in range(0, window):
-                if i_shift + j_shift < ignore_diags:
-                    continue
-
-                mask = (
-                    (i + i_shift == j - j_shift)
-                    & (i + i_shift < N)
-                    & (j - j_shift >= 0)
-                )
+        for k, window in enumerate(windows)
+    ]
 
-                sum_counts += np.bincount(
-                    i[mask] + i_shift, diag_pixels["count"].values[mask], minlength=N
-                )
 
-                sum_balanced += np.bincount(
-                    i[mask & valid_pixel_mask] + i_shift,
-                    diag_pixels["balanced"].values[mask & valid_pixel_mask],
-                    minlength=N,
-                )
+def _insul_from_sums(
+    bins, window, ignore_diags, norm_by_median, sum_counts, sum_balanced, n_valid
+):
+    """
+    The (score, n_pixels, sum_balanced, sum_counts) tuple of a window from
+    the sums over its diamonds and the numbers of valid pixels in them.
+    """
+    n_pixels = get_n_pixels(
+        bins.weight.isnull().values, window=window, ignore_diags=ignore_diags
+    )
+    # exact zeros for diamonds without valid pixels, despite rounding errors:
+    sum_balanced = np.where(n_valid == 0, 0.0, sum_balanced)
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -126,6 +214,7 @@ def calculate_insulation_score(
     append_raw_scores=False,
     chunksize=20000000,
     verbose=False,
+    map=map,
 ):
     """Calculate the diamond insulation scores and call insulating boundaries.
 
@@ -145,6 +234,10 @@ def calculate_insulation_score(
         to the output table.
     verbose : bool
         If True, report real-time progress.
+    map : callable
+        Map functor implementation, e.g. the `imap_unordered` of a process
+        pool. Chromosomes are processed independently, each by a worker
+        opening the cooler by itself.
 
     Returns
     -------
@@ -154,7 +247,124 @@ def calculate_insulation_score(
     """
     if chromosomes is None:
         chromosomes = clr.chromnames
+    window_bp, ignore_diags = _check_insulation_params(clr, window_bp, ignore_diags)
+
+    # largest chromosomes first, to balance the load of the workers:
+    chromosomes = sorted(chromosomes, key=lambda chrom: -clr.chromsizes[chrom])
+    job = partial(
+        _insulation_chrom,
+        clr.uri,
+        window_bp,
+        ignore_diags,
+        append_raw_scores,
+        chunksize,
+        verbose,
+    )
+    ins_chrom_tables = dict(map(job, chromosomes))
 
+    # genome order of the chromosomes:
+    chromosomes = [chrom for chrom in clr.chromnames if chrom in ins_chrom_tables]
+    ins_table = pd.concat([ins_chrom_tables[chrom] for chrom in chromosomes])
+    return ins_table
+
+
+def iter_insulation_boundaries(
+    clr,
+    window_bp,
+    ignore_diags=None,
+    chromosomes=None,
+    append_raw_scores=False,
+    min_frac_valid_pixels=0.66,
+    min_dist_bad_bin=0,
+    chunksize=20000000,
+    verbose=False,
+    map=map,
+):
+    """
+    Calculate the diamond insulation scores and call insulating boundaries
+    chromosome by chromosome, holding only a few chromosomes in memory.
+
+    Parameters
+    ----------
+    clr : cooler.Cooler
+        A cooler with balanced Hi-C data.
+    window_bp : int or list
+        The size(s) of the sliding diamond window, see
+        `calculate_insulation_score`.
+    ignore_diags : int
+        The number of diagonals to ignore. If None, equals the number of
+        diagonals ignored during IC balancing.
+    chromosomes : list of str
+        The chromosomes to process, all of them by default.
+    append_raw_scores : bool
+        If True, append columns with raw scores (sum_counts, sum_balanced,
+        n_pixels) to the output tables.
+    min_frac_valid_pixels, min_dist_bad_bin
+        Parameters of boundary calling, see `find_boundaries`. The minimal
+        number of valid pixels is relative to the genome-wide maximum, as in
+        `find_boundaries` of a genome-wide table.
+    map : callable
+        Map functor implementation, e.g. the `imap_unordered` of a process
+        pool. Chromosomes are submitted largest first, and the tables that
+        are done ahead of their turn are held until they can be yielded.
+
+    Yields
+    ------
+    ins_chrom : pandas.DataFrame
+        The tables of the insulation scores and boundary strengths of the
+        chromosomes, in genome order.
+    """
+    if chromosomes is None:
+        chromosomes = clr.chromnames
+    chromosomes = set(chromosomes)
+    chromosomes = [chrom for chrom in clr.chromnames if chrom in chromosomes]
+    window_bp, ignore_diags = _check_insulation_params(clr, window_bp, ignore_diags)
+
+    # the genome-wide maximal numbers of valid pixels are known from the
+    # bad bins alone, i.e. without the scores of the other chromosomes:
+    min_valid_pixels = {}
+    for win in window_bp:
+        max_valid_pixels = max(
+            get_n_pixels(
+                clr.bins().fetch(chrom)["weight"].isnull().values,
+                window=win // clr.binsize,
+                ignore_diags=ignore_diags,
+            ).max()
+            for chrom in chromosomes
+        )
+        min_valid_pixels[win] = max_valid_pixels * min_frac_valid_pixels
+
+    job = partial(
+        _insulation_chrom,
+        clr.uri,
+        window_bp,
+        ignore_diags,
+        append_raw_scores,
+        chunksize,
+        verbose,
+    )
+    # largest chromosomes first, to balance the load of the workers, and
+    # tables that are done ahead of their turn wait in a buffer:
+    submitted = sorted(chromosomes, key=lambda chrom: -clr.chromsizes[chrom])
+    pending = {}
+    chroms = iter(chromosomes)
+    next_chrom = next(chroms, None)
+    for chrom, ins_chrom in map(job, submitted):
+        pending[chrom] = ins_chrom
+        while next_chrom in pending:
+            yield find_boundaries(
+                pending.pop(next_chrom),
+                min_dist_bad_bin=min_dist_bad_bin,
+                min_valid_pixels=min_valid_pixels,
+            )
+            next_chrom = next(chroms, None)
+
+
+def _check_insulation_params(clr, window_bp, ignore_diags):
+    """
+    Check the window sizes and default ignore_diags to the number of
+    diagonals ignored during IC balancing.
+    """
     bin_size = clr.info["bin-size"]
     ignore_diags = (
         ignore_diags
@@ -165,7 +375,6 @@ def calculate_insulation_score(
     if isinstance(window_bp, int):
         window_bp = [window_bp]
     window_bp = np.array(window_bp)
-    window_bins = window_bp // bin_size
 
     bad_win_sizes = window_bp % bin_size != 0
     if np.any(bad_win_sizes):
@@ -174,6 +383,21 @@ def calculate_insulation_score(
                 window_bp[bad_win_sizes], bin_size
             )
         )
+    return window_bp, ignore_diags
+
+
+def _insulation_chrom(
+    cool_uri, window_bp, ignore_diags, append_raw_scores, chunksize, verbose, chrom
+):
+    """
+    Calculate the insulation scores of a single chromosome, opening the
+    cooler in the process that does the work. Returns a (chrom, table) pair.
+    """
+    if verbose:
+        logging.info("Processing {}".format(chrom))
+
+    clr = cooler.Cooler(cool_uri)
+    window_bins = window_bp // clr.info["bin-size"]
 
     # XXX -- Use a delayed query executor
     nbins = len(clr.bins())
@@ -181,42 +405,36 @@ def calculate_insulation_score(
         clr.open("r"), shape=(nbins, nbins), field="count", chunksize=chunksize
     )
 
-    ins_chrom_tables = []
-    for chrom in chromosomes:
-        if verbose:
-            logging.info("Processing {}".format(chrom))
-
-        chrom_bins = clr.bins().fetch(chrom)
-        ins_chrom = chrom_bins[["chrom", "start", "end"]].copy()
-        ins_chrom["is_bad_bin"] = chrom_bins["weight"].isnull()
-
-        # XXX --- Create a delayed selection
-        c0, c1 = clr.extent(chrom)
-        chrom_query = selector[c0:c1, c0:c1]
-
-        for j, win_bin in enumerate(window_bins):
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", RuntimeWarning)
-                # XXX -- updated insul_diamond
-                ins_track, n_pixels, sum_balanced, sum_counts = insul_diamond(
-                    chrom_query, chrom_bins, window=win_bin, ignore_diags=ignore_diags
-                )
-                ins_track[ins_track == 0] = np.nan
-                ins_track = np.log2(ins_track)
+    chrom_bins = clr.bins().fetch(chrom)
+    ins_chrom = chrom_bins[["chrom", "start", "end"]].copy()
+    ins_chrom["is_bad_bin"] = chrom_bins["weight"].isnull()
 
-            ins_track[~np.isfinite(ins_track)] = np.nan
+    # XXX --- Create a delayed selection
+    # only the band of the largest diamond is read:
+    c0, c1 = clr.extent(chrom)
+    chrom_query = selector.band(c0, c1, max_diag=(max(window_bins) - 1) * 2 + 1)
 
-            ins_chrom["log2_insulation_score_{}".format(window_bp[j])] = ins_track
-            ins_chrom["n_valid_pixels_{}".format(window_bp[j])] = n_pixels
+    # all the windows from a single pass over the pixels of the chromosome:
+    diamonds = insul_diamonds(
+        chrom_query, chrom_bins, windows=window_bins, ignore_diags=ignore_diags
+    )
 
-            if append_raw_scores:
-                ins_chrom["sum_counts_{}".format(window_bp[j])] = sum_counts
-                ins_chrom["sum_balanced_{}".format(window_bp[j])] = sum_balanced
+    for j, (ins_track, n_pixels, sum_balanced, sum_counts) in enumerate(diamonds):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            ins_track[ins_track == 0] = np.nan
+            ins_track = np.log2(ins_track)
 
-        ins_chrom_tables.append(ins_chrom)
+        ins_track[~np.isfinite(ins_track)] = np.nan
 
-    ins_table = pd.concat(ins_chrom_tables)
-    return ins_table
+        ins_chrom["log2_insulation_score_{}".format(window_bp[j])] = ins_track
+        ins_chrom["n_valid_pixels_{}".format(window_bp[j])] = n_pixels
+
+        if append_raw_scores:
+            ins_chrom["sum_counts_{}".format(window_bp[j])] = sum_counts
+            ins_chrom["sum_balanced_{}".format(window_bp[j])] = sum_balanced
+
+    return chrom, ins_chrom
 
 
 def find_boundaries(
@@ -226,6 +444,7 @@ def find_boundaries(
     log2_ins_key="log2_insulation_score_{WINDOW}",
     n_valid_pixels_key="n_valid_pixels_{WINDOW}",
     is_bad_bin_key="is_bad_bin",
+    min_valid_pixels=None,
 ):
     """Call insulating boundaries.
 
@@ -249,6 +468,14 @@ def find_boundaries(
         the number of valid pixels per diamond. When a template
         containing `{WINDOW}` is provided, the calculation is repeated
         for all pairs of columns matching the template.
+    is_bad_bin_key : str
+        The name of the column containing the mask of bad bins, required
+        when `min_dist_bad_bin` is non-zero.
+    min_valid_pixels : dict, optional
+        The minimal numbers of valid pixels per diamond, keyed by window
+        (or None without a template), instead of `min_frac_valid_pixels`
+        of the maxima in `ins_table`. Used to call boundaries of a single
+        chromosome with the genome-wide thresholds.
 
     Returns
     -------
@@ -256,14 +483,83 @@ def find_boundaries(
         A bin table with appended columns with boundary prominences.
     """
 
-    if min_dist_bad_bin:
-        ins_table = pd.concat(
-            [
-                df.assign(dist_bad_bin=numutils.dist_to_mask(df.is_bad_bin))
-                for chrom, df in ins_table.groupby("chrom")
-            ]
-        )
+    windows = _template_windows(ins_table, log2_ins_key)
+    if min_valid_pixels is None:
+        min_valid_pixels = {
+            win: ins_table[n_valid_pixels_key.format(WINDOW=win)].max()
+            * min_frac_valid_pixels
+            for win in windows
+        }
+
+    return _boundary_strengths(
+        ins_table,
+        windows,
+        [min_valid_pixels],
+        min_dist_bad_bin,
+        log2_ins_key,
+        n_valid_pixels_key,
+        is_bad_bin_key,
+    )[0]
+
+
+def sweep_boundaries(
+    ins_table,
+    min_frac_valid_pixels=(0.5, 0.66, 0.8),
+    min_dist_bad_bin=0,
+    log2_ins_key="log2_insulation_score_{WINDOW}",
+    n_valid_pixels_key="n_valid_pixels_{WINDOW}",
+    is_bad_bin_key="is_bad_bin",
+):
+    """Call insulating boundaries at several thresholds of valid pixels.
+
+    The prominences of all windows and all thresholds of a chromosome are
+    calculated in a single call of a compiled kernel. Thresholds of the
+    boundary strength need no recalculation at all: the boundaries at any
+    of them are the bins with `boundary_strength_{WINDOW}` above it.
+
+    Parameters
+    ----------
+    ins_table : pandas.DataFrame
+        A bin table with columns containing log2(insulation score),
+        the number of valid pixels per diamond and (optionally) the mask
+        of bad bins.
+    min_frac_valid_pixels : list of float
+        The minimal fractions of valid pixels in a diamond to be used in
+        boundary picking and prominence calculation.
+    min_dist_bad_bin, log2_ins_key, n_valid_pixels_key, is_bad_bin_key
+        See `find_boundaries`.
+
+    Returns
+    -------
+    ins_tables : dict
+        The outputs of `find_boundaries`, keyed by min_frac_valid_pixels.
+    """
+    windows = _template_windows(ins_table, log2_ins_key)
+    thresholds = [
+        {
+            win: ins_table[n_valid_pixels_key.format(WINDOW=win)].max() * frac
+            for win in windows
+        }
+        for frac in min_frac_valid_pixels
+    ]
+
+    ins_tables = _boundary_strengths(
+        ins_table,
+        windows,
+        thresholds,
+        min_dist_bad_bin,
+        log2_ins_key,
+        n_valid_pixels_key,
+        is_bad_bin_key,
+    )
+    return dict(zip(min_frac_valid_pixels, ins_tables))
+
 
+def _template_windows(ins_table, log2_ins_key):
+    """
+    The windows of the columns matching a template with `{WINDOW}`, or
+    None for a single column.
+    """
     if "{WINDOW}" in log2_ins_key:
         windows = set()
         for col in ins_table.columns:
@@ -272,40 +568,64 @@ def find_boundaries(
                 windows.add(int(m.groups()[0]))
     else:
         windows = set([None])
+    return list(windows)
+
 
-    min_valid_pixels = {
-        win: ins_table[n_valid_pixels_key.format(WINDOW=win)].max()
-        * min_frac_valid_pixels
-        for win in windows
-    }
+def _boundary_strengths(
+    ins_table,
+    windows,
+    thresholds,
+    min_dist_bad_bin,
+    log2_ins_key,
+    n_valid_pixels_key,
+    is_bad_bin_key,
+):
+    """
+    Boundary strengths of all windows for every dict of the minimal numbers
+    of valid pixels in `thresholds`, returns a table per dict.
+    """
+    if min_dist_bad_bin:
+        ins_table = pd.concat(
+            [
+                df.assign(dist_bad_bin=numutils.dist_to_mask(df[is_bad_bin_key]))
+                for chrom, df in ins_table.groupby("chrom")
+            ]
+        )
 
-    dfs = []
+    dfs = [[] for _ in thresholds]
     for chrom, df in ins_table.groupby("chrom"):
         df = df.reset_index(drop=True)
-        for win in windows:
-            mask = (
-                df[n_valid_pixels_key.format(WINDOW=win)].values
-                >= min_valid_pixels[win]
-            )
 
-            if min_dist_bad_bin:
-                mask &= df.dist_bad_bin.values >= min_dist_bad_bin
+        # masked bins are NaNs, which the prominence kernel skips, same as
+        # dropping these bins from the track:
+        tracks = []
+        for min_valid_pixels in thresholds:
+            for win in windows:
+                mask = (
+                    df[n_valid_pixels_key.format(WINDOW=win)].values
+                    >= min_valid_pixels[win]
+                )
 
-            ins_track = df[log2_ins_key.format(WINDOW=win)].values[mask]
-            poss, proms = peaks.find_peak_prominence(-ins_track)
-            ins_prom_track = np.zeros_like(ins_track) * np.nan
-            ins_prom_track[poss] = proms
+                if min_dist_bad_bin:
+                    mask &= df.dist_bad_bin.values >= min_dist_bad_bin
 
-            if win is not None:
-                bs_key = "boundary_strength_{win}".format(win=win)
-            else:
-                bs_key = "boundary_strength"
+                ins_track = df[log2_ins_key.format(WINDOW=win)].values
+                tracks.append(np.where(mask, -ins_track, np.nan))
+
+        proms = peaks.find_peak_prominence_2d(np.array(tracks))
+        proms = proms.reshape(len(thresholds), len(windows), len(df))
 
-            df[bs_key] = np.nan
-            df.loc[mask, bs_key] = ins_prom_track
+        for k in range(len(thresholds)):
+            df_k = df.copy() if len(thresholds) > 1 else df
+            for w, win in enumerate(windows):
+                if win is not None:
+                    bs_key = "boundary_strength_{win}".format(win=win)
+                else:
+                    bs_key = "boundary_strength"
+                df_k[bs_key] = proms[k, w]
+            dfs[k].append(df_k)
 
-        dfs.append(df)
-    return pd.concat(dfs)
+    return [pd.concat(dfs_k) for dfs_k in dfs]
 
 
 def _insul_diamond_dense(mat, window=10, ignore_diags=2, norm_by_median=True):
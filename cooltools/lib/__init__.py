@@ -1 +1,2 @@
 from .common import *
+from .band import BandMatrix
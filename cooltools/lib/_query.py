@@ -1,4 +1,7 @@
 from collections import defaultdict
+import queue
+import threading
+import time
 import numpy as np
 import pandas as pd
 
@@ -27,6 +30,7 @@ class CSRSelector(_IndexingMixin):
     -------
     >>> selector = CSRSelector(h5, (100, 100), 'count', 10000)
     >>> query = selector[lo1:hi1, lo2:hi2]
+    >>> band_query = selector.band(lo, hi, max_diag)
 
     """
 
@@ -66,10 +70,6 @@ class CSRSelector(_IndexingMixin):
         # let's take the downsampled subset of pixel id offsets [o0, ...., o1]
         # each successive pair corresponds to a "piece" of the query
         def getchunk(chunk_id, include_index=False):
-            out = {"bin1_id": [], "bin2_id": [], field: []}
-            if include_index:
-                out["__index"] = []
-
             # extract a chunk of on-disk rows
             oi, of = loc_pruned_offsets[chunk_id], loc_pruned_offsets[chunk_id + 1]
             p0, p1 = offsets[oi], offsets[of]
@@ -77,48 +77,122 @@ class CSRSelector(_IndexingMixin):
 
             bin2_extracted = bin2_selector[slc]
             data_extracted = data_selector[slc]
+
+            # row of every pixel, expanded from the lengths of the rows
+            rows = np.repeat(
+                np.arange(i0 + oi, i0 + of, dtype=bin1_selector.dtype),
+                np.diff(offsets[oi : of + 1]),
+            )
+
+            # filter all of the rows for the range of j values we want at once
+            mask = (bin2_extracted >= j0) & (bin2_extracted < j1)
+
+            out = {
+                "bin1_id": rows[mask],
+                "bin2_id": bin2_extracted[mask],
+                field: data_extracted[mask],
+            }
             if include_index:
-                ind_extracted = np.arange(slc.start, slc.stop)
-
-            # go row by row and filter
-            for i in range(oi, of):
-                # correct the offsets
-                lo = offsets[i] - p0
-                hi = offsets[i + 1] - p0
-
-                # this row
-                bin2 = bin2_extracted[lo:hi]
-
-                # filter for the range of j values we want
-                mask = (bin2 >= j0) & (bin2 < j1)
-                cols = bin2[mask]
-
-                # apply same mask for data
-                data = data_extracted[lo:hi][mask]
-
-                # shortcut for row data
-                rows = np.full(len(cols), i0 + i, dtype=bin1_selector.dtype)
-
-                out["bin1_id"].append(rows)
-                out["bin2_id"].append(cols)
-                out[field].append(data)
-                if include_index:
-                    out["__index"].append(ind_extracted[lo:hi][mask])
-
-            if len(out):
-                for k in out.keys():
-                    out[k] = np.concatenate(out[k], axis=0)
-            else:
-                out["bin1_id"] = np.array([], dtype=bin1_selector.dtype)
-                out["bin2_id"] = np.array([], dtype=bin2_selector.dtype)
-                out[field] = np.array([], dtype=data_selector.dtype)
-                if include_index:
-                    out["__index"] = np.array([], dtype=np.int64)
+                out["__index"] = np.arange(p0, p1)[mask]
 
             return out
 
         return getchunk, loc_pruned_offsets
 
+    def _make_getchunk_band(self, lo, hi, max_diag, max_gap):
+        # Factory for function that executes any piece of a query of the
+        # pixels of [lo, hi) x [lo, hi) with bin2 - bin1 < max_diag.
+
+        bin1_selector = self.bin1_selector
+        bin2_selector = self.bin2_selector
+        data_selector = self.data_selector
+        field = self.field
+
+        if (hi - lo < 1) or (max_diag < 1):
+            return None, []
+
+        # bin2 is sorted and unique within a row and starts at bin1 or
+        # later, so the pixels in the band are among the first max_diag
+        # pixels of the row, whatever the rest of the row is
+        offsets = self.offset_selector[lo : hi + 1]
+        starts = offsets[:-1]
+        ends = np.minimum(offsets[1:], starts + max_diag)
+
+        # coalesce the reads of successive rows separated by small gaps,
+        # each "piece" is a contiguous read of the pixels of a few rows,
+        # spanning about chunksize pixels at most
+        breaks = np.union1d(
+            np.flatnonzero(starts[1:] - ends[:-1] > max_gap) + 1,
+            arg_prune_partition(starts, self.chunksize)[1:-1],
+        )
+        piece_rows = np.r_[0, breaks, len(starts)]
+        piece_starts = starts[piece_rows[:-1]]
+        piece_ends = ends[piece_rows[1:] - 1]
+
+        # group the pieces to read about chunksize pixels at a time
+        loc_pruned_pieces = arg_prune_partition(
+            np.r_[0, np.cumsum(piece_ends - piece_starts)], self.chunksize
+        )
+
+        def getchunk(chunk_id, include_index=False):
+            pi, pf = loc_pruned_pieces[chunk_id], loc_pruned_pieces[chunk_id + 1]
+            slcs = [
+                slice(p0, p1) for p0, p1 in zip(piece_starts[pi:pf], piece_ends[pi:pf])
+            ]
+            bin2_extracted = np.concatenate([bin2_selector[slc] for slc in slcs])
+            data_extracted = np.concatenate([data_selector[slc] for slc in slcs])
+
+            # the first max_diag pixels of every row of the pieces, skipping
+            # the gaps that were read only to coalesce the reads
+            r0, r1 = piece_rows[pi], piece_rows[pf]
+            lengths = ends[r0:r1] - starts[r0:r1]
+            piece_shifts = np.cumsum(np.r_[0, piece_ends[pi:pf] - piece_starts[pi:pf]])
+            piece_shifts = piece_shifts[:-1] - piece_starts[pi:pf]
+            row_shifts = np.repeat(piece_shifts, np.diff(piece_rows[pi : pf + 1]))
+            within_row = np.arange(lengths.sum()) - np.repeat(
+                np.cumsum(lengths) - lengths, lengths
+            )
+            ind = np.repeat(starts[r0:r1], lengths) + within_row
+            loc = ind + np.repeat(row_shifts, lengths)
+
+            rows = np.repeat(
+                np.arange(lo + r0, lo + r1, dtype=bin1_selector.dtype), lengths
+            )
+            bin2 = bin2_extracted[loc]
+            mask = (bin2 - rows < max_diag) & (bin2 < hi)
+
+            out = {
+                "bin1_id": rows[mask],
+                "bin2_id": bin2[mask],
+                field: data_extracted[loc][mask],
+            }
+            if include_index:
+                out["__index"] = ind[mask]
+
+            return out
+
+        return getchunk, loc_pruned_pieces
+
+    def band(self, lo, hi, max_diag, max_gap=None):
+        """
+        Query of the pixels of the square [lo, hi) x [lo, hi) near the main
+        diagonal, i.e. with bin2 - bin1 < max_diag.
+
+        Only the first max_diag pixels of every row are read from disk,
+        reads of neighbouring rows separated by fewer than max_gap pixels
+        are coalesced. By default, max_gap is the length of the HDF5 chunks
+        of the pixels, as these are decompressed in whole anyway.
+
+        """
+        if max_gap is None:
+            max_gap = (self.bin2_selector.chunks or (self.chunksize,))[0]
+        getchunk, loc_pruned_pieces = self._make_getchunk_band(
+            lo, hi, max_diag, max_gap
+        )
+        return RangeQuery(
+            self, (lo, hi), (lo, hi), self.field, getchunk, loc_pruned_pieces
+        )
+
     def __getitem__(self, key):
         s1, s2 = self._unpack_index(key)
         ispan = self._process_slice(s1, self.shape[0])
@@ -141,6 +215,15 @@ class RangeQuery(object):
         self.n_chunks = len(loc_pruned_offsets) - 1
         self._locs = loc_pruned_offsets
         self._getchunk = getchunk
+        # seconds spent reading chunks, and blocked waiting for them
+        self.read_time = 0.0
+        self.wait_time = 0.0
+
+    def _timed_getchunk(self, i, include_index):
+        t0 = time.perf_counter()
+        chunk = self._getchunk(i, include_index)
+        self.read_time += time.perf_counter() - t0
+        return chunk
 
     def read_chunk(self, i, include_index=False):
         """Read any chunk of the partitioned query as a dictionary."""
@@ -148,10 +231,63 @@ class RangeQuery(object):
             raise IndexError(i)
         return self._getchunk(i, include_index)
 
-    def read_chunked(self, include_index=False):
-        """Iterator over chunks (as dictionaries)."""
+    def read_chunked(self, include_index=False, prefetch=0):
+        """
+        Iterator over chunks (as dictionaries).
+
+        With prefetch > 0, up to `prefetch` chunks are read ahead in a
+        background thread, while the consumer works on the current chunk.
+        The time spent reading chunks is accumulated in `read_time`, and the
+        time the consumer was blocked waiting for them in `wait_time`: a
+        wait time close to the read time means that a deeper prefetch may
+        help, a wait time close to zero that the consumer is the bottleneck.
+
+        """
+        if prefetch > 0:
+            yield from self._read_chunked_prefetch(include_index, prefetch)
+            return
+
         for i in range(self.n_chunks):
-            yield self._getchunk(i, include_index)
+            t0 = time.perf_counter()
+            chunk = self._timed_getchunk(i, include_index)
+            self.wait_time += time.perf_counter() - t0
+            yield chunk
+
+    def _read_chunked_prefetch(self, include_index, prefetch):
+        chunks = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # give up, when the consumer is gone
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for i in range(self.n_chunks):
+                    if not put((self._timed_getchunk(i, include_index), None)):
+                        return
+            except Exception as e:
+                put((None, e))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            for _ in range(self.n_chunks):
+                t0 = time.perf_counter()
+                chunk, exc = chunks.get()
+                self.wait_time += time.perf_counter() - t0
+                if exc is not None:
+                    raise exc
+                yield chunk
+        finally:
+            stop.set()
+            producer.join()
 
     def read(self, include_index=False):
         """Read the complete range query as a dictionary"""
@@ -0,0 +1,209 @@
+import numpy as np
+
+from ._query import CSRSelector
+
+
+class BandMatrix(object):
+    """
+    The diagonals 0..k of a symmetric matrix, e.g. of the Hi-C map of a
+    chromosome, stored as a (k + 1, N) array: the element (d, i) of the
+    array is the element (i, i + d) of the matrix. The elements past the
+    end of a diagonal are NaN (or 0 for integer data).
+
+    Rows and columns of bad bins are NaN in balanced data.
+
+    Example
+    -------
+    >>> band = BandMatrix.from_cooler(clr, "chr1", max_diag=20)
+    >>> band.diag(2)
+    >>> sums, n_valid = band.diamond_sums(window=10, ignore_diags=2)
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def max_diag(self):
+        return self.data.shape[0] - 1
+
+    @property
+    def shape(self):
+        return (self.data.shape[1], self.data.shape[1])
+
+    @property
+    def bad_bins(self):
+        """The mask of bins with NaN elements on the main diagonal."""
+        if np.issubdtype(self.data.dtype, np.floating):
+            return np.isnan(self.data[0])
+        return np.zeros(self.data.shape[1], dtype=bool)
+
+    @classmethod
+    def from_cooler(
+        cls,
+        clr,
+        region,
+        max_diag,
+        balance="weight",
+        dtype=None,
+        path=None,
+        chunksize=10000000,
+    ):
+        """
+        Load the band of the map of a region in one pass over its pixels.
+
+        Parameters
+        ----------
+        clr : cooler.Cooler
+            A cooler.
+        region : str
+            A UCSC-style region string or a chromosome name.
+        max_diag : int
+            The last diagonal to keep.
+        balance : str or bool
+            The name of the column of the bin table with balancing weights,
+            True for "weight", or False to keep the raw counts.
+        dtype : numpy.dtype
+            The type of the elements, float32 for balanced data and int32
+            for raw counts by default.
+        path : str, optional
+            If provided, the band is stored in a .npy file memory-mapped
+            from this path, to be reused by `BandMatrix.load`.
+        chunksize : int
+            The number of pixels to read at a time.
+
+        """
+        if balance is True:
+            balance = "weight"
+        if dtype is None:
+            dtype = np.float32 if balance else np.int32
+        lo, hi = clr.extent(region)
+        N = hi - lo
+        shape = (max_diag + 1, N)
+        if path is None:
+            data = np.zeros(shape, dtype=dtype)
+        else:
+            data = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+            data[:] = 0
+
+        nbins = len(clr.bins())
+        selector = CSRSelector(
+            clr.open("r"), shape=(nbins, nbins), field="count", chunksize=chunksize
+        )
+        if balance:
+            weights = clr.bins()[lo:hi][balance].values
+        for chunk_dict in selector.band(lo, hi, max_diag + 1).read_chunked():
+            i = chunk_dict["bin1_id"] - lo
+            j = chunk_dict["bin2_id"] - lo
+            values = chunk_dict["count"]
+            if balance:
+                values = values * weights[i] * weights[j]
+            data[j - i, i] = values
+
+        if np.issubdtype(data.dtype, np.floating):
+            # mask the rows and the columns of bad bins, and the padding:
+            bad_bins = np.flatnonzero(np.isnan(weights) if balance else [])
+            for d in range(max_diag + 1):
+                data[d, bad_bins] = np.nan
+                data[d, bad_bins[bad_bins >= d] - d] = np.nan
+                data[d, max(N - d, 0) :] = np.nan
+
+        if path is not None:
+            data.flush()
+        return cls(data)
+
+    @classmethod
+    def load(cls, path, mode="r"):
+        """
+        Memory-map a band stored by `from_cooler` with a path.
+        """
+        return cls(np.lib.format.open_memmap(path, mode=mode))
+
+    def diag(self, d):
+        """
+        The d-th diagonal of the matrix, i.e. elements (i, i + d).
+        """
+        if not 0 <= d <= self.max_diag:
+            raise IndexError(d)
+        return self.data[d, : max(self.shape[0] - d, 0)]
+
+    def row_window(self, i, window):
+        """
+        The elements (i, i - window + 1) .. (i, i + window - 1) of a row,
+        NaN outside of the matrix.
+        """
+        if window > self.max_diag + 1:
+            raise ValueError("The window is wider than the band")
+        N = self.shape[0]
+        out = np.full(2 * window - 1, np.nan)
+        for d in range(window):
+            if i + d < N:
+                out[window - 1 + d] = self.data[d, i]
+            if i - d >= 0:
+                out[window - 1 - d] = self.data[d, i - d]
+        return out
+
+    def row_window_sums(self, window, ignore_diags=0):
+        """
+        The sums of the elements of every row upstream, (i, i - d), and
+        downstream, (i, i + d), of the diagonal, for ignore_diags <= d <
+        window. NaNs are ignored.
+
+        Returns
+        -------
+        sums_up, sums_down : numpy.array
+        """
+        if window > self.max_diag + 1:
+            raise ValueError("The window is wider than the band")
+        N = self.shape[0]
+        sums_up = np.zeros(N)
+        sums_down = np.zeros(N)
+        for d in range(ignore_diags, window):
+            diag = np.nan_to_num(self.diag(d), nan=0.0)
+            sums_down[: len(diag)] += diag
+            sums_up[N - len(diag) :] += diag
+        return sums_up, sums_down
+
+    def diamond_sums(self, window, ignore_diags=0):
+        """
+        The sums and the numbers of non-NaN elements of the diamonds
+        [i - window + 1, i] x [i, i + window - 1] of every bin i, excluding
+        the diagonals < ignore_diags. Every diagonal adds a sliding sum along
+        itself, from its prefix sums.
+
+        Returns
+        -------
+        sums, n_valid : numpy.array
+        """
+        if 2 * (window - 1) > self.max_diag:
+            raise ValueError("The diamond is wider than the band")
+        N = self.shape[0]
+        sums = np.zeros(N)
+        n_valid = np.zeros(N, dtype=np.int64)
+        k = np.arange(N)
+        for d in range(ignore_diags, 2 * (window - 1) + 1):
+            diag = self.diag(d)
+            is_valid = ~np.isnan(diag)
+            cum_sums = np.r_[0, np.cumsum(np.where(is_valid, diag, 0), dtype=float)]
+            cum_valid = np.r_[0, np.cumsum(is_valid)]
+            # element (i, i + d) is in the diamonds of bins
+            # [i + max(0, d - window + 1), i + min(window - 1, d)]:
+            lo = np.clip(k - min(window - 1, d), 0, len(diag))
+            hi = np.clip(k - max(0, d - window + 1) + 1, 0, len(diag))
+            sums += cum_sums[hi] - cum_sums[lo]
+            n_valid += cum_valid[hi] - cum_valid[lo]
+        return sums, n_valid
+
+    def dense(self, lo, hi):
+        """
+        A dense square block [lo, hi) x [lo, hi) of the matrix, NaN outside
+        of the band.
+        """
+        n = hi - lo
+        out = np.full((n, n), np.nan)
+        for d in range(min(self.max_diag + 1, n)):
+            diag = self.data[d, lo : hi - d]
+            idx = np.arange(n - d)
+            out[idx, idx + d] = diag
+            out[idx + d, idx] = diag
+        return out
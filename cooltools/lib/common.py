@@ -2,6 +2,69 @@ import numpy as np
 import pandas as pd
 
 
+def assign_intervals(chroms, starts, ends, intervals):
+    """
+    Find the last of the support intervals overlapping each of the genomic
+    intervals, by a binary search among the support intervals of its
+    chromosome, in O(n log k) for n genomic and k support intervals.
+
+    Parameters
+    ----------
+    chroms, starts, ends : array-like
+        Genomic intervals. An interval overlaps a support interval, when
+        its start is before the end of the support interval and its end
+        is after the start of the support interval.
+    intervals : list of tuples
+        Support intervals (chrom, start, end, index), the end is None for
+        support intervals extending to the end of chromosome. The largest
+        of the indices of the overlapping support intervals is assigned.
+
+    Returns
+    -------
+    1D array of the assigned indices, -1 for intervals overlapping none
+    of the support intervals.
+
+    """
+    chroms = np.asarray(chroms)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    # in doubled coordinates both empty and non-empty intervals are
+    # closed ranges of integers [lo, hi]:
+    empty = ends <= starts
+    lo = np.where(empty, 2 * starts, 2 * starts + 1)
+    hi = np.where(empty, 2 * starts, 2 * ends - 1)
+
+    by_chrom = {}
+    for chrom, start, end, index in intervals:
+        end = 2**62 if end is None else 2 * end - 1
+        by_chrom.setdefault(chrom, []).append((2 * start + 1, end, index))
+
+    assigned = np.full(len(chroms), -1, dtype=np.int64)
+    positions = pd.Series(chroms).groupby(chroms, sort=False).indices
+    for chrom, sel in positions.items():
+        if chrom not in by_chrom:
+            continue
+        ilo, ihi, index = map(np.array, zip(*by_chrom[chrom]))
+        # the largest index of the support intervals covering every
+        # elementary segment [bounds[t], bounds[t + 1]) of the chromosome:
+        bounds = np.unique(np.r_[ilo, ihi + 1])
+        seg_max = np.full(len(bounds), -1, dtype=np.int64)
+        for a, b, i in zip(
+            np.searchsorted(bounds, ilo), np.searchsorted(bounds, ihi + 1), index
+        ):
+            seg_max[a:b] = np.maximum(seg_max[a:b], i)
+        # the range of segments, overlapped by every interval:
+        t_lo = np.searchsorted(bounds, lo[sel], side="right") - 1
+        t_hi = np.searchsorted(bounds, hi[sel], side="right") - 1
+        t_lo = np.maximum(t_lo, 0)
+        t_hi = np.minimum(t_hi, len(bounds) - 2)
+        valid = t_lo <= t_hi
+        # seg_max ends with -1 for the reduction over the last segment:
+        maxima = np.maximum.reduceat(seg_max, np.c_[t_lo, t_hi + 1].ravel())[::2]
+        assigned[sel[valid]] = maxima[valid]
+    return assigned
+
+
 def assign_supports(features, supports, labels=False, suffix=""):
     """
     Assign support regions to a table of genomic intervals.
@@ -15,9 +78,6 @@ def assign_supports(features, supports, labels=False, suffix=""):
         Support areas
 
     """
-    features = features.copy()
-    supp_col = pd.Series(index=features.index, data=np.nan)
-
     c = "chrom" + suffix
     s = "start" + suffix
     e = "end" + suffix
@@ -27,23 +87,19 @@ def assign_supports(features, supports, labels=False, suffix=""):
                 'Column "{}" not found in features data frame.'.format(col)
             )
 
+    intervals = []
     for i, region in enumerate(supports):
         # single-region support
         if len(region) == 3:
-            sel = (features[c] == region[0]) & (features[e] > region[1])
-            if region[2] is not None:
-                sel &= features[s] < region[2]
+            intervals.append((*region, i))
         # paired-region support
         elif len(region) == 2:
             region1, region2 = region
-            sel1 = (features[c] == region1[0]) & (features[e] > region1[1])
-            if region1[2] is not None:
-                sel1 &= features[s] < region1[2]
-            sel2 = (features[c] == region2[0]) & (features[e] > region2[1])
-            if region2[2] is not None:
-                sel2 &= features[s] < region2[2]
-            sel = sel1 | sel2
-        supp_col.loc[sel] = i
+            intervals.extend([(*region1, i), (*region2, i)])
+    assigned = assign_intervals(features[c], features[s], features[e], intervals)
+    supp_col = pd.Series(
+        index=features.index, data=np.where(assigned >= 0, assigned, np.nan)
+    )
 
     if labels:
         supp_col = supp_col.map(lambda i: supports[int(i)], na_action="ignore")
@@ -1180,6 +1180,66 @@ def zoom_array(
     return rescaled
 
 
+def _resampling_matrix(in_size, out_size):
+    # overlaps of the output bins, of in_size / out_size input bins each,
+    # with the input bins:
+    edges = np.arange(out_size + 1) * (in_size / out_size)
+    bins = np.arange(in_size)
+    overlaps = np.minimum(edges[1:, np.newaxis], bins + 1) - np.maximum(
+        edges[:-1, np.newaxis], bins
+    )
+    return np.clip(overlaps, 0, None)
+
+
+def zoom_array_stack(in_stack, final_shape, same_sum=False):
+    """Rescale a stack of 2D arrays to the same shape at once.
+
+    Unlike 'zoom_array', every output pixel is an average of the input pixels
+    it covers, weighted by the area of the overlap, which is done for the
+    whole stack by a pair of matrix products. NaNs are ignored, and output
+    pixels covering only NaNs are NaN.
+
+    Parameters
+    ----------
+    in_stack : ndarray
+        Stack of arrays of shape (n, h, w).
+    final_shape : shape tuple
+        Resulting shape of the arrays.
+    same_sum : bool, optional
+        Preserve sums of the arrays, rather than values. By default, values
+        are preserved.
+
+    Returns
+    -------
+    rescaled : ndarray
+        Stack of rescaled arrays of shape (n,) + final_shape.
+
+    """
+    in_stack = np.asarray(in_stack, dtype=np.double)
+    n, h, w = in_stack.shape
+    out_h, out_w = final_shape
+    # every input bin overlaps at most a couple of output bins when
+    # coarsening, so the products are sparse:
+    rows = scipy.sparse.csr_matrix(_resampling_matrix(h, out_h))
+    cols = scipy.sparse.csr_matrix(_resampling_matrix(w, out_w))
+
+    def _resample(stack):
+        # both products over the whole stack as single matrix products:
+        stack = cols @ stack.reshape(n * h, w).T
+        stack = stack.reshape(out_w, n, h).transpose(2, 1, 0).reshape(h, -1)
+        stack = rows @ stack
+        return stack.reshape(out_h, n, out_w).transpose(1, 0, 2)
+
+    finite = np.isfinite(in_stack)
+    total = _resample(np.where(finite, in_stack, 0))
+    weights = _resample(finite.astype(np.double))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rescaled = total / weights
+    if same_sum:
+        rescaled *= (h / final_shape[0]) * (w / final_shape[1])
+    return rescaled
+
+
 def adaptive_coarsegrain(ar, countar, cutoff=5, max_levels=8, min_shape=8):
     """
     Adaptively coarsegrain a Hi-C matrix based on local neighborhood pooling
@@ -2,6 +2,7 @@
 #
 import warnings
 import numpy as np
+import numba
 
 
 def find_peak_prominence(arr, max_dist=None):
@@ -125,6 +126,149 @@ def find_peak_prominence(arr, max_dist=None):
     return loc_max_poss, max_proms
 
 
+@numba.njit
+def _range_min_table(arr):
+    """
+    Sparse table of the minima of the ranges of 2 ** k elements of arr,
+    NaNs are ignored as +inf.
+    """
+    n = len(arr)
+    n_levels = 1
+    while (1 << n_levels) <= n:
+        n_levels += 1
+    table = np.empty((n_levels, n))
+    for i in range(n):
+        table[0, i] = np.inf if np.isnan(arr[i]) else arr[i]
+    for k in range(1, n_levels):
+        half = 1 << (k - 1)
+        for i in range(n - (1 << k) + 1):
+            table[k, i] = min(table[k - 1, i], table[k - 1, i + half])
+    return table
+
+
+@numba.njit
+def _range_nanmin(table, lo, hi):
+    """
+    The NaN-minimum of arr[lo:hi] from its sparse table, NaN if all-NaN.
+    """
+    k = 0
+    while (1 << (k + 1)) <= hi - lo:
+        k += 1
+    val = min(table[k, lo], table[k, hi - (1 << k)])
+    return np.nan if val == np.inf else val
+
+
+@numba.njit
+def _find_peak_prominence_1d(arr, max_dist, out):
+    n = len(arr)
+    table = _range_min_table(arr)
+
+    # local minima and maxima among the non-NaN elements:
+    nonans = np.flatnonzero(~np.isnan(arr))
+    is_loc_max = np.zeros(n, dtype=np.bool_)
+    is_loc_min = np.zeros(n, dtype=np.bool_)
+    for k in range(1, len(nonans) - 1):
+        prev, cur, next_ = arr[nonans[k - 1]], arr[nonans[k]], arr[nonans[k + 1]]
+        is_loc_max[nonans[k]] = (cur > prev) and (cur > next_)
+        is_loc_min[nonans[k]] = (cur < prev) and (cur < next_)
+
+    # the adjacent higher elements on the left and on the right, or the
+    # positions max_dist away, from monotonic stacks:
+    left_maxs = -np.ones(n, dtype=np.int64)
+    right_maxs = -np.ones(n, dtype=np.int64)
+    stack = np.empty(n, dtype=np.int64)
+    top = 0
+    for i in nonans:
+        while top > 0 and arr[stack[top - 1]] <= arr[i]:
+            top -= 1
+        if is_loc_max[i]:
+            left = max(stack[top - 1] if top > 0 else -1, i - max_dist - 1)
+            left_maxs[i] = left if left >= 0 else -1
+        stack[top] = i
+        top += 1
+    top = 0
+    for i in nonans[::-1]:
+        while top > 0 and arr[stack[top - 1]] <= arr[i]:
+            top -= 1
+        if is_loc_max[i]:
+            right = min(stack[top - 1] if top > 0 else n, i + max_dist + 1)
+            right_maxs[i] = right if right < n else -1
+        stack[top] = i
+        top += 1
+
+    # the prominence with respect to the lowest point between the peak and
+    # the adjacent higher elements:
+    global_max_pos = -1
+    for pos in nonans:
+        if not is_loc_max[pos]:
+            continue
+        left, right = left_maxs[pos], right_maxs[pos]
+        left_prom = np.nan
+        if left >= 0:
+            left_prom = arr[pos] - _range_nanmin(table, left, pos)
+        right_prom = np.nan
+        if right >= 0:
+            right_prom = arr[pos] - _range_nanmin(table, pos, right)
+        if np.isnan(left_prom):
+            out[pos] = right_prom
+        elif np.isnan(right_prom):
+            out[pos] = left_prom
+        else:
+            out[pos] = min(left_prom, right_prom)
+        if left == -1 and right == -1 and global_max_pos == -1:
+            global_max_pos = pos
+
+    # the global maximum, see find_peak_prominence:
+    if global_max_pos >= 0:
+        lowest = np.inf
+        for pos in np.flatnonzero(is_loc_min):
+            if (pos >= global_max_pos - max_dist) and (pos < global_max_pos + max_dist):
+                lowest = min(lowest, arr[pos])
+        if lowest == np.inf:
+            lowest = _range_nanmin(
+                table,
+                max(global_max_pos - max_dist, 0),
+                min(global_max_pos + max_dist, n),
+            )
+        out[global_max_pos] = arr[global_max_pos] - lowest
+
+
+@numba.njit
+def _find_peak_prominence_2d(arr, max_dist, out):
+    for i in range(arr.shape[0]):
+        _find_peak_prominence_1d(arr[i], max_dist, out[i])
+
+
+def find_peak_prominence_2d(arr, max_dist=None):
+    """Find the local maxima of several arrays and their prominence at once.
+
+    A compiled equivalent of `find_peak_prominence` applied to every row of
+    a 2D array, e.g. insulation tracks of several windows. NaNs are skipped,
+    i.e. with `max_dist=None` a row with NaNs at masked positions gives the
+    same peaks and prominences as `find_peak_prominence` of the row with
+    these positions removed.
+
+    Parameters
+    ----------
+    arr : array_like
+        A 2D array, one track per row.
+    max_dist : int
+        If specified, the distance to the adjacent higher peaks is limited
+        by `max_dist`.
+
+    Returns
+    -------
+    proms : numpy.array
+        An array of the shape of `arr` with the prominences of the local
+        maxima and NaNs elsewhere.
+    """
+    arr = np.ascontiguousarray(np.atleast_2d(arr), dtype=np.float64)
+    max_dist = arr.shape[1] if max_dist is None else int(max_dist)
+    proms = np.full(arr.shape, np.nan)
+    _find_peak_prominence_2d(arr, max_dist, proms)
+    return proms
+
+
 def peakdet(arr, min_prominence):
     """Detect local peaks in an array.
     Finds a sequence of minima and maxima such that the two consecutive extrema
@@ -1,5 +1,7 @@
 from collections import OrderedDict
-from functools import partial
+from collections.abc import Mapping
+from functools import partial, reduce
+import zlib
 
 import matplotlib.pyplot as plt
 from scipy.linalg import toeplitz
@@ -9,7 +11,8 @@ import pandas as pd
 import bioframe
 import cooler
 
-from .lib.numutils import LazyToeplitz
+from .lib.common import assign_intervals
+from .lib.numutils import LazyToeplitz, zoom_array_stack
 
 
 def make_bin_aligned_windows(
@@ -79,71 +82,310 @@ def make_bin_aligned_windows(
 
 def assign_regions(features, supports):
     """
+    Assign support regions to features. A feature is assigned to the last
+    of the support regions it overlaps, or to none of them (NaN).
+
+    Parameters
+    ----------
+    features : DataFrame
+        Table of on-diagonal features with columns ['chrom', 'start', 'end'],
+        or off-diagonal features with columns ['chrom1', 'start1', 'end1',
+        'chrom2', 'start2', 'end2'].
+    supports : list
+        Support regions (chrom, start, end) or pairs of support regions.
+
+    Returns
+    -------
+    Copy of 'features' with a 'region' column of UCSC-style strings.
 
     """
     features = features.copy()
 
     # on-diagonal features
     if "chrom" in features.columns:
+        intervals = []
         for i, region in enumerate(supports):
             if len(region) == 3:
-                sel = features.chrom == region[0]
-                sel &= features.end >= region[1]
-                if region[2] is not None:
-                    sel &= features.start < region[2]
-
-                features.loc[sel, "region"] = i
-
+                intervals.append((*region, i))
             elif len(region) == 2:
                 region1, region2 = region
-                sel1 = features.chrom == region1[0]
-                sel1 &= features.end >= region1[1]
-                if region1[2] is not None:
-                    sel1 &= features.start < region1[2]
-
-                sel2 = features.chrom == region2[0]
-                sel2 &= features.end >= region2[1]
-                if region2[2] is not None:
-                    sel2 &= features.start < region2[2]
-
-                features.loc[(sel1 | sel2), "region"] = i
+                intervals.extend([(*region1, i), (*region2, i)])
+        # features ending right at the start of a region are assigned to it:
+        assigned = assign_intervals(
+            features.chrom, features.start, features.end + 1, intervals
+        )
 
     # off-diagonal features
     elif "chrom1" in features.columns:
+        intervals1, intervals2 = [], []
         for i, region in enumerate(supports):
             if len(region) == 3:
                 region1, region2 = region, region
             elif len(region) == 2:
                 region1, region2 = region[0], region[1]
-
-            sel1 = features.chrom1 == region1[0]
-            sel1 &= features.end1 >= region1[1]
-            if region1[2] is not None:
-                sel1 &= features.start1 < region1[2]
-
-            sel2 = features.chrom2 == region2[0]
-            sel2 &= features.end2 >= region2[1]
-            if region2[2] is not None:
-                sel2 &= features.start2 < region2[2]
-
-            features.loc[(sel1 | sel2), "region"] = i
+            intervals1.append((*region1, i))
+            intervals2.append((*region2, i))
+        assigned = np.maximum(
+            assign_intervals(
+                features.chrom1, features.start1, features.end1 + 1, intervals1
+            ),
+            assign_intervals(
+                features.chrom2, features.start2, features.end2 + 1, intervals2
+            ),
+        )
     else:
         raise ValueError("Could not parse `features` data frame.")
 
-    features["region"] = features["region"].map(
-        lambda i: "{}:{}-{}".format(*supports[int(i)]), na_action="ignore"
+    features["region"] = pd.Series(assigned, index=features.index).map(
+        lambda i: "{}:{}-{}".format(*supports[int(i)]) if i >= 0 else np.nan
     )
     return features
 
 
-def _pileup(data_select, data_snip, arg):
-    support, feature_group = arg
+class PileupAccumulator:
+    """
+    Running per-pixel statistics of a pileup: NaN-aware counts, sums and
+    sums of squares of snippets, and optionally a histogram of values in
+    every pixel to estimate quantiles. Memory usage is independent of the
+    number of snippets.
+
+    Parameters
+    ----------
+    shape : (int, int) tuple, optional
+        Shape of the snippets. Taken from the first added snippet if None.
+    sketch_edges : 1D array-like, optional
+        Edges of the histogram bins of values, used to estimate quantiles.
+        Values outside of the edges are counted in the outermost bins.
+        No histograms are kept if None.
+
+    Example
+    -------
+    >>> acc = PileupAccumulator()
+    >>> for snippet in snippets:
+    ...     acc.add(snippet)
+    >>> acc.mean
+
+    """
+
+    def __init__(self, shape=None, sketch_edges=None):
+        self.shape = None
+        self.sketch_edges = (
+            None if sketch_edges is None else np.asarray(sketch_edges, dtype=float)
+        )
+        self.n = 0
+        if shape is not None:
+            self._allocate(shape)
+
+    def _allocate(self, shape):
+        self.shape = tuple(shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.sum = np.zeros(self.shape)
+        self.sumsq = np.zeros(self.shape)
+        if self.sketch_edges is not None:
+            n_bins = len(self.sketch_edges) - 1
+            self.hist = np.zeros((n_bins,) + self.shape, dtype=np.int64)
+        else:
+            self.hist = None
+
+    def add(self, snippets):
+        """
+        Add a snippet, or a stack of snippets along the first axis.
+        """
+        snippets = np.asarray(snippets, dtype=float)
+        if snippets.ndim == 2:
+            snippets = snippets[np.newaxis]
+        if self.shape is None:
+            self._allocate(snippets.shape[1:])
+        elif snippets.shape[1:] != self.shape:
+            raise ValueError(
+                "Snippet shape {} does not match {}.".format(
+                    snippets.shape[1:], self.shape
+                )
+            )
+        isfinite = np.isfinite(snippets)
+        values = np.where(isfinite, snippets, 0.0)
+        self.n += len(snippets)
+        self.count += isfinite.sum(axis=0)
+        self.sum += values.sum(axis=0)
+        self.sumsq += (values * values).sum(axis=0)
+        if self.hist is not None:
+            # histogram bin and pixel of every finite value:
+            n_bins = len(self.sketch_edges) - 1
+            bins = np.searchsorted(self.sketch_edges, snippets[isfinite], side="right")
+            bins = np.clip(bins - 1, 0, n_bins - 1)
+            pixels = np.flatnonzero(isfinite) % self.count.size
+            self.hist += np.bincount(
+                bins * self.count.size + pixels, minlength=self.hist.size
+            ).reshape(self.hist.shape)
+        return self
+
+    def merge(self, other):
+        """
+        Add up statistics of another accumulator, in-place.
+        """
+        if other.shape is None:
+            return self
+        if self.shape is None:
+            self._allocate(other.shape)
+        elif other.shape != self.shape:
+            raise ValueError(
+                "Snippet shape {} does not match {}.".format(other.shape, self.shape)
+            )
+        if (self.hist is None) != (other.hist is None) or (
+            self.hist is not None
+            and not np.array_equal(self.sketch_edges, other.sketch_edges)
+        ):
+            raise ValueError("Accumulators must use the same sketch edges.")
+        self.n += other.n
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        if self.hist is not None:
+            self.hist += other.hist
+        return self
+
+    @property
+    def mean(self):
+        """Per-pixel mean, NaN where no finite values were added."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sum / self.count
+
+    @property
+    def var(self):
+        """Per-pixel (population) variance."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.sum / self.count
+            return np.maximum(self.sumsq / self.count - mean * mean, 0.0)
+
+    @property
+    def std(self):
+        """Per-pixel (population) standard deviation."""
+        return np.sqrt(self.var)
+
+    def quantile(self, q):
+        """
+        Per-pixel estimate of the 'q'-th quantile, interpolated linearly
+        within the bins of the histogram sketch.
+        """
+        if self.hist is None:
+            raise ValueError("Quantiles require an accumulator with sketch_edges.")
+        edges = self.sketch_edges
+        cumhist = np.cumsum(self.hist, axis=0)
+        rank = q * self.count
+        # histogram bin, where the cumulative count reaches the rank:
+        b = np.minimum((cumhist < rank).sum(axis=0), len(edges) - 2)
+        below = np.take_along_axis(cumhist, b[np.newaxis], 0)[0]
+        inbin = np.take_along_axis(self.hist, b[np.newaxis], 0)[0]
+        below = below - inbin
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frac = np.clip((rank - below) / inbin, 0.0, 1.0)
+        frac[inbin == 0] = 0.0
+        result = edges[b] + frac * (edges[b + 1] - edges[b])
+        result[self.count == 0] = np.nan
+        return result
+
+
+class ShiftedControls:
+    """
+    Control windows for pileups, made by shifting windows of features along
+    the diagonal by random distances. Both ends of off-diagonal windows are
+    shifted by the same distance, so that controls are matched by the
+    distance between the ends. Shifts are towards the side, where shifted
+    windows stay within support regions, and random otherwise.
+
+    Parameters
+    ----------
+    binsize : int
+        Bin size of the data, shifts are multiples of it.
+    n_shifts : int
+        Number of control windows per feature.
+    min_shift, max_shift : int
+        Range of the distances of shifts, in bp.
+    seed : int, optional
+        Seed of random shifts. Shifts in a support region depend only on
+        the seed and the region, but not on the order of processing.
+
+    Example
+    -------
+    >>> controls = ShiftedControls(clr.binsize, n_shifts=10, seed=0)
+    >>> observed, control = accumulate_pileup(
+    ...     windows, snipper.select, snipper.snip, control=controls
+    ... )
+    >>> enrichment = observed.mean / control.mean
+
+    """
+
+    def __init__(
+        self, binsize, n_shifts=10, min_shift=100000, max_shift=1000000, seed=None
+    ):
+        if not (0 < min_shift <= max_shift):
+            raise ValueError("Shifts should satisfy 0 < min_shift <= max_shift.")
+        self.binsize = binsize
+        self.n_shifts = n_shifts
+        self.min_shift = min_shift
+        self.max_shift = max_shift
+        self.seed = seed
+
+    def control_spans(self, support, spans):
+        """
+        Control windows of windows of features in a support region.
+
+        Parameters
+        ----------
+        support : str or tuple of str
+            Support region, as in the 'region' column of features, or a
+            pair of them for off-diagonal features.
+        spans : array-like
+            Windows (start1, end1, start2, end2) of features.
+
+        Returns
+        -------
+        Array of control windows of shape (n, n_shifts, 4).
+
+        """
+        spans = np.asarray(list(spans), dtype=np.int64).reshape(-1, 4)
+        if self.seed is None:
+            rng = np.random.RandomState()
+        else:
+            rng = np.random.RandomState(
+                (self.seed + zlib.crc32(str(support).encode())) % 2**32
+            )
+        lo = -(-self.min_shift // self.binsize)
+        hi = max(lo, self.max_shift // self.binsize)
+        shape = (len(spans), self.n_shifts)
+        shifts = rng.randint(lo, hi + 1, shape) * self.binsize
+        shifts *= rng.choice([-1, 1], shape)
+
+        # shifts keeping windows within the support regions:
+        region1, region2 = _parse_support(support)
+        s1, e1, s2, e2 = spans.T[:, :, np.newaxis]
+        # a bare chromosome has neither a start nor an end:
+        start1 = 0 if region1[1] is None else region1[1]
+        start2 = 0 if region2[1] is None else region2[1]
+        min_shift = np.maximum(start1 - s1, start2 - s2)
+        max_shift = np.full_like(min_shift, np.iinfo(np.int64).max)
+        if region1[2] is not None:
+            max_shift = np.minimum(max_shift, region1[2] - e1)
+        if region2[2] is not None:
+            max_shift = np.minimum(max_shift, region2[2] - e2)
+        flip = (shifts < min_shift) | (shifts > max_shift)
+        shifts[flip] *= -1
+        # shifts out of the regions on both sides are kept random:
+        flip &= (shifts < min_shift) | (shifts > max_shift)
+        shifts[flip] *= -1
+        return spans[:, np.newaxis, :] + shifts[:, :, np.newaxis]
+
+
+def _parse_support(support):
     # check if support region is on- or off-diagonal
     if len(support) == 2:
         region1, region2 = map(bioframe.parse_region_string, support)
     else:
         region1 = region2 = bioframe.parse_region_string(support)
+    return region1, region2
+
 
+def _feature_spans(feature_group):
     # check if features are on- or off-diagonal
     if "start" in feature_group:
         s1 = feature_group["start"].values
@@ -154,16 +396,24 @@ def _pileup(data_select, data_snip, arg):
         e1 = feature_group["end1"].values
         s2 = feature_group["start2"].values
         e2 = feature_group["end2"].values
+    return zip(s1, e1, s2, e2)
 
-    data = data_select(region1, region2)
-    stack = list(map(partial(data_snip, data, region1, region2), zip(s1, e1, s2, e2)))
 
-    return np.dstack(stack), feature_group["_rank"].values
+def _pileup(data_select, data_snip, arg):
+    support, feature_group = arg
+    region1, region2 = _parse_support(support)
+
+    spans = list(_feature_spans(feature_group))
+    data = _select_windows(data_select)(region1, region2, spans)
+    stack = _snip_batch(data_snip)(data, region1, region2, spans)
+
+    return np.moveaxis(stack, 0, -1), feature_group["_rank"].values
 
 
 def pileup(features, data_select, data_snip, map=map):
     """
-    Handles on-diagonal and off-diagonal cases.
+    Handles on-diagonal and off-diagonal cases. Returns a stack of all of
+    the snippets, use 'accumulate_pileup' for large sets of features.
 
     Parameters
     ----------
@@ -175,7 +425,8 @@ def pileup(features, data_select, data_snip, map=map):
 
     data_select : callable
         Callable that takes a region as argument and returns
-        the data, mask and bin offset of a support region
+        the data, mask and bin offset of a support region. Snippers, that
+        have a 'select_windows' method, fetch only the windows of features.
 
     data_snip : callable
         Callable that takes data, mask and a 2D bin span (lo1, hi1, lo2, hi2)
@@ -209,44 +460,780 @@ def pileup(features, data_select, data_snip, map=map):
     return cumul_stack
 
 
+def _accumulate_pileup(
+    data_select, data_snip, by, sketch_edges, arg, batch_size=1000, control=None
+):
+    support, feature_group = arg
+    region1, region2 = _parse_support(support)
+
+    spans = list(_feature_spans(feature_group))
+    if control is not None:
+        # control windows are snipped from the same selected data:
+        control_spans = control.control_spans(support, spans)
+        spans += [tuple(span) for span in control_spans.reshape(-1, 4)]
+        feature_group = feature_group.assign(_pos=np.arange(len(feature_group)))
+    data = _select_windows(data_select)(region1, region2, spans)
+    snip_batch = _snip_batch(data_snip)
+    if by is None:
+        groups = [(None, feature_group)]
+    else:
+        groups = feature_group.groupby(by, sort=False)
+
+    accumulators, controls = {}, {}
+    for key, group in groups:
+        acc = PileupAccumulator(sketch_edges=sketch_edges)
+        ctrl = PileupAccumulator(sketch_edges=sketch_edges)
+        # snip in batches, to keep a bounded number of snippets in memory:
+        for i in range(0, len(group), batch_size):
+            batch = group.iloc[i : i + batch_size]
+            acc.add(snip_batch(data, region1, region2, _feature_spans(batch)))
+            if control is not None:
+                batch_controls = control_spans[batch["_pos"].values]
+                ctrl.add(
+                    snip_batch(data, region1, region2, batch_controls.reshape(-1, 4))
+                )
+        accumulators[key] = acc
+        controls[key] = ctrl
+    if control is None:
+        return accumulators
+    return accumulators, controls
+
+
+def _merge_accumulators(accumulators, other):
+    for key, acc in other.items():
+        if key in accumulators:
+            accumulators[key].merge(acc)
+        else:
+            accumulators[key] = acc
+    return accumulators
+
+
+def accumulate_pileup(
+    features, data_select, data_snip, by=None, sketch_edges=None, control=None, map=map
+):
+    """
+    Pileup of features without a stack of snippets in memory: snippets are
+    added up into running per-pixel statistics as soon as they are snipped.
+    Memory usage is proportional to the size of a snippet and the number of
+    groups, but not to the number of features. Handles on-diagonal and
+    off-diagonal cases.
+
+    Parameters
+    ----------
+    features : DataFrame
+        Table of features, same as in 'pileup'.
+
+    data_select : callable
+        Callable that takes a region as argument and returns
+        the data, mask and bin offset of a support region. Snippers, that
+        have a 'select_windows' method, fetch only the windows of features.
+
+    data_snip : callable
+        Callable that takes data, mask and a 2D bin span (lo1, hi1, lo2, hi2)
+        and returns a snippet from the selected support region
+
+    by : str or list of str, optional
+        Column(s) of 'features' to aggregate features by, e.g. motif
+        orientation or quantile of strength. All features are aggregated
+        together if None.
+
+    sketch_edges : 1D array-like, optional
+        Edges of histogram bins to estimate quantiles with,
+        see 'PileupAccumulator'.
+
+    control : ShiftedControls, optional
+        Strategy of making control windows for features, e.g. by random
+        shifts. Control windows are snipped from the same data of support
+        regions, as the windows of features.
+
+    map : callable
+        Map function to dispatch support regions with.
+
+    Returns
+    -------
+    PileupAccumulator, or a dict of PileupAccumulator-s with group keys as
+    keys, when 'by' is provided. A pair of such pileups of features and of
+    controls, when 'control' is provided.
+
+    """
+    if features.region.isnull().any():
+        raise ValueError(
+            "Drop features with no region assignment before calling pileup!"
+        )
+
+    partial_accumulators = map(
+        partial(
+            _accumulate_pileup,
+            data_select,
+            data_snip,
+            by,
+            sketch_edges,
+            control=control,
+        ),
+        features.groupby("region", sort=False),
+    )
+    if control is None:
+        return _reduce_accumulators(partial_accumulators, by, sketch_edges)
+
+    observed, controls = zip(*partial_accumulators)
+    return (
+        _reduce_accumulators(observed, by, sketch_edges),
+        _reduce_accumulators(controls, by, sketch_edges),
+    )
+
+
+def _reduce_accumulators(partial_accumulators, by, sketch_edges):
+    accumulators = reduce(_merge_accumulators, partial_accumulators, {})
+    if by is None:
+        return accumulators.get(None, PileupAccumulator(sketch_edges=sketch_edges))
+    return accumulators
+
+
+class SnipperSpec:
+    """
+    A picklable recipe of a snipper, that opens the cooler by its URI
+    wherever the snipper is made, e.g. in a worker process. Unlike snippers
+    themselves, specs hold no open file handles and no per-region state.
+
+    Parameters
+    ----------
+    snipper_class : class
+        Snipper class, e.g. CoolerSnipper or ObsExpSnipper.
+    cool_uri : str
+        URI of the cooler to snip from.
+    *args, **kwargs
+        Other arguments of the snipper, e.g. a DataFrame of expected.
+
+    Example
+    -------
+    >>> spec = SnipperSpec(ObsExpSnipper, "test.mcool::resolutions/10000", expected)
+    >>> snipper = spec.make()
+
+    """
+
+    def __init__(self, snipper_class, cool_uri, *args, **kwargs):
+        self.snipper_class = snipper_class
+        self.cool_uri = cool_uri
+        self.args = args
+        self.kwargs = kwargs
+
+    def make(self):
+        """Open the cooler and make a new snipper."""
+        return self.snipper_class(
+            cooler.Cooler(self.cool_uri), *self.args, **self.kwargs
+        )
+
+
+def _accumulate_snipper_pileup(snipper_spec, by, sketch_edges, arg):
+    # select and snip within a worker, returning only the accumulators:
+    snipper = snipper_spec.make()
+    return _accumulate_pileup(snipper.select, snipper.snip, by, sketch_edges, arg)
+
+
+def accumulate_snipper_pileup(
+    features, snipper_spec, by=None, sketch_edges=None, map=map
+):
+    """
+    Same as 'accumulate_pileup', with every support region selected and
+    snipped by a snipper made from 'snipper_spec', so that regions can be
+    processed in separate processes, e.g. with 'map=pool.imap_unordered'.
+    Only partial accumulators are sent back from workers, and regions with
+    the most features are dispatched first.
+
+    Parameters
+    ----------
+    features : DataFrame
+        Table of features, same as in 'pileup'.
+
+    snipper_spec : SnipperSpec
+        Recipe of a snipper to select and snip support regions with.
+
+    by, sketch_edges :
+        Same as in 'accumulate_pileup'.
+
+    map : callable
+        Map function to dispatch support regions with.
+
+    Returns
+    -------
+    PileupAccumulator, or a dict of PileupAccumulator-s with group keys as
+    keys, when 'by' is provided.
+
+    """
+    if features.region.isnull().any():
+        raise ValueError(
+            "Drop features with no region assignment before calling pileup!"
+        )
+
+    region_groups = sorted(
+        features.groupby("region", sort=False), key=lambda group: -len(group[1])
+    )
+    return _reduce_accumulators(
+        map(
+            partial(_accumulate_snipper_pileup, snipper_spec, by, sketch_edges),
+            region_groups,
+        ),
+        by,
+        sketch_edges,
+    )
+
+
+def _condition_specs(condition, chroms):
+    # snipper specs of a condition, given as a (cooler, expected) pair, for
+    # each of the chromosomes, with only the expected of a chromosome:
+    if isinstance(condition, SnipperSpec):
+        return dict.fromkeys(chroms, condition)
+    clr, expected = condition
+    cool_uri = clr if isinstance(clr, str) else clr.uri
+    if expected is None:
+        return dict.fromkeys(chroms, SnipperSpec(CoolerSnipper, cool_uri))
+    if "chrom" not in expected.columns:
+        return dict.fromkeys(chroms, SnipperSpec(ObsExpSnipper, cool_uri, expected))
+    tables = dict(iter(expected.groupby("chrom", sort=False)))
+    return {
+        chrom: SnipperSpec(ObsExpSnipper, cool_uri, tables.get(chrom, expected[:0]))
+        for chrom in chroms
+    }
+
+
+def _accumulate_condition_pileup(by, sketch_edges, arg):
+    condition, snipper_spec, region_group = arg
+    accumulators = _accumulate_snipper_pileup(
+        snipper_spec, by, sketch_edges, region_group
+    )
+    return condition, accumulators
+
+
+def accumulate_multi_pileup(features, conditions, by=None, sketch_edges=None, map=map):
+    """
+    Pileups of the same features in multiple coolers, e.g. of a timecourse
+    or of knockouts. Features are grouped by support regions only once, and
+    every pair of a condition and a support region is a separate task, so
+    that all of the coolers are processed in parallel with e.g.
+    'map=pool.imap_unordered'.
+
+    Parameters
+    ----------
+    features : DataFrame
+        Table of features, same as in 'pileup'.
+
+    conditions : dict or list
+        Conditions as (cooler, expected) pairs, with a Cooler or a cooler
+        URI, and a table of expected for observed over expected pileups, or
+        None for pileups of balanced observed. SnipperSpec-s are accepted as
+        well. A list is indexed by the positions of conditions.
+
+    by, sketch_edges :
+        Same as in 'accumulate_pileup'.
+
+    map : callable
+        Map function to dispatch tasks with.
+
+    Returns
+    -------
+    dict of pileups, as returned by 'accumulate_pileup', with condition
+    keys as keys.
+
+    """
+    if features.region.isnull().any():
+        raise ValueError(
+            "Drop features with no region assignment before calling pileup!"
+        )
+    if not isinstance(conditions, Mapping):
+        conditions = dict(enumerate(conditions))
+
+    region_groups = sorted(
+        features.groupby("region", sort=False), key=lambda group: -len(group[1])
+    )
+    chroms = [_parse_support(support)[0][0] for support, _ in region_groups]
+    # tasks carry along the expected of their chromosomes only:
+    specs = {
+        key: _condition_specs(condition, set(chroms))
+        for key, condition in conditions.items()
+    }
+    tasks = [
+        (key, specs[key][chrom], region_group)
+        for chrom, region_group in zip(chroms, region_groups)
+        for key in conditions
+    ]
+    partial_accumulators = {key: [] for key in conditions}
+    for key, accumulators in map(
+        partial(_accumulate_condition_pileup, by, sketch_edges), tasks
+    ):
+        partial_accumulators[key].append(accumulators)
+    return {
+        key: _reduce_accumulators(partial_accumulators[key], by, sketch_edges)
+        for key in conditions
+    }
+
+
+def _accumulate_rescaled_pileup(
+    data_select, data_snip, shape, same_sum, by, sketch_edges, arg, max_pixels=10**7
+):
+    support, feature_group = arg
+    region1, region2 = _parse_support(support)
+
+    spans = list(_feature_spans(feature_group))
+    data = _select_windows(data_select)(region1, region2, spans)
+    snip_batch = _snip_batch(data_snip)
+    if by is None:
+        groups = [(None, feature_group)]
+    else:
+        groups = feature_group.groupby(by, sort=False)
+
+    accumulators = {}
+    for key, group in groups:
+        acc = PileupAccumulator(sketch_edges=sketch_edges)
+        # windows of the same size are snipped and rescaled in batches,
+        # to keep a bounded number of pixels in memory:
+        for size, windows in group.groupby("_size", sort=False):
+            batch_size = max(1, max_pixels // size**2)
+            for i in range(0, len(windows), batch_size):
+                batch = windows.iloc[i : i + batch_size]
+                snippets = snip_batch(data, region1, region2, _feature_spans(batch))
+                acc.add(zoom_array_stack(snippets, shape, same_sum))
+        accumulators[key] = acc
+    return accumulators
+
+
+def accumulate_rescaled_pileup(
+    features,
+    data_select,
+    data_snip,
+    binsize,
+    flank=1.0,
+    shape=(90, 90),
+    same_sum=False,
+    by=None,
+    sketch_edges=None,
+    map=map,
+):
+    """
+    Pileup of features of different sizes, e.g. TADs or compartmental
+    domains, with every window rescaled to the same shape. A window spans
+    a feature and flanks of a 'flank' fraction of its size on both sides,
+    extended to bin edges. Windows are snipped and rescaled in batches of
+    the same size, and added up as in 'accumulate_pileup'. Handles
+    on-diagonal features only.
+
+    Parameters
+    ----------
+    features : DataFrame
+        Table of features with columns ['chrom', 'start', 'end', 'region'].
+
+    data_select, data_snip :
+        Same as in 'accumulate_pileup'.
+
+    binsize : int
+        Bin size of the data, in bp.
+
+    flank : float
+        Size of the flanks, as a fraction of the size of a feature.
+
+    shape : tuple of int
+        Shape of the rescaled snippets.
+
+    same_sum : bool
+        Preserve sums of the snippets, rather than values, when rescaling,
+        see 'lib.numutils.zoom_array_stack'.
+
+    by, sketch_edges, map :
+        Same as in 'accumulate_pileup'.
+
+    Returns
+    -------
+    PileupAccumulator, or a dict of PileupAccumulator-s with group keys as
+    keys, when 'by' is provided.
+
+    """
+    if "start" not in features.columns:
+        raise ValueError("Rescaled pileups are implemented for on-diagonal features.")
+    if features.region.isnull().any():
+        raise ValueError(
+            "Drop features with no region assignment before calling pileup!"
+        )
+
+    windows = features.copy()
+    flanks = flank * (features["end"] - features["start"])
+    lo = np.floor((features["start"] - flanks) / binsize).astype(int)
+    hi = np.ceil((features["end"] + flanks) / binsize).astype(int)
+    hi = np.maximum(hi, lo + 1)
+    windows["start"], windows["end"] = lo * binsize, hi * binsize
+    windows["_size"] = hi - lo
+
+    return _reduce_accumulators(
+        map(
+            partial(
+                _accumulate_rescaled_pileup,
+                data_select,
+                data_snip,
+                tuple(shape),
+                same_sum,
+                by,
+                sketch_edges,
+            ),
+            windows.groupby("region", sort=False),
+        ),
+        by,
+        sketch_edges,
+    )
+
+
+def iter_site_pairs(sites, separation, slop, chunksize=1000000):
+    """
+    Pair sites on the same chromosomes, separated by a distance between
+    'separation' - 'slop' and 'separation' + 'slop', by a sweep over sites
+    sorted by their midpoints. Pairs are yielded in chunks, so that they
+    can be piled up without keeping all of the pairs in memory.
+
+    Parameters
+    ----------
+    sites : DataFrame
+        Table of sites with columns ['chrom', 'start', 'end'], and
+        optionally 'strand'.
+    separation, slop : int
+        Distance between midpoints of paired sites is within
+        [separation - slop, separation + slop], in bp. The second site of
+        a pair is downstream of the first one for a positive separation.
+    chunksize : int
+        Maximal number of pairs in a chunk, unless a single site has more
+        pairs.
+
+    Yields
+    ------
+    DataFrame-s of pairs with columns ['chrom', 'site_id1', 'site_id2',
+    'mid1', 'mid2'], and ['strand1', 'strand2'] when sites are stranded.
+    Site ids are labels of the index of 'sites'.
+
+    """
+    mids = ((sites["start"] + sites["end"]) // 2).values
+    strands = sites["strand"].values if "strand" in sites.columns else None
+    for chrom, idx in sites.groupby("chrom", sort=False).indices.items():
+        order = idx[np.argsort(mids[idx], kind="mergesort")]
+        chrom_mids = mids[order]
+        # every site is paired with a range of sites in the sorted order:
+        lo = np.searchsorted(chrom_mids, chrom_mids + separation - slop, "left")
+        hi = np.searchsorted(chrom_mids, chrom_mids + separation + slop, "right")
+        counts = np.maximum(hi - lo, 0)
+        cumcounts = np.cumsum(counts)
+
+        start = 0
+        while start < len(order):
+            done = cumcounts[start - 1] if start else 0
+            stop = np.searchsorted(cumcounts, done + chunksize, side="right")
+            stop = max(stop, start + 1)
+            n = counts[start:stop]
+            i = np.repeat(np.arange(start, stop), n)
+            j = np.arange(len(i)) + np.repeat(lo[start:stop] - np.cumsum(n) + n, n)
+            i, j = i[i != j], j[i != j]
+            start = stop
+            if len(i) == 0:
+                continue
+
+            pairs = pd.DataFrame(
+                {
+                    "chrom": chrom,
+                    "site_id1": sites.index[order[i]],
+                    "site_id2": sites.index[order[j]],
+                    "mid1": chrom_mids[i],
+                    "mid2": chrom_mids[j],
+                }
+            )
+            if strands is not None:
+                pairs["strand1"] = strands[order[i]]
+                pairs["strand2"] = strands[order[j]]
+            yield pairs
+
+
 def pair_sites(sites, separation, slop):
     """
     Create "hand" intervals to the right and to the left of each site.
     Then join right hands with left hands to pair sites together.
 
-    """
-    from bioframe.tools import tsv, bedtools
+    Hands overlap, when the distance between sites is within
+    2 * 'separation' +/- 2 * 'slop'. Pairs are found by 'iter_site_pairs'.
 
+    """
     mids = (sites["start"] + sites["end"]) // 2
-    left_hand = sites[["chrom"]].copy()
-    left_hand["start"] = mids - separation - slop
-    left_hand["end"] = mids - separation + slop
-    left_hand["site_id"] = left_hand.index
-    left_hand["direction"] = "L"
-    left_hand["snip_mid"] = mids
-    left_hand["snip_strand"] = sites["strand"]
-
-    right_hand = sites[["chrom"]].copy()
-    right_hand["start"] = mids + separation - slop
-    right_hand["end"] = mids + separation + slop
-    right_hand["site_id"] = right_hand.index
-    right_hand["direction"] = "R"
-    right_hand["snip_mid"] = mids
-    right_hand["snip_strand"] = sites["strand"]
 
     # ignore out-of-bounds hands
-    mask = (left_hand["start"] > 0) & (right_hand["start"] > 0)
-    left_hand = left_hand[mask].copy()
-    right_hand = right_hand[mask].copy()
+    mask = (mids - separation - slop > 0) & (mids + separation - slop > 0)
+    columns = ["chrom", "site_id1", "site_id2", "mid1", "mid2", "strand1", "strand2"]
+    pairs = pd.concat(
+        [pd.DataFrame(columns=columns)]
+        + list(iter_site_pairs(sites[mask], 2 * separation, 2 * slop)),
+        ignore_index=True,
+    )
+    # hands overlap, when the distance is strictly within the slop:
+    pairs = pairs[np.abs(pairs["mid2"] - pairs["mid1"] - 2 * separation) < 2 * slop]
+
+    out = pd.DataFrame(index=pairs.index)
+    for suffix, end, sign, direction in [("_r", "1", 1, "R"), ("_l", "2", -1, "L")]:
+        out["chrom" + suffix] = pairs["chrom"]
+        out["start" + suffix] = pairs["mid" + end] + sign * separation - slop
+        out["end" + suffix] = pairs["mid" + end] + sign * separation + slop
+        out["site_id" + suffix] = pairs["site_id" + end]
+        out["direction" + suffix] = direction
+        out["snip_mid" + suffix] = pairs["mid" + end]
+        out["snip_strand" + suffix] = pairs["strand" + end]
+    return out.reset_index(drop=True)
+
+
+def _window_spans(spans, binsize, offset1, offset2):
+    # bin spans of the windows, relative to the support regions:
+    spans = np.asarray(list(spans), dtype=np.int64).reshape(-1, 4)
+    s1, e1, s2, e2 = spans.T
+    lo1, hi1 = (s1 // binsize) - offset1, (e1 // binsize) - offset1
+    lo2, hi2 = (s2 // binsize) - offset2, (e2 // binsize) - offset2
+    assert np.all(hi1 >= 0)
+    assert np.all(hi2 >= 0)
+    return lo1, hi1, lo2, hi2
+
+
+def _window_bins(spans, binsize, offset1, offset2):
+    # bin spans of the windows of the same shape:
+    lo1, hi1, lo2, hi2 = _window_spans(spans, binsize, offset1, offset2)
+    shapes = np.unique(np.c_[hi1 - lo1, hi2 - lo2], axis=0)
+    if len(shapes) > 1:
+        raise ValueError("Windows of different shapes cannot be snipped in a batch.")
+    dm, dn = shapes[0] if len(shapes) else (0, 0)
+    return lo1, lo2, (len(lo1), dm, dn)
+
+
+def _window_mask(lo, length, size, isnan=None):
+    # bins of the windows that are out of bounds or masked:
+    idx = lo[:, np.newaxis] + np.arange(length)
+    mask = (idx < 0) | (idx >= size)
+    if isnan is not None:
+        mask |= isnan[np.clip(idx, 0, size - 1)]
+    return mask
+
+
+def _mask_windows(snippets, mask1, mask2):
+    # fill masked rows and columns of every snippet with NaNs:
+    snippets[mask1] = np.nan
+    snippets.transpose(0, 2, 1)[mask2] = np.nan
+    return snippets
+
+
+def _csr_keys(matrix):
+    # pixels of a CSR matrix as a sorted array of row * ncols + col:
+    if not matrix.has_sorted_indices:
+        matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
+
+
+def _gather_windows(matrix, lo1, lo2, shape, csr_keys=None):
+    """
+    Gather rectangular windows of a dense or CSR matrix into a stack of
+    dense snippets of 'shape' (n, h, w). Windows could be out of bounds of
+    the matrix, such parts are filled with zeros.
+    """
+    n_windows, dm, dn = shape
+    m, n = matrix.shape
+    rows = lo1[:, np.newaxis] + np.arange(dm)
+    cols = lo2[:, np.newaxis] + np.arange(dn)
+    if not sps.issparse(matrix):
+        matrix = np.asarray(matrix)
+        if not (m and n):
+            return np.zeros(shape)
+        snippets = matrix[
+            np.clip(rows, 0, m - 1)[:, :, np.newaxis],
+            np.clip(cols, 0, n - 1)[:, np.newaxis, :],
+        ].astype(float)
+        snippets[(rows < 0) | (rows >= m)] = 0
+        snippets.transpose(0, 2, 1)[(cols < 0) | (cols >= n)] = 0
+        return snippets
+
+    if csr_keys is None:
+        csr_keys = _csr_keys(matrix)
+    snippets = np.zeros(shape)
+    # every in-bounds row of every window is a range of pixels
+    # between two row * ncols + col keys:
+    win, a = np.nonzero((rows >= 0) & (rows < m))
+    row_keys = rows[win, a].astype(np.int64) * n
+    starts = np.searchsorted(csr_keys, row_keys + np.clip(lo2[win], 0, n))
+    stops = np.searchsorted(csr_keys, row_keys + np.clip(lo2[win] + dn, 0, n))
+    lengths = stops - starts
+    # indices of pixels in all of the ranges, and their places in the
+    # flattened stack of snippets:
+    idx = np.arange(lengths.sum()) + np.repeat(
+        starts - np.cumsum(lengths) + lengths, lengths
+    )
+    places = np.repeat((win * dm + a) * dn - lo2[win], lengths)
+    snippets.put(places + matrix.indices[idx], matrix.data[idx])
+    return snippets
 
-    # intersect right hands (left anchor site)
-    # with left hands (right anchor site)
-    with tsv(right_hand) as R, tsv(left_hand) as L:
-        out = bedtools.intersect(a=R.name, b=L.name, wa=True, wb=True)
-        out.columns = [c + "_r" for c in right_hand.columns] + [
-            c + "_l" for c in left_hand.columns
-        ]
-    return out
+
+class _TemplateCache:
+    """
+    Cache of windows of expected with a bound on their number, that evicts
+    the least recently used windows first.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._templates = OrderedDict()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, key, make):
+        if key in self._templates:
+            self._templates.move_to_end(key)
+            return self._templates[key]
+        template = self._templates[key] = make()
+        if len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+        return template
+
+
+def _expected_template(expected, offset, dm, dn):
+    # window of a symmetric Toeplitz matrix of expected on a diagonal 'offset':
+    diags = offset + np.arange(dn)[np.newaxis, :] - np.arange(dm)[:, np.newaxis]
+    return expected[np.clip(np.abs(diags), 0, len(expected) - 1)].astype(float)
+
+
+def _expected_windows(expected, lo1, lo2, shape, templates=None, region=None):
+    """
+    Windows of a symmetric Toeplitz matrix of expected. Windows on the same
+    diagonal are the same, so a template is built once per diagonal offset,
+    and kept in 'templates' cache under (region, offset, shape) keys, when
+    the cache is provided.
+    """
+    n_windows, dm, dn = shape
+    offsets, inverse = np.unique(lo2 - lo1, return_inverse=True)
+    stack = np.empty((len(offsets), dm, dn))
+    for k, offset in enumerate(offsets):
+        make = partial(_expected_template, expected, offset, dm, dn)
+        if templates is None:
+            stack[k] = make()
+        else:
+            stack[k] = templates.get((region, offset, (dm, dn)), make)
+    return stack[inverse]
+
+
+def _span_union(lo, hi):
+    # union of half-open intervals [lo, hi) as sorted disjoint intervals:
+    lo, hi = np.asarray(lo, dtype=np.int64), np.asarray(hi, dtype=np.int64)
+    lo, hi = lo[lo < hi], hi[lo < hi]
+    if len(lo) == 0:
+        return lo, hi
+    order = np.argsort(lo, kind="mergesort")
+    lo, hi = lo[order], np.maximum.accumulate(hi[order])
+    first = np.r_[True, lo[1:] > hi[:-1]]
+    last = np.r_[first[1:], True]
+    return lo[first], hi[last]
+
+
+def _in_spans(x, starts, ends):
+    # whether values of x fall into sorted disjoint intervals [starts, ends):
+    idx = np.searchsorted(starts, x, side="right") - 1
+    return (idx >= 0) & (x < np.r_[ends, 0][idx])
+
+
+def _fetch_windows(clr, region1, region2, windows, field="count", weight=None):
+    """
+    Fetch pixels of 'region1' x 'region2', covered by windows of bins
+    (lo1, hi1, lo2, hi2) of the regions, into a CSR matrix of the size of
+    the regions. Only the rows of the cooler, that are needed for the
+    windows, are read using the bin1 offsets index, other pixels are left
+    empty. Pixels are balanced with the 'weight' column of bins, unless
+    it is None.
+    """
+    lo1, hi1, lo2, hi2 = windows
+    o1, o2 = clr.offset(region1), clr.offset(region2)
+    m, n = clr.extent(region1)[1] - o1, clr.extent(region2)[1] - o2
+    rows = _span_union(np.clip(lo1, 0, m) + o1, np.clip(hi1, 0, m) + o1)
+    cols = _span_union(np.clip(lo2, 0, n) + o2, np.clip(hi2, 0, n) + o2)
+    # only the upper triangle is stored, so pixels of the windows are
+    # in the rows of the cooler for both rows and columns of the windows:
+    starts, ends = _span_union(np.r_[rows[0], cols[0]], np.r_[rows[1], cols[1]])
+    with clr.open("r") as grp:
+        pixels = grp["pixels"]
+        bin1 = [np.array([], dtype=np.int64)]
+        bin2 = [np.array([], dtype=pixels["bin2_id"].dtype)]
+        data = [np.array([], dtype=pixels[field].dtype)]
+        for i0, i1 in zip(starts, ends):
+            offsets = grp["indexes"]["bin1_offset"][i0 : i1 + 1]
+            p0, p1 = offsets[0], offsets[-1]
+            bin1.append(np.repeat(np.arange(i0, i1), np.diff(offsets)))
+            bin2.append(pixels["bin2_id"][p0:p1])
+            data.append(pixels[field][p0:p1])
+        if weight is not None:
+            weights = grp["bins"][weight]
+            w1, w2 = weights[o1 : o1 + m], weights[o2 : o2 + n]
+    bin1, bin2, data = map(np.concatenate, (bin1, bin2, data))
+
+    upper = _in_spans(bin1, *rows) & _in_spans(bin2, *cols)
+    lower = _in_spans(bin2, *rows) & _in_spans(bin1, *cols) & (bin1 != bin2)
+    i = np.r_[bin1[upper], bin2[lower]] - o1
+    j = np.r_[bin2[upper], bin1[lower]] - o2
+    data = np.r_[data[upper], data[lower]]
+    if weight is not None:
+        data = data * w1[i] * w2[j]
+    return sps.csr_matrix((data, (i, j)), shape=(m, n))
+
+
+def _fetch_opts(cooler_opts):
+    # field and weight column to fetch windows with, or None when some
+    # of the cooler options are not supported by '_fetch_windows':
+    opts = dict(cooler_opts)
+    opts.pop("sparse", None)
+    field = opts.pop("field", None) or "count"
+    balance = opts.pop("balance", True)
+    if opts:
+        return None
+    if isinstance(balance, str):
+        return field, balance
+    return field, "weight" if balance else None
+
+
+def _bad_bins(clr, cache, region):
+    # bad-bin mask of a region, sliced out of a cached mask of its chromosome:
+    chrom = region[0]
+    if chrom not in cache:
+        cache[chrom] = np.isnan(clr.bins()["weight"].fetch(chrom).values)
+    lo, hi = np.subtract(clr.extent(region), clr.offset(chrom))
+    return cache[chrom][lo:hi]
+
+
+def _snip_batch(data_snip):
+    """
+    Callable that snips a batch of windows into a stack of shape (n, h, w),
+    using 'snip_batch' of a snipper when 'data_snip' is its 'snip' method,
+    and snipping windows one by one otherwise.
+    """
+    snipper = getattr(data_snip, "__self__", None)
+    if getattr(data_snip, "__name__", None) == "snip" and hasattr(
+        snipper, "snip_batch"
+    ):
+        return snipper.snip_batch
+
+    def snip_batch(data, region1, region2, spans):
+        snip = partial(data_snip, data, region1, region2)
+        return np.stack(list(map(snip, spans)))
+
+    return snip_batch
+
+
+def _select_windows(data_select):
+    """
+    Callable that selects the data of a support region for a batch of
+    windows, using 'select_windows' of a snipper when 'data_select' is its
+    'select' method, and selecting the entire support region otherwise.
+    """
+    snipper = getattr(data_select, "__self__", None)
+    if getattr(data_select, "__name__", None) == "select" and hasattr(
+        snipper, "select_windows"
+    ):
+        return snipper.select_windows
+
+    def select_windows(region1, region2, spans):
+        return data_select(region1, region2)
+
+    return select_windows
 
 
 class CoolerSnipper:
@@ -257,61 +1244,66 @@ class CoolerSnipper:
         self.pad = True
         self.cooler_opts = {} if cooler_opts is None else cooler_opts
         self.cooler_opts.setdefault("sparse", True)
+        # pixel keys of the last selected matrix, for batch snipping:
+        self._keys = self._keys_for = None
+        # bad-bin masks of chromosomes:
+        self._bad_bins = {}
 
     def select(self, region1, region2):
         self.offsets[region1] = self.clr.offset(region1) - self.clr.offset(region1[0])
         self.offsets[region2] = self.clr.offset(region2) - self.clr.offset(region2[0])
-        self._isnan1 = np.isnan(self.clr.bins()["weight"].fetch(region1).values)
-        self._isnan2 = np.isnan(self.clr.bins()["weight"].fetch(region2).values)
+        self._isnan1 = _bad_bins(self.clr, self._bad_bins, region1)
+        self._isnan2 = _bad_bins(self.clr, self._bad_bins, region2)
         matrix = self.clr.matrix(**self.cooler_opts).fetch(region1, region2)
         if self.cooler_opts["sparse"]:
             matrix = matrix.tocsr()
         return matrix
 
-    def snip(self, matrix, region1, region2, tup):
-        s1, e1, s2, e2 = tup
-        offset1 = self.offsets[region1]
-        offset2 = self.offsets[region2]
-        binsize = self.binsize
-        lo1, hi1 = (s1 // binsize) - offset1, (e1 // binsize) - offset1
-        lo2, hi2 = (s2 // binsize) - offset2, (e2 // binsize) - offset2
-        assert hi1 >= 0
-        assert hi2 >= 0
+    def select_windows(self, region1, region2, spans):
+        """
+        Same as 'select', but only pixels covered by the windows of 'spans'
+        are read from the cooler, into a CSR matrix of the size of the
+        regions. The entire regions are selected, when cooler options other
+        than 'field', 'balance' and 'sparse' are used.
+        """
+        opts = _fetch_opts(self.cooler_opts)
+        if opts is None:
+            return self.select(region1, region2)
+        self.offsets[region1] = self.clr.offset(region1) - self.clr.offset(region1[0])
+        self.offsets[region2] = self.clr.offset(region2) - self.clr.offset(region2[0])
+        self._isnan1 = _bad_bins(self.clr, self._bad_bins, region1)
+        self._isnan2 = _bad_bins(self.clr, self._bad_bins, region2)
+        windows = _window_spans(
+            spans, self.binsize, self.offsets[region1], self.offsets[region2]
+        )
+        return _fetch_windows(self.clr, region1, region2, windows, *opts)
 
+    def snip(self, matrix, region1, region2, tup):
+        return self.snip_batch(matrix, region1, region2, [tup])[0]
+
+    def snip_batch(self, matrix, region1, region2, tups):
+        """
+        Snip all windows at once into a stack of shape (n, h, w). Parts of
+        the windows out of bounds of the regions, and bad bins are NaN.
+        """
+        lo1, lo2, shape = _window_bins(
+            tups, self.binsize, self.offsets[region1], self.offsets[region2]
+        )
+        if self._keys_for is not matrix and sps.issparse(matrix):
+            self._keys, self._keys_for = _csr_keys(matrix), matrix
+        snippets = _gather_windows(
+            matrix, lo1, lo2, shape, self._keys if sps.issparse(matrix) else None
+        )
         m, n = matrix.shape
-        dm, dn = hi1 - lo1, hi2 - lo2
-        out_of_bounds = False
-        pad_left = pad_right = pad_bottom = pad_top = None
-        if lo1 < 0:
-            pad_bottom = -lo1
-            out_of_bounds = True
-        if lo2 < 0:
-            pad_left = -lo2
-            out_of_bounds = True
-        if hi1 > m:
-            pad_top = dm - (hi1 - m)
-            out_of_bounds = True
-        if hi2 > n:
-            pad_right = dn - (hi2 - n)
-            out_of_bounds = True
-
-        if out_of_bounds:
-            i0 = max(lo1, 0)
-            i1 = min(hi1, m)
-            j0 = max(lo2, 0)
-            j1 = min(hi2, n)
-            snippet = np.full((dm, dn), np.nan)
-        #             snippet[pad_bottom:pad_top,
-        #                     pad_left:pad_right] = matrix[i0:i1, j0:j1].toarray()
-        else:
-            snippet = matrix[lo1:hi1, lo2:hi2].toarray()
-            snippet[self._isnan1[lo1:hi1], :] = np.nan
-            snippet[:, self._isnan2[lo2:hi2]] = np.nan
-        return snippet
+        return _mask_windows(
+            snippets,
+            _window_mask(lo1, shape[1], m, self._isnan1),
+            _window_mask(lo2, shape[2], n, self._isnan2),
+        )
 
 
 class ObsExpSnipper:
-    def __init__(self, clr, expected, cooler_opts=None):
+    def __init__(self, clr, expected, cooler_opts=None, max_templates=128):
         self.clr = clr
         self.expected = expected
 
@@ -344,71 +1336,82 @@ class ObsExpSnipper:
         self.pad = True
         self.cooler_opts = {} if cooler_opts is None else cooler_opts
         self.cooler_opts.setdefault("sparse", True)
-
-    def select(self, region1, region2):
+        # pixel keys of the last selected matrix, for batch snipping:
+        self._keys = self._keys_for = None
+        # bad-bin masks of chromosomes:
+        self._bad_bins = {}
+        # windows of expected for diagonal offsets:
+        self._templates = _TemplateCache(max_templates)
+
+    def _select_expected(self, region1, region2):
         assert region1 == region2, "ObsExpSnipper is implemented for cis contacts only."
         self.offsets[region1] = self.clr.offset(region1) - self.clr.offset(region1[0])
         self.offsets[region2] = self.clr.offset(region2) - self.clr.offset(region2[0])
-        matrix = self.clr.matrix(**self.cooler_opts).fetch(region1, region2)
-        if self.cooler_opts["sparse"]:
-            matrix = matrix.tocsr()
-        self._isnan1 = np.isnan(self.clr.bins()["weight"].fetch(region1).values)
-        self._isnan2 = np.isnan(self.clr.bins()["weight"].fetch(region2).values)
-        self._expected = LazyToeplitz(
+        self._isnan1 = _bad_bins(self.clr, self._bad_bins, region1)
+        self._isnan2 = _bad_bins(self.clr, self._bad_bins, region2)
+        # only the values of expected are kept, windows of the Toeplitz
+        # matrix are built when snipping:
+        self._expected_values = (
             self.expected.groupby(self.regions_columns)
             .get_group(region1[0] if len(self.regions_columns) > 0 else region1)[
                 "balanced.avg"
             ]
             .values
         )
+
+    def select(self, region1, region2):
+        self._select_expected(region1, region2)
+        matrix = self.clr.matrix(**self.cooler_opts).fetch(region1, region2)
+        if self.cooler_opts["sparse"]:
+            matrix = matrix.tocsr()
         return matrix
 
-    def snip(self, matrix, region1, region2, tup):
-        s1, e1, s2, e2 = tup
-        offset1 = self.offsets[region1]
-        offset2 = self.offsets[region2]
-        binsize = self.binsize
-        lo1, hi1 = (s1 // binsize) - offset1, (e1 // binsize) - offset1
-        lo2, hi2 = (s2 // binsize) - offset2, (e2 // binsize) - offset2
-        assert hi1 >= 0
-        assert hi2 >= 0
+    def select_windows(self, region1, region2, spans):
+        """
+        Same as 'select', but only pixels covered by the windows of 'spans'
+        are read from the cooler, into a CSR matrix of the size of the
+        regions. The entire regions are selected, when cooler options other
+        than 'field', 'balance' and 'sparse' are used.
+        """
+        opts = _fetch_opts(self.cooler_opts)
+        if opts is None:
+            return self.select(region1, region2)
+        self._select_expected(region1, region2)
+        windows = _window_spans(
+            spans, self.binsize, self.offsets[region1], self.offsets[region2]
+        )
+        return _fetch_windows(self.clr, region1, region2, windows, *opts)
 
+    def snip(self, matrix, region1, region2, tup):
+        return self.snip_batch(matrix, region1, region2, [tup])[0]
+
+    def snip_batch(self, matrix, region1, region2, tups):
+        """
+        Snip all windows at once into a stack of shape (n, h, w) of
+        observed over expected. Parts of the windows out of bounds of the
+        regions, and bad bins are NaN.
+        """
+        lo1, lo2, shape = _window_bins(
+            tups, self.binsize, self.offsets[region1], self.offsets[region2]
+        )
+        if self._keys_for is not matrix and sps.issparse(matrix):
+            self._keys, self._keys_for = _csr_keys(matrix), matrix
+        snippets = _gather_windows(
+            matrix, lo1, lo2, shape, self._keys if sps.issparse(matrix) else None
+        )
         m, n = matrix.shape
-        dm, dn = hi1 - lo1, hi2 - lo2
-        out_of_bounds = False
-        pad_left = pad_right = pad_bottom = pad_top = None
-        if lo1 < 0:
-            pad_bottom = -lo1
-            out_of_bounds = True
-        if lo2 < 0:
-            pad_left = -lo2
-            out_of_bounds = True
-        if hi1 > m:
-            pad_top = dm - (hi1 - m)
-            out_of_bounds = True
-        if hi2 > n:
-            pad_right = dn - (hi2 - n)
-            out_of_bounds = True
-
-        if out_of_bounds:
-            i0 = max(lo1, 0)
-            i1 = min(hi1, m)
-            j0 = max(lo2, 0)
-            j1 = min(hi2, n)
-            return np.full((dm, dn), np.nan)
-        #             snippet[pad_bottom:pad_top,
-        #                     pad_left:pad_right] = matrix[i0:i1, j0:j1].toarray()
-        else:
-            snippet = matrix[lo1:hi1, lo2:hi2].toarray()
-            snippet[self._isnan1[lo1:hi1], :] = np.nan
-            snippet[:, self._isnan2[lo2:hi2]] = np.nan
-
-        e = self._expected[lo1:hi1, lo2:hi2]
-        return snippet / e
+        snippets = _mask_windows(
+            snippets,
+            _window_mask(lo1, shape[1], m, self._isnan1),
+            _window_mask(lo2, shape[2], n, self._isnan2),
+        )
+        return snippets / _expected_windows(
+            self._expected_values, lo1, lo2, shape, self._templates, region1
+        )
 
 
 class ExpectedSnipper:
-    def __init__(self, clr, expected):
+    def __init__(self, clr, expected, max_templates=128):
         self.clr = clr
         self.expected = expected
 
@@ -445,6 +1448,8 @@ class ExpectedSnipper:
 
         self.binsize = self.clr.binsize
         self.offsets = {}
+        # windows of expected for diagonal offsets:
+        self._templates = _TemplateCache(max_templates)
 
     def select(self, region1, region2):
         assert (
@@ -454,28 +1459,31 @@ class ExpectedSnipper:
         self.offsets[region2] = self.clr.offset(region2) - self.clr.offset(region2[0])
         self.m = np.diff(self.clr.extent(region1))
         self.n = np.diff(self.clr.extent(region2))
-        self._expected = LazyToeplitz(
+        self._expected_values = (
             self.expected.groupby(self.regions_columns)
             .get_group(region1[0] if len(self.regions_columns) > 0 else region1)[
                 "balanced.avg"
             ]
             .values
         )
+        self._expected = LazyToeplitz(self._expected_values)
         return self._expected
 
     def snip(self, exp, region1, region2, tup):
-        s1, e1, s2, e2 = tup
-        offset1 = self.offsets[region1]
-        offset2 = self.offsets[region2]
-        binsize = self.binsize
-        lo1, hi1 = (s1 // binsize) - offset1, (e1 // binsize) - offset1
-        lo2, hi2 = (s2 // binsize) - offset2, (e2 // binsize) - offset2
-        assert hi1 >= 0
-        assert hi2 >= 0
-        dm, dn = hi1 - lo1, hi2 - lo2
-
-        if lo1 < 0 or lo2 < 0 or hi1 > self.m or hi2 > self.n:
-            return np.full((dm, dn), np.nan)
-
-        snippet = exp[lo1:hi1, lo2:hi2]
-        return snippet
+        return self.snip_batch(exp, region1, region2, [tup])[0]
+
+    def snip_batch(self, exp, region1, region2, tups):
+        """
+        Snip all windows at once into a stack of shape (n, h, w). Parts of
+        the windows out of bounds of the regions are NaN.
+        """
+        lo1, lo2, shape = _window_bins(
+            tups, self.binsize, self.offsets[region1], self.offsets[region2]
+        )
+        return _mask_windows(
+            _expected_windows(
+                self._expected_values, lo1, lo2, shape, self._templates, region1
+            ),
+            _window_mask(lo1, shape[1], int(self.m)),
+            _window_mask(lo2, shape[2], int(self.n)),
+        )
@@ -0,0 +1,102 @@
+# shared fixtures of the tests:
+
+import numpy as np
+import pandas as pd
+import cooler
+import pytest
+
+
+@pytest.fixture(scope="session")
+def make_synthetic_cooler(tmpdir_factory):
+    """
+    A factory of small synthetic coolers, with a power-law decay of contacts
+    with distance and a few "bad" bins with NaN weights, and optionally
+    domains and "dots" with enriched contacts.
+
+    Example
+    -------
+    >>> clr = make_synthetic_cooler("insulation", seed=11)
+
+    """
+
+    def make(
+        name,
+        binsize=1000,
+        chromsizes=None,
+        bad_bins=None,
+        seed=0,
+        scale=50.0,
+        decay=1.0,
+        weights=(0.5, 1.5),
+        domain_size=None,
+        domain_enrichment=3,
+        dots=None,
+        dot_enrichment=6,
+        empty_bad_bins=False,
+    ):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the temporary directory to write the cooler to.
+        binsize : int
+            Bin size, in bp.
+        chromsizes : pandas.Series
+            Sizes of chromosomes, two short ones by default.
+        bad_bins : dict
+            Bins with NaN weights of every chromosome, relative to its start.
+        seed : int
+            Seed of random weights and counts.
+        scale, decay : float
+            The expected count at a distance of s bins is
+            scale / (1 + s) ** decay.
+        weights : tuple
+            Range of uniformly distributed balancing weights.
+        domain_size : int or None
+            Size, in bins, of back-to-back domains with contacts
+            enriched 'domain_enrichment' times.
+        dots : dict or None
+            Positions (i, j) of "dots" of every chromosome, relative to its
+            start, with 3x3 pixels enriched 'dot_enrichment' times.
+        empty_bad_bins : bool
+            No contacts in the rows and the columns of bad bins.
+
+        """
+        if chromsizes is None:
+            chromsizes = pd.Series({"chr1": 120000, "chr2": 80000})
+        if bad_bins is None:
+            bad_bins = {"chr1": [0, 7, 8, 60], "chr2": [30, 79]}
+        rng = np.random.RandomState(seed)
+        bins = cooler.binnify(chromsizes, binsize)
+        bins["weight"] = rng.uniform(*weights, len(bins))
+        pixel_chunks = []
+        offset = 0
+        for chrom in chromsizes.index:
+            n = int(np.ceil(chromsizes[chrom] / binsize))
+            i, j = np.triu_indices(n)
+            lam = scale / (1.0 + j - i) ** decay
+            if domain_size is not None:
+                lam[(i // domain_size) == (j // domain_size)] *= domain_enrichment
+            for (di, dj) in (dots or {}).get(chrom, []):
+                lam[(np.abs(i - di) <= 1) & (np.abs(j - dj) <= 1)] *= dot_enrichment
+            counts = rng.poisson(lam)
+            if empty_bad_bins:
+                is_bad = np.isin(i, bad_bins[chrom]) | np.isin(j, bad_bins[chrom])
+                counts[is_bad] = 0
+            keep = counts > 0
+            pixel_chunks.append(
+                pd.DataFrame(
+                    {
+                        "bin1_id": i[keep] + offset,
+                        "bin2_id": j[keep] + offset,
+                        "count": counts[keep],
+                    }
+                )
+            )
+            bins.loc[np.array(bad_bins[chrom]) + offset, "weight"] = np.nan
+            offset += n
+        path = str(tmpdir_factory.mktemp(name).join("synthetic.cool"))
+        cooler.create_cooler(path, bins, pd.concat(pixel_chunks, ignore_index=True))
+        return cooler.Cooler(path)
+
+    return make
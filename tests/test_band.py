@@ -0,0 +1,116 @@
+# test the band matrix of a small synthetic Hi-C map:
+
+import numpy as np
+import pytest
+
+from cooltools import directionality, insulation
+from cooltools.lib import BandMatrix
+from cooltools.lib._query import CSRSelector
+
+
+@pytest.fixture(scope="module")
+def synthetic(make_synthetic_cooler):
+    return make_synthetic_cooler("band", seed=7)
+
+
+@pytest.mark.parametrize("balance", ["weight", True, False])
+def test_band_matrix(synthetic, tmpdir, balance):
+    clr = synthetic
+    path = str(tmpdir.join("band.npy"))
+    band = BandMatrix.from_cooler(clr, "chr2", max_diag=12, balance=balance, path=path)
+    assert band.data.dtype == (np.float32 if balance else np.int32)
+    mat = clr.matrix(balance=balance).fetch("chr2")
+    N = len(mat)
+    assert band.shape == mat.shape
+
+    # the band is reused from the disk:
+    band = BandMatrix.load(path)
+    for d in [0, 1, 12]:
+        assert np.allclose(band.diag(d), np.diagonal(mat, d), equal_nan=True)
+    with pytest.raises(IndexError):
+        band.diag(13)
+
+    i = np.arange(N)
+    for k in [0, 29, 40, N - 1]:
+        cols = np.arange(k - 4, k + 5)
+        expected = np.where(
+            (cols >= 0) & (cols < N), mat[k, np.clip(cols, 0, N - 1)], np.nan
+        )
+        assert np.allclose(band.row_window(k, 5), expected, equal_nan=True)
+
+    dense = band.dense(10, 40)
+    in_band = np.abs(i[10:40, None] - i[None, 10:40]) <= 12
+    assert np.allclose(dense[in_band], mat[10:40, 10:40][in_band], equal_nan=True)
+    assert np.isnan(dense[~in_band]).all()
+
+
+def test_band_matrix_short_region(synthetic):
+    clr = synthetic
+    # a region of 8 bins, shorter than the band:
+    region = "chr2:10000-18000"
+    band = BandMatrix.from_cooler(clr, region, max_diag=20)
+    mat = clr.matrix(balance=True).fetch(region)
+    N = len(mat)
+    assert N == 8
+    for d in range(N):
+        assert np.allclose(band.diag(d), np.diagonal(mat, d), equal_nan=True)
+        assert np.isnan(band.data[d, N - d :]).all()
+    for d in [N, 10, 20]:
+        assert len(band.diag(d)) == 0
+        assert np.isnan(band.data[d]).all()
+    assert np.allclose(band.dense(0, N), mat, equal_nan=True)
+
+    # sums over windows and diamonds reaching past the end of the region:
+    sums_up, sums_down = band.row_window_sums(10)
+    assert np.allclose(sums_up, np.nansum(np.tril(mat), axis=1))
+    assert np.allclose(sums_down, np.nansum(np.triu(mat), axis=1))
+    sums, n_valid = band.diamond_sums(6)
+    for k in range(N):
+        diamond = mat[max(k - 5, 0) : k + 1, k : k + 6]
+        assert np.isclose(sums[k], np.nansum(diamond))
+        assert n_valid[k] == np.isfinite(diamond).sum()
+
+
+def test_band_matrix_sums(synthetic):
+    clr = synthetic
+    band = BandMatrix.from_cooler(clr, "chr1", max_diag=20)
+    bins = clr.bins().fetch("chr1")
+    c0, c1 = clr.extent("chr1")
+
+    # diamonds are the same as in insulation, also when insulation is
+    # calculated from the band:
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", 1000)
+    windows = [1, 5, 11]
+    for ignore_diags in [0, 2, 3]:
+        diamonds = insulation.insul_diamonds(
+            selector[c0:c1, c0:c1], bins, windows=windows, ignore_diags=ignore_diags
+        )
+        band_diamonds = insulation.insul_diamonds(
+            band, bins, windows=windows, ignore_diags=ignore_diags
+        )
+        for window, (score, n_pixels, sum_balanced, _), band_diamond in zip(
+            windows, diamonds, band_diamonds
+        ):
+            sums, n_valid = band.diamond_sums(window, ignore_diags)
+            assert np.allclose(sums, sum_balanced)
+            assert np.array_equal(n_valid, n_pixels)
+            assert np.allclose(band_diamond[0], score, equal_nan=True)
+            assert np.array_equal(band_diamond[1], n_pixels)
+            assert np.allclose(band_diamond[2], sum_balanced)
+            assert np.isnan(band_diamond[3]).all()
+    with pytest.raises(ValueError):
+        band.diamond_sums(12)
+    with pytest.raises(ValueError):
+        insulation.insul_diamond(band, bins, window=12)
+    with pytest.raises(ValueError):
+        insulation.insul_diamond(band, bins.iloc[1:], window=5)
+
+    # upstream and downstream sums are the same as in directionality:
+    pixels = clr.matrix(as_pixels=True, balance=True).fetch("chr1")
+    for window, ignore_diags in [(1, 0), (8, 2)]:
+        sums_up, sums_down = band.row_window_sums(window, ignore_diags)
+        expected = directionality.dirscore(pixels, bins, window, ignore_diags)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            score = (sums_down - sums_up) / (sums_up + sums_down)
+        assert np.allclose(score, expected, equal_nan=True)
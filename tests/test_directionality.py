@@ -0,0 +1,109 @@
+# test the directionality of a small synthetic Hi-C map:
+
+import subprocess
+import sys
+
+import multiprocess as mp
+import numpy as np
+import pandas as pd
+import pytest
+
+from cooltools import directionality
+
+
+@pytest.fixture(scope="module")
+def synthetic(make_synthetic_cooler):
+    # domains of 20 bins with enriched contacts:
+    return make_synthetic_cooler("directionality", seed=13, domain_size=20)
+
+
+@pytest.mark.parametrize("window,ignore_diags", [(1, 0), (5, 1), (12, 2)])
+def test_dirscore(synthetic, window, ignore_diags):
+    clr = synthetic
+    bins = clr.bins().fetch("chr1")
+    pixels = clr.matrix(as_pixels=True, balance=True).fetch("chr1")
+    score = directionality.dirscore(pixels, bins, window, ignore_diags)
+
+    # brute-force upstream and downstream sums of the dense matrix:
+    mat = np.nan_to_num(clr.matrix(balance=True).fetch("chr1"))
+    N = len(mat)
+    a, b = np.zeros(N), np.zeros(N)
+    for k in range(N):
+        a[k] = sum(mat[k - s, k] for s in range(ignore_diags, window) if k >= s)
+        b[k] = sum(mat[k, k + s] for s in range(ignore_diags, window) if k + s < N)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        expected = (b - a) / (a + b)
+    assert np.allclose(score, expected, equal_nan=True)
+
+
+def test_directionality(synthetic):
+    clr = synthetic
+    windows = [5000, 2000, 12000]
+    dir_table = directionality.directionality(clr, windows, ignore_diags=2)
+    assert list(dir_table["chrom"].unique()) == clr.chromnames
+    assert len(dir_table) == len(clr.bins())
+
+    # all the windows from one read are the same as a window at a time,
+    # and the same as dirscore of the pixels of the whole chromosome
+    # (numpy integers are single windows as well):
+    pool = mp.Pool(2)
+    try:
+        for window in np.array(windows):
+            single = directionality.directionality(
+                clr, window, ignore_diags=2, map=pool.imap_unordered
+            )
+            for key in ["directionality_ratio", "directionality_index"]:
+                col = "{}_{}".format(key, window)
+                assert np.allclose(dir_table[col], single[col], equal_nan=True)
+    finally:
+        pool.close()
+
+    for chrom in clr.chromnames:
+        bins = clr.bins().fetch(chrom)
+        pixels = clr.matrix(as_pixels=True, balance=True).fetch(chrom)
+        expected = directionality.dirscore(pixels, bins, 5, 2, signed_chi2=True)
+        expected[
+            dir_table["bad_bin_masked"][dir_table["chrom"] == chrom].values
+        ] = np.nan
+        expected[~np.isfinite(expected)] = np.nan
+        result = dir_table["directionality_index_5000"][dir_table["chrom"] == chrom]
+        assert np.allclose(result, expected, equal_nan=True)
+
+
+def test_compute_directionality_cli(synthetic, tmpdir):
+    out_path = str(tmpdir.join("directionality.tsv"))
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "cooltools",
+            "compute-directionality",
+            synthetic.uri,
+            "2",
+            "10",
+            "--window-pixels",
+            "--ignore-diags",
+            "2",
+            "--nproc",
+            "2",
+            "-o",
+            out_path,
+        ]
+    )
+    dir_table = pd.read_table(out_path)
+    expected = directionality.directionality(synthetic, [2000, 10000], ignore_diags=2)
+    assert list(dir_table.columns) == list(expected.columns)
+    assert np.allclose(
+        dir_table["directionality_ratio_10000"],
+        expected["directionality_ratio_10000"],
+        equal_nan=True,
+    )
+
+    # at least one window is required:
+    result = subprocess.run(
+        [sys.executable, "-m", "cooltools", "compute-directionality", synthetic.uri],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert result.returncode != 0
+    assert b"WINDOW" in result.stderr
@@ -111,3 +111,33 @@ def test_adjusted_expected_tile_some_nans():
 
     # now we can only guess the size:
     assert len(res) > len(mock_res)
+
+
+def test_kernel_bank_matches_convolve():
+    from scipy.ndimage import convolve
+    from cooltools.dotfinder import KernelBank, get_kernel
+
+    ktypes = ["donut", "vertical", "horizontal", "lowleft"]
+    kernels = {k: get_kernel(3, 1, k) for k in ktypes}
+    # kernels of different sizes and with arbitrary weights:
+    kernels["wide_donut"] = get_kernel(5, 2, "donut")
+    kernels["random"] = np.random.RandomState(1).randint(-2, 3, size=(5, 5))
+    bank = KernelBank(kernels)
+    assert set(bank) == set(kernels)
+
+    rng = np.random.RandomState(0)
+    O_bal = rng.uniform(0, 10, size=(37, 45))
+    E_bal = rng.uniform(1, 5, size=(37, 45))
+    N_bal = rng.uniform(size=(37, 45)) < 0.1
+    O_bal[N_bal] = 0.0
+    E_bal[N_bal] = 0.0
+
+    convolved = bank.convolve(O_bal, E_bal, N_bal)
+    for name, kernel in kernels.items():
+        KO, KE, NN = convolved[name]
+        assert np.allclose(KO, convolve(O_bal, kernel, mode="constant", cval=0.0))
+        assert np.allclose(KE, convolve(E_bal, kernel, mode="constant", cval=0.0))
+        footprint = (kernel != 0).astype(int)
+        assert np.array_equal(
+            NN, convolve(N_bal.astype(int), footprint, mode="constant", cval=1)
+        )
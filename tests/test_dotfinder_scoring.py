@@ -0,0 +1,246 @@
+# test the step-functions of dotfinder on a small synthetic Hi-C map:
+
+import numpy as np
+import pandas as pd
+import cooler
+import pytest
+
+from cooltools import dotfinder
+
+
+# synthetic map parameters:
+binsize = 10000
+chromsizes = pd.Series({"chr1": 1500000, "chr2": 1200000})
+bad_bins = {"chr1": [30, 31, 100], "chr2": [5, 77]}
+dots = {"chr1": [(20, 35), (60, 80), (110, 130)], "chr2": [(40, 52), (90, 101)]}
+w, p = 3, 1
+ktypes = ["donut", "vertical", "horizontal", "lowleft"]
+
+
+def make_expected(clr):
+    """
+    Average balanced contacts per diagonal, indexed by chrom and diag.
+    """
+    exp_tables = []
+    for chrom in clr.chromnames:
+        mat = clr.matrix(balance=True).fetch(chrom)
+        n = len(mat)
+        avg = [np.nanmean(np.diagonal(mat, d)) for d in range(n)]
+        exp_tables.append(
+            pd.DataFrame({"chrom": chrom, "diag": np.arange(n), "balanced.avg": avg})
+        )
+    return pd.concat(exp_tables).set_index(["chrom", "diag"])
+
+
+@pytest.fixture(scope="module")
+def synthetic(make_synthetic_cooler):
+    clr = make_synthetic_cooler(
+        "dotfinder",
+        binsize=binsize,
+        chromsizes=chromsizes,
+        bad_bins=bad_bins,
+        seed=17,
+        scale=2000.0,
+        decay=1.1,
+        weights=(0.8, 1.2),
+        dots=dots,
+        empty_bad_bins=True,
+    )
+    expected = make_expected(clr)
+    kernels = {k: dotfinder.get_kernel(w, p, k) for k in ktypes}
+    band = 60
+    tiles = list(
+        dotfinder.heatmap_tiles_generator_diag(clr, clr.chromnames, w, 40, band)
+    )
+    return clr, expected, kernels, tiles, band
+
+
+def test_ordered_pixel_chunks():
+    tiles = [
+        ("chr1", (0, 10), (0, 10)),
+        ("chr1", (0, 10), (8, 20)),
+        ("chr1", (8, 20), (8, 20)),
+        ("chr1", (18, 30), (18, 30)),
+    ]
+    rng = np.random.RandomState(0)
+    chunks = []
+    for _, tilei, tilej in tiles:
+        i = rng.randint(*tilei, size=30)
+        j = rng.randint(*tilej, size=30)
+        chunks.append(pd.DataFrame({"bin1_id": i, "bin2_id": j, "count": i + j}))
+    # complete the tiles in a shuffled order:
+    order = rng.permutation(len(tiles))
+    out = list(
+        dotfinder.ordered_pixel_chunks(tiles, ((k, chunks[k]) for k in order))
+    )
+    result = pd.concat(out, ignore_index=True)
+    expected = (
+        pd.concat(chunks)
+        .drop_duplicates(subset=["bin1_id", "bin2_id"])
+        .sort_values(["bin1_id", "bin2_id"])
+        .reset_index(drop=True)
+    )
+    # bin1-major order across all the chunks:
+    assert pd.MultiIndex.from_frame(result[["bin1_id", "bin2_id"]]).is_monotonic
+    assert result.equals(expected)
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_scoring_step_ordered_cooler_output(synthetic, tmpdir, nproc):
+    clr, expected, kernels, tiles, band = synthetic
+    args = (clr, expected, "balanced.avg", "weight", tiles, kernels, 1, band)
+    local = dotfinder.scoring_step(*args, None, 1, "local", False)
+    local = (
+        local.drop_duplicates(subset=["bin1_id", "bin2_id"])
+        .sort_values(["bin1_id", "bin2_id"])
+        .reset_index(drop=True)
+    )
+
+    out_path = str(tmpdir.join("scores.cool"))
+    dotfinder.scoring_step(*args, out_path, nproc, "cooler", False)
+    scores = cooler.Cooler(out_path).pixels()[:]
+
+    assert scores[["bin1_id", "bin2_id"]].equals(local[["bin1_id", "bin2_id"]])
+    assert np.allclose(scores["count"], local["count"])
+    for k in kernels:
+        assert np.allclose(
+            scores["la_exp." + k + ".value"], local["la_exp." + k + ".value"]
+        )
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_scoring_step_band_reads(synthetic, tmpdir, monkeypatch, nproc):
+    clr, expected, kernels, tiles, band = synthetic
+    # log band reads to a file, to count the ones of worker processes too:
+    log_path = str(tmpdir.join("reads.log"))
+    read_band = dotfinder.TileReader._read_band
+
+    def logged_read_band(self, *args):
+        with open(log_path, "a") as f:
+            f.write("{}\n".format(args))
+        return read_band(self, *args)
+
+    monkeypatch.setattr(dotfinder.TileReader, "_read_band", logged_read_band)
+    args = (clr, expected, "balanced.avg", "weight", tiles, kernels, 1, band)
+    out_path = str(tmpdir.join("scores.cool"))
+    dotfinder.scoring_step(*args, out_path, nproc, "cooler", False)
+    with open(log_path) as f:
+        n_reads = len(f.readlines())
+    # one band read per stripe of tiles:
+    n_stripes = len({(chrom, tilei) for chrom, tilei, _ in tiles})
+    assert n_reads == n_stripes
+
+
+def test_tile_reader(synthetic):
+    clr, expected, kernels, tiles, band = synthetic
+    reader = dotfinder.TileReader(clr, max_span=band)
+    for chrom, tilei, tilej in tiles:
+        tile = reader[slice(*tilei), slice(*tilej)]
+        observed = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
+        # only the upper triangle is read:
+        i, j = np.indices(observed.shape)
+        upper = (i + tilei[0]) <= (j + tilej[0])
+        assert np.array_equal(tile[upper], observed[upper])
+        assert not tile[~upper].any()
+
+    # scores do not depend on the way tiles are read:
+    args = (clr, expected, "balanced.avg", "weight", kernels, 1, band, None, False)
+    for tile in tiles:
+        scores = dotfinder.score_tile(tile, *args)
+        assert scores.equals(dotfinder.score_tile(tile, *args, tile_reader=reader))
+
+
+def test_spilled_extraction_and_postprocessing(synthetic, tmpdir):
+    clr, expected, kernels, tiles, band = synthetic
+    ledges = np.r_[-np.inf, np.logspace(0, 39, num=40, base=2 ** (1 / 3)), np.inf]
+    args = (clr, expected, "balanced.avg", "weight", tiles, kernels, ledges)
+    gw_hist = dotfinder.scoring_and_histogramming_step(*args, 1, band, 1, False)
+    thresholds, qvalues = dotfinder.determine_thresholds(kernels, ledges, gw_hist, 0.2)
+    args = args + (thresholds, 1, None, band)
+
+    # in-memory extraction and post-processing:
+    pixels = dotfinder.scoring_and_extraction_step(*args, None, 1, False)
+    pixels = dotfinder.annotate_pixels_with_qvalues(pixels, qvalues, kernels)
+    pixels = cooler.annotate(pixels, clr.bins()[:])
+    centroids = dotfinder.clustering_step(pixels, clr.chromnames, 39000, False)
+
+    # extraction spilled to disk and post-processed chromosome by chromosome:
+    spill_path = str(tmpdir.join("pixels.h5"))
+    output_path = str(tmpdir.join("pixels.tsv"))
+    assert spill_path == dotfinder.scoring_and_extraction_step(
+        *args, output_path, 2, False, spill_path=spill_path
+    )
+    spilled = pd.read_csv(output_path, sep="\t")
+    assert len(spilled) == len(pixels)
+    spilled_centroids = dotfinder.postprocessing_step(
+        spill_path, clr, clr.chromnames, qvalues, kernels, 39000, False
+    )
+
+    key = ["chrom1", "start1", "start2"]
+    centroids = centroids.sort_values(key).reset_index(drop=True)
+    spilled_centroids = spilled_centroids.sort_values(key).reset_index(drop=True)
+    assert len(centroids) > 0
+    assert centroids[key].equals(spilled_centroids[key])
+    assert np.allclose(centroids["c_size"], spilled_centroids["c_size"])
+
+
+def test_spilled_extraction_no_pixels(synthetic, tmpdir):
+    clr, expected, kernels, tiles, band = synthetic
+    ledges = np.r_[-np.inf, np.logspace(0, 39, num=40, base=2 ** (1 / 3)), np.inf]
+    args = (clr, expected, "balanced.avg", "weight", tiles, kernels, ledges)
+    gw_hist = dotfinder.scoring_and_histogramming_step(*args, 1, band, 1, False)
+    thresholds, qvalues = dotfinder.determine_thresholds(kernels, ledges, gw_hist, 0.2)
+    # reference centroids, with pixels passing the filters:
+    pixels = dotfinder.scoring_and_extraction_step(
+        *args, thresholds, 1, None, band, None, 1, False
+    )
+    columns = list(pixels.columns)
+    pixels = dotfinder.annotate_pixels_with_qvalues(pixels, qvalues, kernels)
+    pixels = cooler.annotate(pixels, clr.bins()[:])
+    centroids = dotfinder.clustering_step(pixels, clr.chromnames, 39000, False)
+
+    # no pixel passes infinite thresholds:
+    thresholds = {k: thresholds[k] * np.inf for k in kernels}
+    spill_path = str(tmpdir.join("pixels.h5"))
+    output_path = str(tmpdir.join("pixels.tsv"))
+    dotfinder.scoring_and_extraction_step(
+        *args, thresholds, 1, None, band, output_path, 1, False, spill_path=spill_path
+    )
+    spilled = pd.read_csv(output_path, sep="\t")
+    assert len(spilled) == 0
+    assert list(spilled.columns) == columns
+    empty_centroids = dotfinder.postprocessing_step(
+        spill_path, clr, clr.chromnames, qvalues, kernels, 39000, False
+    )
+    assert len(empty_centroids) == 0
+    assert list(empty_centroids.columns) == list(centroids.columns)
+
+    # no tiles to score at all:
+    args = (clr, expected, "balanced.avg", "weight", [], kernels, ledges)
+    dotfinder.scoring_and_extraction_step(
+        *args, thresholds, 1, None, band, output_path, 1, False, spill_path=spill_path
+    )
+    spilled = pd.read_csv(output_path, sep="\t")
+    assert len(spilled) == 0
+    assert list(spilled.columns) == columns
+    empty_centroids = dotfinder.postprocessing_step(
+        spill_path, clr, clr.chromnames, qvalues, kernels, 39000, False
+    )
+    assert len(empty_centroids) == 0
+    assert list(empty_centroids.columns) == list(centroids.columns)
+
+
+def test_groupwise_argmax():
+    rng = np.random.RandomState(3)
+    df = pd.DataFrame(
+        {
+            "chrom": rng.choice(["chr2", "chr10", "chrX"], 5000),
+            "label": rng.randint(0, 300, 5000),
+            # plenty of ties:
+            "count": rng.randint(0, 10, 5000),
+        }
+    )
+    expected = df.groupby(["chrom", "label"])["count"].idxmax().values
+    chrom_codes = pd.factorize(df["chrom"], sort=True)[0]
+    result = dotfinder.groupwise_argmax(df["count"].values, chrom_codes, df["label"])
+    assert np.array_equal(df.index[result], expected)
@@ -0,0 +1,290 @@
+# test the insulation score on a small synthetic Hi-C map:
+
+import subprocess
+import sys
+
+import multiprocess as mp
+import numpy as np
+import pandas as pd
+import pytest
+
+from cooltools import insulation
+from cooltools.lib import numutils, peaks
+from cooltools.lib._query import CSRSelector
+
+
+@pytest.fixture(scope="module")
+def synthetic(make_synthetic_cooler):
+    return make_synthetic_cooler("insulation", seed=11)
+
+
+@pytest.mark.parametrize("window,ignore_diags", [(1, 0), (4, 1), (10, 2), (3, 5)])
+def test_insul_diamond(synthetic, window, ignore_diags):
+    clr = synthetic
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", 777)
+    for chrom in clr.chromnames:
+        lo, hi = clr.extent(chrom)
+        bins = clr.bins()[lo:hi]
+        score, n_pixels, sum_balanced, sum_counts = insulation.insul_diamond(
+            selector[lo:hi, lo:hi],
+            bins,
+            window=window,
+            ignore_diags=ignore_diags,
+            norm_by_median=False,
+        )
+
+        # brute-force sums over the diamonds of the dense matrices:
+        raw = clr.matrix(balance=False).fetch(chrom).astype(float)
+        balanced = clr.matrix(balance=True).fetch(chrom)
+        N = len(raw)
+        i, j = np.indices((N, N))
+        expected = np.zeros((3, N))
+        for k in range(N):
+            rows = (i <= k) & (i > k - window)
+            cols = (j >= k) & (j < k + window)
+            diamond = rows & cols & (j - i >= ignore_diags)
+            expected[0, k] = np.isfinite(balanced[diamond]).sum()
+            expected[1, k] = np.nansum(balanced[diamond])
+            expected[2, k] = raw[diamond].sum()
+
+        assert np.array_equal(n_pixels, expected[0])
+        assert np.allclose(sum_balanced, expected[1])
+        assert np.allclose(sum_counts, expected[2])
+        with np.errstate(invalid="ignore"):
+            assert np.allclose(score, expected[1] / expected[0], equal_nan=True)
+
+        # the dense implementation agrees as well:
+        dense = insulation._insul_diamond_dense(
+            balanced, window, ignore_diags, norm_by_median=False
+        )
+        assert np.allclose(score, dense, equal_nan=True)
+
+
+def test_calculate_insulation_score(synthetic):
+    clr = synthetic
+    windows = [3000, 10000, 5000]
+    ins_table = insulation.calculate_insulation_score(
+        clr, windows, ignore_diags=2, append_raw_scores=True
+    )
+    assert len(ins_table) == len(clr.bins())
+    # all the windows from one read are the same as one window at a time:
+    for window in windows:
+        single = insulation.calculate_insulation_score(
+            clr, window, ignore_diags=2, append_raw_scores=True
+        )
+        for key in [
+            "log2_insulation_score",
+            "n_valid_pixels",
+            "sum_counts",
+            "sum_balanced",
+        ]:
+            col = "{}_{}".format(key, window)
+            assert np.allclose(ins_table[col], single[col], equal_nan=True)
+
+
+def test_calculate_insulation_score_nproc(synthetic):
+    clr = synthetic
+    windows = [3000, 10000]
+    ins_table = insulation.calculate_insulation_score(clr, windows, ignore_diags=2)
+    pool = mp.Pool(2)
+    try:
+        ins_table_mp = insulation.calculate_insulation_score(
+            clr, windows, ignore_diags=2, map=pool.imap_unordered
+        )
+    finally:
+        pool.close()
+    # results are in genome order, regardless of the order of completion:
+    assert ins_table_mp.index.equals(ins_table.index)
+    assert ins_table_mp.equals(ins_table)
+
+
+def test_diamond_insulation_cli(synthetic, tmpdir):
+    out_path = str(tmpdir.join("insulation.tsv"))
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "cooltools",
+            "diamond-insulation",
+            synthetic.uri,
+            "3000",
+            "10000",
+            "--ignore-diags",
+            "2",
+            "--nproc",
+            "2",
+            "-o",
+            out_path,
+        ]
+    )
+    ins_table = pd.read_table(out_path)
+    assert list(ins_table["chrom"].unique()) == synthetic.chromnames
+    assert len(ins_table) == len(synthetic.bins())
+    assert "log2_insulation_score_10000" in ins_table.columns
+
+
+def test_iter_insulation_boundaries(synthetic):
+    clr = synthetic
+    windows = [3000, 10000]
+    ins_table = insulation.calculate_insulation_score(clr, windows, ignore_diags=2)
+    ins_table = insulation.find_boundaries(
+        ins_table, min_frac_valid_pixels=0.9, min_dist_bad_bin=2
+    )
+    ins_chroms = list(
+        insulation.iter_insulation_boundaries(
+            clr,
+            windows,
+            ignore_diags=2,
+            min_frac_valid_pixels=0.9,
+            min_dist_bad_bin=2,
+        )
+    )
+    # one table per chromosome, with the genome-wide thresholds:
+    assert [df["chrom"].iloc[0] for df in ins_chroms] == clr.chromnames
+    result = pd.concat(ins_chroms)
+    assert result.reset_index(drop=True).equals(ins_table.reset_index(drop=True))
+
+    # largest chromosomes are submitted first, and tables completed out of
+    # order are still yielded in genome order:
+    submitted = []
+
+    def reversed_map(func, chroms):
+        submitted.extend(chroms)
+        return reversed([func(chrom) for chrom in submitted])
+
+    ins_chroms = list(
+        insulation.iter_insulation_boundaries(
+            clr,
+            windows,
+            ignore_diags=2,
+            min_frac_valid_pixels=0.9,
+            min_dist_bad_bin=2,
+            map=reversed_map,
+        )
+    )
+    assert submitted == sorted(clr.chromnames, key=lambda c: -clr.chromsizes[c])
+    result = pd.concat(ins_chroms)
+    assert result.reset_index(drop=True).equals(ins_table.reset_index(drop=True))
+
+
+def test_diamond_insulation_cli_parquet(synthetic, tmpdir):
+    pytest.importorskip("pyarrow")
+    tsv_path = str(tmpdir.join("insulation.tsv"))
+    parquet_path = str(tmpdir.join("insulation.parquet"))
+    for out_path, out_format in [(tsv_path, "tsv"), (parquet_path, "parquet")]:
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-m",
+                "cooltools",
+                "diamond-insulation",
+                synthetic.uri,
+                "3000",
+                "--ignore-diags",
+                "2",
+                "--output-format",
+                out_format,
+                "-o",
+                out_path,
+            ]
+        )
+    ins_table = pd.read_table(tsv_path)
+    ins_table_parquet = pd.read_parquet(parquet_path)
+    assert list(ins_table_parquet.columns) == list(ins_table.columns)
+    assert np.allclose(
+        ins_table_parquet["log2_insulation_score_3000"],
+        ins_table["log2_insulation_score_3000"],
+        equal_nan=True,
+    )
+
+
+def test_diamond_insulation_cli_bigwig(synthetic, tmpdir):
+    pyBigWig = pytest.importorskip("pyBigWig")
+    tsv_path = str(tmpdir.join("insulation.tsv"))
+    bw_prefix = str(tmpdir.join("insulation"))
+    for out_path, out_format in [(tsv_path, "tsv"), (bw_prefix, "bigwig")]:
+        subprocess.check_call(
+            [
+                sys.executable,
+                "-m",
+                "cooltools",
+                "diamond-insulation",
+                synthetic.uri,
+                "3000",
+                "--ignore-diags",
+                "2",
+                "--output-format",
+                out_format,
+                "-o",
+                out_path,
+            ]
+        )
+    ins_table = pd.read_table(tsv_path)
+    for col in ["log2_insulation_score_3000", "boundary_strength_3000"]:
+        bw = pyBigWig.open("{}.{}.bw".format(bw_prefix, col))
+        try:
+            assert bw.chroms() == dict(synthetic.chromsizes)
+            # one interval per bin with a finite value:
+            for chrom, df in ins_table.groupby("chrom", sort=False):
+                df = df[np.isfinite(df[col])]
+                intervals = np.array(bw.intervals(chrom) or []).reshape(-1, 3)
+                assert np.array_equal(intervals[:, 0], df["start"])
+                assert np.array_equal(intervals[:, 1], df["end"])
+                assert np.allclose(intervals[:, 2], df[col])
+        finally:
+            bw.close()
+
+
+def test_find_peak_prominence_2d():
+    rng = np.random.RandomState(0)
+    arrs = np.vstack([rng.randn(5, 300), rng.randint(0, 5, (5, 300))])
+    arrs[rng.rand(*arrs.shape) < 0.2] = np.nan
+    for max_dist in [None, 7]:
+        proms = peaks.find_peak_prominence_2d(arrs, max_dist=max_dist)
+        for arr, prom in zip(arrs, proms):
+            poss, expected = peaks.find_peak_prominence(arr, max_dist=max_dist)
+            expected_prom = np.full(len(arr), np.nan)
+            expected_prom[poss] = expected
+            assert np.allclose(prom, expected_prom, equal_nan=True)
+
+
+def test_sweep_boundaries(synthetic):
+    clr = synthetic
+    windows = [3000, 10000]
+    ins_table = insulation.calculate_insulation_score(clr, windows, ignore_diags=2)
+    fracs = [0.5, 0.9]
+    swept = insulation.sweep_boundaries(ins_table, fracs, min_dist_bad_bin=1)
+    for frac in fracs:
+        result = insulation.find_boundaries(
+            ins_table, min_frac_valid_pixels=frac, min_dist_bad_bin=1
+        )
+        assert swept[frac].equals(result)
+
+        # prominences of the tracks with the masked bins dropped:
+        for window in windows:
+            n_valid_pixels = ins_table["n_valid_pixels_{}".format(window)]
+            for chrom, df in result.groupby("chrom"):
+                mask = n_valid_pixels[ins_table["chrom"] == chrom].values >= (
+                    n_valid_pixels.max() * frac
+                )
+                mask &= numutils.dist_to_mask(df["is_bad_bin"]) >= 1
+                track = df["log2_insulation_score_{}".format(window)].values
+                poss, proms = peaks.find_peak_prominence(-track[mask])
+                expected = np.full(mask.sum(), np.nan)
+                expected[poss] = proms
+                strength = df["boundary_strength_{}".format(window)].values
+                assert np.allclose(strength[mask], expected, equal_nan=True)
+                assert np.isnan(strength[~mask]).all()
+
+    # the mask of bad bins can be read from a differently named column:
+    renamed = ins_table.rename(columns={"is_bad_bin": "bad"})
+    swept_renamed = insulation.sweep_boundaries(
+        renamed, fracs, min_dist_bad_bin=1, is_bad_bin_key="bad"
+    )
+    for frac in fracs:
+        assert (
+            swept_renamed[frac]
+            .drop(columns="bad")
+            .equals(swept[frac].drop(columns="is_bad_bin"))
+        )
@@ -0,0 +1,128 @@
+# test 2D range queries of the pixels of a small synthetic cooler:
+
+import threading
+
+import numpy as np
+import pandas as pd
+import cooler
+import pytest
+
+from cooltools.lib._query import CSRSelector
+
+
+@pytest.fixture(scope="module")
+def clr(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp("query").join("synthetic.cool"))
+    rng = np.random.RandomState(3)
+    bins = cooler.binnify(pd.Series({"chr1": 200000, "chr2": 100000}), 1000)
+    i, j = np.triu_indices(len(bins))
+    counts = rng.poisson(20.0 / (1.0 + j - i))
+    # a few empty rows, too:
+    keep = (counts > 0) & ~np.isin(i, [0, 5, 6, 150])
+    pixels = pd.DataFrame(
+        {"bin1_id": i[keep], "bin2_id": j[keep], "count": counts[keep]}
+    )
+    cooler.create_cooler(path, bins, pixels)
+    return cooler.Cooler(path)
+
+
+@pytest.mark.parametrize(
+    "ispan,jspan,chunksize",
+    [((0, 300), (0, 300), 1000), ((3, 120), (40, 170), 50), ((7, 8), (0, 300), 10)],
+)
+def test_csr_selector(clr, ispan, jspan, chunksize):
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", chunksize)
+    query = selector[slice(*ispan), slice(*jspan)]
+
+    pixels = clr.pixels()[:]
+    pixels["__index"] = np.arange(len(pixels))
+    pixels = pixels[
+        (pixels["bin1_id"] >= ispan[0])
+        & (pixels["bin1_id"] < ispan[1])
+        & (pixels["bin2_id"] >= jspan[0])
+        & (pixels["bin2_id"] < jspan[1])
+    ]
+
+    chunks = list(query.read_chunked(include_index=True))
+    for chunk in chunks:
+        assert list(chunk) == ["bin1_id", "bin2_id", "count", "__index"]
+        assert chunk["bin1_id"].dtype == pixels["bin1_id"].dtype
+    for key in ["bin1_id", "bin2_id", "count", "__index"]:
+        result = np.concatenate([chunk[key] for chunk in chunks])
+        assert np.array_equal(result, pixels[key].values)
+
+    result = query.read()
+    assert list(result) == ["bin1_id", "bin2_id", "count"]
+    assert np.array_equal(result["count"], pixels["count"].values)
+
+
+@pytest.mark.parametrize(
+    "lo,hi,max_diag,max_gap", [(0, 300, 10, 0), (3, 170, 25, 100), (150, 300, 1, 5)]
+)
+def test_csr_selector_band(clr, lo, hi, max_diag, max_gap):
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", 100)
+    query = selector.band(lo, hi, max_diag, max_gap=max_gap)
+
+    pixels = clr.pixels()[:]
+    pixels["__index"] = np.arange(len(pixels))
+    pixels = pixels[
+        (pixels["bin1_id"] >= lo)
+        & (pixels["bin2_id"] < hi)
+        & (pixels["bin2_id"] - pixels["bin1_id"] < max_diag)
+    ]
+
+    chunks = list(query.read_chunked(include_index=True))
+    assert len(chunks) > 1
+    for key in ["bin1_id", "bin2_id", "count", "__index"]:
+        result = np.concatenate([chunk[key] for chunk in chunks])
+        assert np.array_equal(result, pixels[key].values)
+
+
+@pytest.mark.parametrize("prefetch", [1, 3])
+def test_read_chunked_prefetch(clr, prefetch):
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", 500)
+    query = selector[0:n_bins, 0:n_bins]
+    chunks = list(query.read_chunked(include_index=True))
+    assert len(chunks) > prefetch + 2
+
+    query = selector[0:n_bins, 0:n_bins]
+    prefetched = list(query.read_chunked(include_index=True, prefetch=prefetch))
+    assert len(prefetched) == len(chunks)
+    for chunk, prefetched_chunk in zip(chunks, prefetched):
+        for key in chunk:
+            assert np.array_equal(chunk[key], prefetched_chunk[key])
+    assert query.read_time > 0
+    assert query.wait_time >= 0
+
+    # the reader stops, when the consumer does:
+    n_threads = threading.active_count()
+    prefetched = query.read_chunked(prefetch=prefetch)
+    next(prefetched)
+    assert threading.active_count() == n_threads + 1
+    prefetched.close()
+    assert threading.active_count() == n_threads
+
+
+def test_read_chunked_prefetch_error(clr):
+    n_bins = len(clr.bins())
+    selector = CSRSelector(clr.open("r"), (n_bins, n_bins), "count", 500)
+    query = selector[0:n_bins, 0:n_bins]
+    getchunk = query._getchunk
+
+    def failing_getchunk(i, include_index=False):
+        if i == 3:
+            raise KeyError("chunk {}".format(i))
+        return getchunk(i, include_index)
+
+    query._getchunk = failing_getchunk
+    n_threads = threading.active_count()
+    # errors of the reader are raised in the consumer, after the good chunks:
+    chunks = []
+    with pytest.raises(KeyError, match="chunk 3"):
+        for chunk in query.read_chunked(prefetch=2):
+            chunks.append(chunk)
+    assert len(chunks) == 3
+    assert threading.active_count() == n_threads
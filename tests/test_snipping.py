@@ -0,0 +1,454 @@
+# test pileups of snippets on a small synthetic Hi-C map:
+
+import subprocess
+import sys
+
+import multiprocess as mp
+import numpy as np
+import pandas as pd
+import bioframe
+import pytest
+
+from cooltools import snipping
+from cooltools.lib import numutils
+
+
+binsize = 1000
+chromsizes = pd.Series({"chr1": 300000, "chr2": 200000})
+bad_bins = {"chr1": [7, 150], "chr2": [30]}
+flank = 10000
+
+
+def make_expected(clr):
+    """
+    Average balanced contacts per diagonal, with a 'chrom' column.
+    """
+    exp_tables = []
+    for chrom in clr.chromnames:
+        mat = clr.matrix(balance=True).fetch(chrom)
+        avg = [np.nanmean(np.diagonal(mat, d)) for d in range(len(mat))]
+        exp_tables.append(pd.DataFrame({"chrom": chrom, "balanced.avg": avg}))
+    return pd.concat(exp_tables, ignore_index=True)
+
+
+def make_features(n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    chroms = rng.choice(chromsizes.index, n)
+    mids = np.array([rng.randint(0, chromsizes[chrom]) for chrom in chroms])
+    features = pd.DataFrame({"chrom": chroms, "start": mids, "end": mids + 1})
+    features["strand"] = rng.choice(["+", "-"], n)
+    return features
+
+
+@pytest.fixture(scope="module")
+def synthetic(make_synthetic_cooler):
+    clr = make_synthetic_cooler(
+        "snipping",
+        binsize=binsize,
+        chromsizes=chromsizes,
+        bad_bins=bad_bins,
+        seed=5,
+        scale=500.0,
+    )
+    expected = make_expected(clr)
+    features = make_features()
+    supports = [(chrom, 0, chromsizes[chrom]) for chrom in chromsizes.index]
+    windows = snipping.make_bin_aligned_windows(
+        binsize, features["chrom"], features["start"], flank_bp=flank
+    )
+    windows["strand"] = features["strand"]
+    windows = snipping.assign_regions(windows, supports)
+    return clr, expected, windows, supports
+
+
+def test_accumulate_pileup(synthetic):
+    clr, expected, windows, supports = synthetic
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    stack = snipping.pileup(windows, snipper.select, snipper.snip)
+
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    edges = np.linspace(0, 5, 501)
+    acc = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, sketch_edges=edges
+    )
+    assert acc.n == len(windows)
+    assert np.array_equal(acc.count, np.isfinite(stack).sum(axis=2))
+    with np.errstate(invalid="ignore"):
+        assert np.allclose(acc.mean, np.nanmean(stack, axis=2), equal_nan=True)
+        assert np.allclose(acc.std, np.nanstd(stack, axis=2), equal_nan=True)
+        lower = np.nanquantile(stack, 0.5, axis=2, interpolation="lower")
+        higher = np.nanquantile(stack, 0.5, axis=2, interpolation="higher")
+    # median from the histogram sketch is exact up to a histogram bin:
+    median = acc.quantile(0.5)
+    has_values = np.isfinite(lower)
+    assert np.all((median >= lower - 0.01)[has_values])
+    assert np.all((median <= higher + 0.01)[has_values])
+    assert np.array_equal(np.isfinite(median), has_values)
+
+    # aggregation by groups:
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    accs = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, by="strand"
+    )
+    assert set(accs) == set(windows["strand"])
+    for strand, acc in accs.items():
+        substack = stack[:, :, (windows["strand"] == strand).values]
+        assert acc.n == substack.shape[2]
+        assert np.allclose(acc.sum, np.nansum(substack, axis=2))
+
+    # merged groups add up to the total:
+    total = snipping.PileupAccumulator()
+    for acc in accs.values():
+        total.merge(acc)
+    assert np.array_equal(total.count, np.isfinite(stack).sum(axis=2))
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_snip_batch(synthetic, sparse):
+    clr, expected, windows, supports = synthetic
+    snipper = snipping.ObsExpSnipper(clr, expected, cooler_opts={"sparse": sparse})
+    # windows sticking out of the chromosome ends are padded with NaNs:
+    spans = [(-5000, 16000, -5000, 16000), (100000, 121000, 110000, 131000)]
+    spans.append((290000, 311000, 280000, 301000))
+    region = ("chr1", 0, chromsizes["chr1"])
+    matrix = snipper.select(region, region)
+    batch = snipper.snip_batch(matrix, region, region, spans)
+    assert batch.shape == (3, 21, 21)
+
+    obs = clr.matrix(balance=True).fetch("chr1")
+    exp = expected.loc[expected["chrom"] == "chr1", "balanced.avg"].values
+    i, j = np.indices(obs.shape)
+    obs_exp = obs / exp[np.abs(j - i)]
+    n = len(obs)
+    for snippet, (s1, e1, s2, e2) in zip(batch, spans):
+        lo1, hi1, lo2, hi2 = s1 // binsize, e1 // binsize, s2 // binsize, e2 // binsize
+        ref = np.full((hi1 - lo1, hi2 - lo2), np.nan)
+        i0, i1, j0, j1 = max(lo1, 0), min(hi1, n), max(lo2, 0), min(hi2, n)
+        ref[i0 - lo1 : i1 - lo1, j0 - lo2 : j1 - lo2] = obs_exp[i0:i1, j0:j1]
+        assert np.allclose(snippet, ref, equal_nan=True)
+        # single snippets are the same as batched ones:
+        single = snipper.snip(matrix, region, region, (s1, e1, s2, e2))
+        assert np.allclose(snippet, single, equal_nan=True)
+
+
+def test_accumulate_snipper_pileup(synthetic):
+    clr, expected, windows, supports = synthetic
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    serial = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, by="strand"
+    )
+
+    spec = snipping.SnipperSpec(snipping.ObsExpSnipper, clr.uri, expected)
+    pool = mp.Pool(2)
+    try:
+        parallel = snipping.accumulate_snipper_pileup(
+            windows, spec, by="strand", map=pool.imap_unordered
+        )
+    finally:
+        pool.close()
+    assert set(parallel) == set(serial)
+    for strand, acc in parallel.items():
+        assert acc.n == serial[strand].n
+        assert np.array_equal(acc.count, serial[strand].count)
+        assert np.allclose(acc.sum, serial[strand].sum)
+        assert np.allclose(acc.sumsq, serial[strand].sumsq)
+
+
+def test_compute_pileup_cli(synthetic, tmpdir):
+    clr, expected, windows, supports = synthetic
+    features_path = str(tmpdir.join("features.tsv"))
+    expected_path = str(tmpdir.join("expected.tsv"))
+    out_prefix = str(tmpdir.join("out"))
+    features = make_features()
+    features.to_csv(features_path, sep="\t", index=False)
+    expected.to_csv(expected_path, sep="\t", index=False)
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "cooltools",
+            "compute-pileup",
+            clr.uri,
+            features_path,
+            "--expected",
+            expected_path,
+            "--flank",
+            str(flank),
+            "--by",
+            "strand",
+            "-p",
+            "2",
+            "-o",
+            out_prefix,
+        ]
+    )
+    result = np.load(out_prefix + ".pileup.npz")
+
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    accs = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, by="strand"
+    )
+    assert sorted(result["groups"]) == sorted(accs)
+    for group, mean, n in zip(result["groups"], result["mean"], result["n"]):
+        assert n == accs[group].n
+        assert np.allclose(mean, accs[group].mean, equal_nan=True)
+
+
+@pytest.mark.parametrize("balance", [True, False])
+def test_select_windows(synthetic, balance):
+    clr, expected, windows, supports = synthetic
+    region = ("chr1", 0, chromsizes["chr1"])
+    # on-diagonal, off-diagonal and out-of-bounds windows:
+    spans = [(50000, 71000, 50000, 71000), (100000, 121000, 140000, 161000)]
+    spans += [(160000, 181000, 100000, 121000), (-5000, 16000, -5000, 16000)]
+    snippers = [
+        snipping.CoolerSnipper(clr, cooler_opts={"balance": balance}),
+        snipping.ObsExpSnipper(clr, expected, cooler_opts={"balance": balance}),
+    ]
+    for snipper in snippers:
+        matrix = snipper.select(region, region)
+        windowed = snipper.select_windows(region, region, spans)
+        assert windowed.shape == matrix.shape
+        # only the rows of the windows are read:
+        assert windowed.nnz < matrix.nnz / 2
+        assert np.allclose(
+            snipper.snip_batch(windowed, region, region, spans),
+            snipper.snip_batch(matrix, region, region, spans),
+            equal_nan=True,
+        )
+
+
+def test_expected_templates(synthetic):
+    clr, expected, windows, supports = synthetic
+    region = ("chr2", 0, chromsizes["chr2"])
+    exp = expected.loc[expected["chrom"] == "chr2", "balanced.avg"].values
+    i, j = np.indices((len(exp), len(exp)))
+    toeplitz = exp[np.abs(j - i)]
+    snipper = snipping.ExpectedSnipper(clr, expected, max_templates=2)
+    data = snipper.select(region, region)
+    # on-diagonal windows share a single template:
+    spans = [(s, s + 21000, s, s + 21000) for s in range(20000, 150000, 7000)]
+    # off-diagonal windows on two more diagonals:
+    spans += [(50000, 71000, 80000, 101000), (90000, 111000, 120000, 141000)]
+    spans += [(40000, 61000, 10000, 31000)]
+    batch = snipper.snip_batch(data, region, region, spans)
+    for snippet, (s1, e1, s2, e2) in zip(batch, spans):
+        ref = toeplitz[s1 // binsize : e1 // binsize, s2 // binsize : e2 // binsize]
+        assert np.allclose(snippet, ref)
+    # the least recently used templates are evicted:
+    assert len(snipper._templates) == 2
+    assert np.allclose(snipper.snip(data, region, region, spans[0]), batch[0])
+
+
+def test_assign_regions():
+    rng = np.random.RandomState(7)
+    # overlapping supports, including one open-ended:
+    supports = [("chr1", 0, 150000), ("chr1", 100000, 300000), ("chr2", 50000, None)]
+    starts = rng.randint(0, 300000, 500)
+    features = pd.DataFrame(
+        {
+            "chrom": rng.choice(["chr1", "chr2", "chr3"], 500),
+            "start": starts,
+            "end": starts + rng.randint(0, 20000, 500),
+        }
+    )
+    # the last of the overlapping supports, features ending at the start
+    # of a support are assigned to it:
+    expected = pd.Series(np.nan, index=features.index, dtype=object)
+    for region in supports:
+        chrom, start, end = region
+        sel = (features.chrom == chrom) & (features.end >= start)
+        if end is not None:
+            sel &= features.start < end
+        expected[sel] = "{}:{}-{}".format(*region)
+    result = snipping.assign_regions(features, supports)
+    assert result["region"].fillna("").equals(expected.fillna(""))
+
+    # supports are assigned by either end of off-diagonal features:
+    paired = pd.DataFrame(
+        {
+            "chrom1": features["chrom"],
+            "start1": features["start"],
+            "end1": features["end"],
+            "chrom2": "chr3",
+            "start2": 0,
+            "end2": 10000,
+        }
+    )
+    result = snipping.assign_regions(paired, supports)
+    assert result["region"].fillna("").equals(expected.fillna(""))
+    paired["chrom2"], paired["start2"], paired["end2"] = "chr2", 60000, 70000
+    result = snipping.assign_regions(paired, supports)
+    assert (result["region"] == "chr2:50000-None").all()
+
+
+def test_accumulate_rescaled_pileup(synthetic):
+    clr, expected, windows, supports = synthetic
+    # rescaling by an integer factor is block-averaging:
+    rng = np.random.RandomState(11)
+    stack = rng.uniform(size=(4, 12, 18))
+    blocks = stack.reshape(4, 4, 3, 6, 3).mean(axis=(2, 4))
+    assert np.allclose(numutils.zoom_array_stack(stack, (4, 6)), blocks)
+    # sums are preserved for any shapes, both when coarsening and refining:
+    for shape in [(5, 7), (30, 40)]:
+        rescaled = numutils.zoom_array_stack(stack, shape, same_sum=True)
+        assert np.allclose(rescaled.sum(axis=(1, 2)), stack.sum(axis=(1, 2)))
+
+    # domains of different sizes, including a few of the same size:
+    starts = rng.randint(0, 150, 40) * binsize
+    domains = pd.DataFrame(
+        {
+            "chrom": rng.choice(chromsizes.index, 40),
+            "start": starts,
+            "end": starts + rng.choice([5, 8, 13, 20, 31], 40) * binsize,
+        }
+    )
+    domains = snipping.assign_regions(domains, supports)
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    acc = snipping.accumulate_rescaled_pileup(
+        domains, snipper.select, snipper.snip, binsize, flank=0.5, shape=(20, 20)
+    )
+    assert acc.n == len(domains)
+
+    snippets = []
+    for _, domain in domains.iterrows():
+        region = bioframe.parse_region_string(domain["region"])
+        size = domain["end"] - domain["start"]
+        lo = int(np.floor((domain["start"] - size / 2) / binsize)) * binsize
+        hi = int(np.ceil((domain["end"] + size / 2) / binsize)) * binsize
+        matrix = snipper.select(region, region)
+        snippet = snipper.snip(matrix, region, region, (lo, hi, lo, hi))
+        snippets.append(numutils.zoom_array_stack(snippet[np.newaxis], (20, 20)))
+    snippets = np.concatenate(snippets)
+    with np.errstate(invalid="ignore"):
+        assert np.allclose(acc.mean, np.nanmean(snippets, axis=0), equal_nan=True)
+    assert np.array_equal(acc.count, np.isfinite(snippets).sum(axis=0))
+
+
+def test_accumulate_multi_pileup(synthetic):
+    clr, expected, windows, supports = synthetic
+    conditions = {"obs_exp": (clr, expected), "obs": (clr.uri, None)}
+    pool = mp.Pool(2)
+    try:
+        pileups = snipping.accumulate_multi_pileup(
+            windows, conditions, by="strand", map=pool.imap_unordered
+        )
+    finally:
+        pool.close()
+    assert set(pileups) == set(conditions)
+
+    snippers = {
+        "obs_exp": snipping.ObsExpSnipper(clr, expected),
+        "obs": snipping.CoolerSnipper(clr),
+    }
+    for condition, snipper in snippers.items():
+        accs = snipping.accumulate_pileup(
+            windows, snipper.select, snipper.snip, by="strand"
+        )
+        assert set(pileups[condition]) == set(accs)
+        for strand, acc in accs.items():
+            assert pileups[condition][strand].n == acc.n
+            assert np.allclose(pileups[condition][strand].sum, acc.sum)
+
+    # conditions in a list are indexed by their positions:
+    pileups = snipping.accumulate_multi_pileup(windows, [(clr, expected)])
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    acc = snipping.accumulate_pileup(windows, snipper.select, snipper.snip)
+    assert np.allclose(pileups[0].sum, acc.sum)
+
+
+def test_shifted_controls(synthetic):
+    clr, expected, windows, supports = synthetic
+    windows = windows[windows["region"].notnull()]
+    controls = snipping.ShiftedControls(binsize, 5, 20000, 60000, seed=3)
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    observed, control = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, by="strand", control=controls
+    )
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    reference = snipping.accumulate_pileup(
+        windows, snipper.select, snipper.snip, by="strand"
+    )
+    for strand, acc in reference.items():
+        assert np.allclose(observed[strand].sum, acc.sum)
+
+    # controls are shifted windows of features, within their regions:
+    control_windows = []
+    for region, group in windows.groupby("region", sort=False):
+        spans = np.c_[group["start"], group["end"], group["start"], group["end"]]
+        control_spans = controls.control_spans(region, spans)
+        shifts = control_spans - spans[:, np.newaxis, :]
+        assert np.all(shifts == shifts[:, :, :1])
+        assert np.all(np.abs(shifts) >= 20000) and np.all(np.abs(shifts) <= 60000)
+        assert np.all(shifts % binsize == 0)
+        chrom, start, end = bioframe.parse_region_string(region)
+        inside = (control_spans[:, :, 0] >= start) & (control_spans[:, :, 1] <= end)
+        assert inside.mean() > 0.9
+        control_windows.append(
+            pd.DataFrame(
+                {
+                    "chrom": chrom,
+                    "start": control_spans[:, :, 0].ravel(),
+                    "end": control_spans[:, :, 1].ravel(),
+                    "strand": np.repeat(group["strand"].values, 5),
+                    "region": region,
+                }
+            )
+        )
+    control_windows = pd.concat(control_windows, ignore_index=True)
+    snipper = snipping.ObsExpSnipper(clr, expected)
+    reference = snipping.accumulate_pileup(
+        control_windows, snipper.select, snipper.snip, by="strand"
+    )
+    for strand, acc in reference.items():
+        assert control[strand].n == acc.n
+        assert np.allclose(control[strand].sum, acc.sum)
+
+
+def test_shifted_controls_bare_chromosome():
+    controls = snipping.ShiftedControls(binsize, 20, 20000, 60000, seed=3)
+    # windows close to the start of the chromosome, as a bare chromosome:
+    spans = np.array([[5000, 26000, 5000, 26000], [0, 1000, 40000, 41000]])
+    for support in ["chr1", ("chr1", "chr1")]:
+        control_spans = controls.control_spans(support, spans)
+        shifts = control_spans - spans[:, np.newaxis, :]
+        assert np.all(np.abs(shifts) >= 20000) and np.all(np.abs(shifts) <= 60000)
+        # all of the shifts are flipped downstream, within the chromosome:
+        assert np.all(control_spans >= 0)
+
+
+def test_iter_site_pairs():
+    rng = np.random.RandomState(2)
+    mids = rng.randint(0, 200000, 400)
+    sites = pd.DataFrame(
+        {
+            "chrom": rng.choice(["chr1", "chr2"], 400),
+            "start": mids,
+            "end": mids + 1,
+            "strand": rng.choice(["+", "-"], 400),
+        },
+        index=np.arange(400) * 10,
+    )
+    # all pairs within the distance range:
+    d = mids[np.newaxis, :] - mids[:, np.newaxis]
+    same = sites["chrom"].values[:, np.newaxis] == sites["chrom"].values
+    i, j = np.nonzero(same & (d >= 5000) & (d <= 7000))
+    expected = set(zip(sites.index[i], sites.index[j]))
+
+    chunks = list(snipping.iter_site_pairs(sites, 6000, 1000, chunksize=50))
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    pairs = pd.concat(chunks, ignore_index=True)
+    assert len(pairs) == len(expected)
+    assert set(zip(pairs["site_id1"], pairs["site_id2"])) == expected
+    assert (pairs["mid2"] - pairs["mid1"]).between(5000, 7000).all()
+    assert pairs["strand1"].equals(
+        sites.loc[pairs["site_id1"], "strand"].reset_index(drop=True)
+    )
+
+    # hands of paired sites overlap:
+    hands = snipping.pair_sites(sites, 3000, 500)
+    in_bounds = mids - 3500 > 0
+    paired = same & (np.abs(d - 6000) < 1000) & in_bounds & in_bounds[:, np.newaxis]
+    assert len(hands) == paired.sum()
+    assert (hands["start_r"] < hands["end_l"]).all()
+    assert (hands["start_l"] < hands["end_r"]).all()